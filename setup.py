@@ -27,7 +27,8 @@ setup(
     author_email="package-maintainer@gns3.net",
     description="Script to control VirtualBox on Linux/Unix",
     long_description=open("README.md", "r").read(),
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests"]),
+    test_suite="tests",
     entry_points={
         "console_scripts": [
             "vboxwrapper = vboxwrapper.vboxwrapper:main",
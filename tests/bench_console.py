@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the serial consoles: serves idle consoles, with a client
+connected to each of them, with the console hub and then with a
+PipeProxy thread per console, and prints the CPU time and the wakeups
+of each while nothing happens. The wakeups of the PipeProxy threads are
+not counted, each of them polls ten times a second.
+
+Run it from the top of the source tree:
+
+    python2.7 -m tests.bench_console [consoles] [seconds]
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import socket
+import sys
+import time
+
+from vboxwrapper.console_hub import ConsoleHub
+from vboxwrapper.tcp_pipe_proxy import PipeProxy
+
+
+def cpu_time():
+
+    times = os.times()
+    return times[0] + times[1]
+
+
+def start_hub(pipes):
+
+    hub = ConsoleHub()
+    consoles = [hub.add_console("VM%d" % index, pipe, "127.0.0.1", 0) for index, pipe in enumerate(pipes)]
+    return hub, consoles, [console.port for console in consoles]
+
+
+def start_threads(pipes):
+
+    consoles = []
+    for index, pipe in enumerate(pipes):
+        console = PipeProxy("VM%d" % index, pipe, "127.0.0.1", 0)
+        console.setDaemon(True)
+        console.start()
+        consoles.append(console)
+    return None, consoles, [console.server.getsockname()[1] for console in consoles]
+
+
+def wakeups(hub):
+
+    return dict(hub.metrics())["console_hub.wakeups"]
+
+
+def measure(start, count, seconds):
+    """
+    Serves idle consoles for a while.
+
+    :returns: tuple of CPU seconds and wakeups per second, None for
+    the wakeups of the PipeProxy threads which are not counted
+    """
+
+    pairs = [socket.socketpair() for _ in range(count)]
+    hub, consoles, ports = start(pipe for vm, pipe in pairs)
+    clients = [socket.create_connection(("127.0.0.1", port)) for port in ports]
+    # lets the clients be accepted and the banners be sent
+    time.sleep(1)
+    rate = None
+    start_cpu = cpu_time()
+    if hub is not None:
+        start_wakeups = wakeups(hub)
+    time.sleep(seconds)
+    cpu = cpu_time() - start_cpu
+    if hub is not None:
+        rate = (wakeups(hub) - start_wakeups) / float(seconds)
+        hub.stop()
+    for console in consoles:
+        console.stop()
+    for console in consoles:
+        console.join(1)
+    for sock in clients + [sock for pair in pairs for sock in pair]:
+        sock.close()
+    return cpu, rate
+
+
+def main():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    logging.disable(logging.CRITICAL)
+    # the PipeProxy threads print their clients
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        results = [("console hub", measure(start_hub, count, seconds)),
+                   ("PipeProxy threads", measure(start_threads, count, seconds))]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print("{} idle consoles with a client each, for {:.1f}s:".format(count, seconds))
+    for name, (cpu, rate) in results:
+        print("  {:<18} CPU {:6.3f}s ({:5.1f}%)  wakeups/s {}".format(name, cpu, cpu / seconds * 100,
+                                                                      "n/a" if rate is None else "{:.1f}".format(rate)))
+
+if __name__ == '__main__':
+    main()
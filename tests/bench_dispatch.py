@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the control protocol: tokenizes and dispatches the
+requests of a replayed GNS3 session (VMs created and configured with
+setattr, captures started and stopped, then everything torn down) and
+prints the best rates. Nothing calls VirtualBox.
+
+Run it from the top of the source tree:
+
+    python2.7 -m tests.bench_dispatch [repetitions]
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import time
+
+from vboxwrapper import vboxwrapper
+from vboxwrapper.tokenizer import tokenize, _csv_tokenize
+from vboxwrapper.worker_pool import WorkerPool, KeyedExecutor
+
+
+class Sink(object):
+    """
+    Discards the replies.
+    """
+
+    def write(self, data):
+
+        pass
+
+
+class Server(object):
+
+    def __init__(self):
+
+        self.executor = KeyedExecutor(WorkerPool(1))
+
+
+def session(vms=40, captures=3):
+    """
+    Returns the request lines of a GNS3 session.
+    """
+
+    lines = ["vboxwrapper version", "vbox version"]
+    for index in range(vms):
+        name = "VBOX%d" % index
+        lines += ["vbox create vbox %s" % name,
+                  'vbox setattr %s image "Lab VM %d"' % (name, index),
+                  "vbox setattr %s console %d" % (name, 3000 + index),
+                  "vbox setattr %s nics 4" % name,
+                  'vbox setattr %s netcard "Intel PRO/1000 MT Desktop (82540EM)"' % name,
+                  "vbox setattr %s headless_mode True" % name,
+                  "vbox setattr %s enable_console True" % name,
+                  "vbox setattr %s nic_start_index 0" % name]
+        lines += ["vbox create_capture %s %d /tmp/%s_%d.pcap" % (name, vnic, name, vnic) for vnic in range(captures)]
+    for index in range(vms):
+        lines += ["vbox delete_capture VBOX%d %d" % (index, vnic) for vnic in range(captures)]
+        lines.append("vbox delete VBOX%d" % index)
+    return lines
+
+
+def best_rate(run, count, repetitions):
+    """
+    Returns the best number of calls per second of several runs.
+    """
+
+    best = 0.0
+    for _ in range(repetitions):
+        start = time.time()
+        run()
+        best = max(best, count / (time.time() - start))
+    return best
+
+
+def main():
+
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    lines = session()
+    requests = [line + "\r\n" for line in lines] * 20
+
+    handler = vboxwrapper.VBoxWrapperRequestHandler.__new__(vboxwrapper.VBoxWrapperRequestHandler)
+    handler.wfile = Sink()
+    handler.server = Server()
+    handler._init_request_state()
+
+    def dispatch():
+        for request in requests:
+            handler.process_request(request)
+
+    def tokenize_all():
+        for request in requests:
+            tokenize(request.rstrip())
+
+    def csv_tokenize_all():
+        for request in requests:
+            _csv_tokenize(request.rstrip())
+
+    logging.disable(logging.CRITICAL)
+    # the instances print their creation
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rates = [("tokenize", best_rate(tokenize_all, len(requests), repetitions)),
+                 ("csv tokenizer", best_rate(csv_tokenize_all, len(requests), repetitions)),
+                 ("process_request", best_rate(dispatch, len(requests), repetitions))]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print("{} requests per session, best of {} runs:".format(len(lines), repetitions))
+    for name, rate in rates:
+        print("  {:<16} {:>8.0f} requests/s".format(name, rate))
+
+if __name__ == '__main__':
+    main()
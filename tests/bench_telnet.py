@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the Telnet processing of the console traffic: escapes
+VM output and filters client input, 4 KB at a time, with the bulk
+functions and with a byte at a time reference, and prints the best
+throughputs.
+
+Run it from the top of the source tree:
+
+    python2.7 -m tests.bench_telnet [repetitions]
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from vboxwrapper.tcp_pipe_proxy import TelnetClient, escape, IAC
+from tests.test_tcp_pipe_proxy import ByteTelnetClient, Socket, random_stream
+
+CHUNK_SIZE = 4096
+
+
+def byte_escape(data):
+
+    return "".join(IAC + IAC if byte == IAC else byte for byte in data)
+
+
+def boot_log(size):
+    """
+    Returns console output without any IAC.
+    """
+
+    lines = []
+    index = 0
+    while size > 0:
+        line = "[%12.6f] eth%d: link up, 1000Mbps, full-duplex, lpa 0x%04X\r\n" % (index * 0.0137, index % 4, index)
+        lines.append(line)
+        size -= len(line)
+        index += 1
+    return "".join(lines)
+
+
+def best_rate(run, size, repetitions):
+    """
+    Returns the best number of MB per second of several runs.
+    """
+
+    best = 0.0
+    for _ in range(repetitions):
+        start = time.time()
+        run()
+        best = max(best, size / (time.time() - start) / 1e6)
+    return best
+
+
+def main():
+
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    size = 1024 * 1024
+    inputs = [("boot log", boot_log(size)), ("random", random_stream(random.Random(17), size))]
+
+    print("{} KB chunks, best of {} runs:".format(CHUNK_SIZE // 1024, repetitions))
+    print("  {:<20} {:>14} {:>12}".format("", "byte at a time", "bulk"))
+    for name, data in inputs:
+        chunks = [data[position:position + CHUNK_SIZE] for position in range(0, len(data), CHUNK_SIZE)]
+
+        def escape_with(func):
+            def run():
+                for chunk in chunks:
+                    func(chunk)
+            return run
+
+        def filter_with(cls):
+            def run():
+                telnet = cls(Socket(), ("127.0.0.1", 50000))
+                for chunk in chunks:
+                    telnet.filter(chunk)
+                    del telnet.sock.sent[:]
+            return run
+
+        for what, reference, bulk in (("escape", escape_with(byte_escape), escape_with(escape)),
+                                      ("filter", filter_with(ByteTelnetClient), filter_with(TelnetClient))):
+            print("  {:<20} {:>9.1f} MB/s {:>7.1f} MB/s".format("{}, {}".format(what, name),
+                                                                best_rate(reference, len(data), repetitions),
+                                                                best_rate(bulk, len(data), repetitions)))
+
+if __name__ == '__main__':
+    main()
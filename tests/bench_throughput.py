@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the console throughput: copies console-like text from a
+VM to a client of its console and from the client to the VM, with a
+Telnet console and with a raw console of the console hub, and prints
+the MB/s of each direction.
+
+Run it from the top of the source tree:
+
+    python2.7 -m tests.bench_throughput [megabytes]
+"""
+
+from __future__ import print_function
+
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+from vboxwrapper.console_hub import ConsoleHub
+from vboxwrapper.tcp_pipe_proxy import set_output_buffer, banner, DROP_OLDEST, OUTPUT_BUFFER_SIZE, OUTPUT_POLICY
+
+CHUNK_SIZE = 65536
+
+
+def drain(sock, size, received):
+    """
+    Receives a number of bytes and discards them.
+    """
+
+    sock.settimeout(10)
+    buffer = bytearray(262144)
+    count = 0
+    while count < size:
+        try:
+            read = sock.recv_into(buffer)
+        except socket.timeout:
+            break
+        if not read:
+            break
+        count += read
+    received.append(count)
+
+
+def transfer(sender, receiver, chunk, count, size):
+    """
+    Sends a chunk a number of times while another thread receives it.
+
+    :returns: MB per second
+    """
+
+    received = []
+    thread = threading.Thread(target=drain, args=(receiver, size, received))
+    thread.start()
+    start = time.time()
+    for _ in range(count):
+        sender.sendall(chunk)
+    thread.join()
+    elapsed = time.time() - start
+    if received[0] != size:
+        raise RuntimeError("received {} bytes instead of {}".format(received[0], size))
+    return len(chunk) * count / elapsed / 1e6
+
+
+def measure(raw, chunk, count):
+    """
+    Copies the chunk through a console in both directions.
+
+    :returns: tuple of the MB per second from the VM and to the VM
+    """
+
+    hub = ConsoleHub()
+    vm, pipe = socket.socketpair()
+    console = hub.add_console("VM1", pipe, "127.0.0.1", 0, raw=raw)
+    client = socket.create_connection(("127.0.0.1", console.port))
+    try:
+        if not raw:
+            # the option requests and the banner
+            data = ""
+            while banner("VM1") not in data:
+                data += client.recv(4096)
+        # the IACs are doubled for the Telnet clients
+        output_size = count * (len(chunk) + (0 if raw else chunk.count("\xff")))
+        from_vm = transfer(vm, client, chunk, count, output_size)
+        # neither IACs nor CR LF, so the input reaches the VM unchanged
+        typed = chunk.replace("\xff", "x").replace("\r", "x")
+        to_vm = transfer(client, vm, typed, count, len(typed) * count)
+    finally:
+        hub.stop()
+        for sock in (client, vm, pipe):
+            sock.close()
+    return from_vm, to_vm
+
+
+def main():
+
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    count = megabytes * 1024 * 1024 // CHUNK_SIZE
+    generator = random.Random(1)
+    # console-like text with the odd IAC
+    characters = [chr(code) for code in range(32, 127)] * 4 + ["\r", "\n", "\xff"]
+    chunk = "".join(generator.choice(characters) for _ in range(CHUNK_SIZE))
+
+    logging.disable(logging.CRITICAL)
+    # the throughput is measured, not the slow client handling
+    set_output_buffer(1 << 30, DROP_OLDEST)
+    try:
+        results = [("telnet", measure(False, chunk, count)), ("raw", measure(True, chunk, count))]
+    finally:
+        set_output_buffer(OUTPUT_BUFFER_SIZE, OUTPUT_POLICY)
+    print("{} MB through one console:".format(megabytes))
+    for name, (from_vm, to_vm) in results:
+        print("  {:<8} VM to client {:7.0f} MB/s  client to VM {:7.0f} MB/s".format(name, from_vm, to_vm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import threading
+import time
+import unittest
+
+from vboxwrapper import console_hub
+from vboxwrapper.console_hub import ConsoleHub
+from vboxwrapper.scrollback import Scrollback
+from vboxwrapper.tcp_pipe_proxy import banner, pipe_notice, set_output_buffer, DROP_OLDEST, DISCONNECT
+
+
+def sync(hub):
+    """
+    Waits for the hub thread to run the calls made so far.
+    """
+
+    done = threading.Event()
+    hub.call(done.set)
+    done.wait(2)
+
+
+def receive(sock, expected, timeout=2):
+    """
+    Receives until the expected string has been received.
+
+    :returns: everything received
+    """
+
+    sock.settimeout(timeout)
+    data = ""
+    while expected not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def receive_size(sock, size, timeout=5):
+
+    sock.settimeout(timeout)
+    chunks = []
+    received = 0
+    while received < size:
+        chunk = sock.recv(size - received)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+    return "".join(chunks)
+
+
+class ConsoleHubTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.hub = ConsoleHub()
+        self.vm, self.pipe = socket.socketpair()
+        self.console = self.hub.add_console("VM1", self.pipe, "127.0.0.1", 0)
+        self.sockets = [self.vm, self.pipe]
+
+    def tearDown(self):
+
+        self.hub.stop()
+        console_hub.PIPE_INPUT_SIZE = 1024 * 1024
+        console_hub.RECONNECT_DELAY = 0.05
+        console_hub.MAX_RECONNECT_DELAY = 0.5
+        set_output_buffer(65536, DROP_OLDEST)
+        for sock in self.sockets:
+            sock.close()
+
+    def metric(self, name):
+
+        return dict(self.hub.metrics())["console_hub." + name]
+
+    def connect(self):
+
+        client = socket.create_connection(("127.0.0.1", self.console.port))
+        self.sockets.append(client)
+        receive(client, banner("VM1"))
+        return client
+
+    def test_output_and_input(self):
+
+        client = self.connect()
+        self.vm.sendall("hello\xff")
+        self.assertTrue(receive(client, "hello\xff\xff").endswith("hello\xff\xff"))
+        client.sendall("ls\r\n")
+        self.assertEqual(receive(self.vm, "ls\r"), "ls\r")
+        self.assertEqual(self.metric("clients"), 1)
+
+    def test_output_to_all_clients(self):
+
+        clients = [self.connect() for _ in range(3)]
+        self.vm.sendall("boot\r\n")
+        for client in clients:
+            self.assertTrue(receive(client, "boot\r\n").endswith("boot\r\n"))
+
+    def test_send_to_pipe(self):
+
+        self.assertTrue(self.console.send_to_pipe("enable\r"))
+        self.assertEqual(receive(self.vm, "enable\r"), "enable\r")
+
+    def test_clients_paused_while_the_vm_does_not_read(self):
+
+        console_hub.PIPE_INPUT_SIZE = 4096
+        client = self.connect()
+        data = "x" * (4 * 1024 * 1024)
+        self.console.send_to_pipe(data)
+        sync(self.hub)
+        queued = self.console._input_size
+        self.assertTrue(queued >= console_hub.PIPE_INPUT_SIZE)
+        # the input of the client is not read while the queue is full
+        client.sendall("hello")
+        time.sleep(0.2)
+        sync(self.hub)
+        self.assertEqual(self.console._input_size, queued)
+        # it goes after the queued input once the VM has read it
+        received = receive_size(self.vm, len(data) + len("hello"))
+        self.assertEqual(len(received), len(data) + len("hello"))
+        self.assertTrue(received.endswith("xhello"))
+        sync(self.hub)
+        self.assertEqual(self.console._input_size, 0)
+
+    def test_queued_input_dropped_when_the_pipe_is_closed(self):
+
+        self.console.send_to_pipe("x" * (4 * 1024 * 1024))
+        sync(self.hub)
+        queued = self.console._input_size
+        self.assertTrue(queued > 0)
+        self.vm.close()
+        self.console.join(2)
+        self.assertFalse(self.console.isAlive())
+        self.assertFalse(self.console.send_to_pipe("more"))
+        self.assertEqual(self.metric("dropped_input_bytes"), queued)
+        self.assertEqual(self.metric("consoles"), 0)
+
+    def test_scrollback_replay_does_not_disconnect(self):
+
+        set_output_buffer(65536, DISCONNECT)
+        vm, pipe = socket.socketpair()
+        self.sockets.extend((vm, pipe))
+        scrollback = Scrollback(256 * 1024)
+        scrollback.append(("boot\xff" * 64) * 512)
+        console = self.hub.add_console("VM2", pipe, "127.0.0.1", 0, scrollback)
+        client = socket.create_connection(("127.0.0.1", console.port))
+        self.sockets.append(client)
+        received = receive(client, "boot\xff\xff" * 64)
+        vm.sendall("login:")
+        received += receive(client, "login:")
+        self.assertTrue(received.endswith("boot\xff\xff" * 64 + "login:"))
+        self.assertEqual(self.metric("slow_disconnects"), 0)
+
+    def test_reconnect_backoff(self):
+
+        console_hub.RECONNECT_DELAY = 0.02
+        console_hub.MAX_RECONNECT_DELAY = 0.08
+        attempts = []
+        vms = []
+        reconnected = threading.Event()
+
+        def reconnect():
+            attempts.append(time.time())
+            if len(attempts) % 6:
+                raise IOError("no such file or directory")
+            vm, pipe = socket.socketpair()
+            self.sockets.append(vm)
+            vms.append(vm)
+            reconnected.set()
+            return pipe
+
+        vm, pipe = socket.socketpair()
+        self.sockets.extend((vm, pipe))
+        console = self.hub.add_console("VM2", pipe, "127.0.0.1", 0, reconnect=reconnect)
+        client = socket.create_connection(("127.0.0.1", console.port))
+        self.sockets.append(client)
+        receive(client, banner("VM2"))
+        lost = time.time()
+        vm.close()
+        self.assertTrue(reconnected.wait(2))
+        # the delay doubles after each failure, up to the maximum
+        delays = [later - earlier for earlier, later in zip([lost] + attempts, attempts)]
+        for delay, expected in zip(delays, (0.02, 0.04, 0.08, 0.08, 0.08, 0.08)):
+            self.assertTrue(expected - 0.005 <= delay < expected + 0.05, delays)
+        received = receive(client, pipe_notice("VM2", True))
+        self.assertTrue(pipe_notice("VM2", False) in received)
+        # the clients are served by the new pipe
+        vms[0].sendall("login:")
+        self.assertTrue(receive(client, "login:").endswith("login:"))
+        client.sendall("admin\r")
+        self.assertEqual(receive(vms[0], "admin\r"), "admin\r")
+        self.assertEqual(console.reconnections, 1)
+        self.assertEqual(self.metric("reconnections"), 1)
+        # the backoff starts over when the new pipe is lost
+        reconnected.clear()
+        lost = time.time()
+        vms[0].close()
+        self.assertTrue(reconnected.wait(2))
+        self.assertTrue(attempts[6] - lost < 0.02 + 0.05)
+        self.assertEqual(console.reconnections, 2)
+
+    def test_timers(self):
+
+        calls = []
+        done = threading.Event()
+
+        def record(name):
+            calls.append((name, time.time()))
+            if name == "late":
+                done.set()
+
+        start = time.time()
+        self.hub.call(self.hub.call_later, 0.2, record, "late")
+        self.hub.call(self.hub.call_later, 0.05, record, "early")
+        self.hub.call(self.hub.call_later, 0.05, record, "early again")
+        done.wait(2)
+        self.assertEqual([name for name, when in calls], ["early", "early again", "late"])
+        self.assertTrue(calls[0][1] - start >= 0.05)
+        self.assertTrue(calls[2][1] - start >= 0.2)
+
+    def test_idle_hub_does_not_wake_up(self):
+
+        client = self.connect()
+        self.vm.sendall("prompt>")
+        receive(client, "prompt>")
+        sync(self.hub)
+        wakeups = self.metric("wakeups")
+        time.sleep(0.5)
+        self.assertEqual(self.metric("wakeups"), wakeups)
+
+    def test_stop(self):
+
+        client = self.connect()
+        self.hub.stop()
+        self.console.join(2)
+        self.assertFalse(self.console.isAlive())
+        self.assertEqual(receive(client, "never"), "")
+        # the pipe given to the console is left open
+        self.pipe.send("still open")
+        self.assertEqual(receive(self.vm, "still open"), "still open")
+
+
+class RawConsoleTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.hub = ConsoleHub()
+        self.vm, self.pipe = socket.socketpair()
+        self.scrollback = Scrollback(1024)
+        self.scrollback.append("boot\xff\r\n")
+        self.console = self.hub.add_console("VM1", self.pipe, "127.0.0.1", 0, self.scrollback, raw=True)
+        self.sockets = [self.vm, self.pipe]
+
+    def tearDown(self):
+
+        self.hub.stop()
+        for sock in self.sockets:
+            sock.close()
+
+    def connect(self, port):
+
+        client = socket.create_connection(("127.0.0.1", port))
+        self.sockets.append(client)
+        return client
+
+    def test_bytes_copied_as_they_are(self):
+
+        client = self.connect(self.console.port)
+        # no banner nor negotiation, only the scrollback
+        self.assertEqual(receive(client, "boot\xff\r\n"), "boot\xff\r\n")
+        self.vm.sendall("\xff\xfd\x01login:")
+        self.assertEqual(receive(client, "login:"), "\xff\xfd\x01login:")
+        client.sendall("admin\r\n\xff\xff")
+        self.assertEqual(receive(self.vm, "admin\r\n\xff\xff"), "admin\r\n\xff\xff")
+
+    def test_no_pipe_notices(self):
+
+        vm, pipe = socket.socketpair()
+        self.sockets.extend((vm, pipe))
+        reconnected = threading.Event()
+
+        def reconnect():
+            new_vm, new_pipe = socket.socketpair()
+            self.sockets.append(new_vm)
+            reconnected.set()
+            return new_pipe
+
+        console = self.hub.add_console("VM2", pipe, "127.0.0.1", 0, reconnect=reconnect, raw=True)
+        client = self.connect(console.port)
+        sync(self.hub)
+        vm.close()
+        self.assertTrue(reconnected.wait(2))
+        sync(self.hub)
+        client.settimeout(0.2)
+        self.assertRaises(socket.timeout, client.recv, 1024)
+
+    def test_mux_selection_by_name(self):
+
+        port = self.hub.listen("127.0.0.1", 0, raw=True)
+        client = self.connect(port)
+        # no prompt nor echo, the input following the name goes to the VM
+        client.sendall("VM1\r\nshow version\r\n")
+        self.assertEqual(receive(self.vm, "show version\r\n"), "show version\r\n")
+        self.assertEqual(receive(client, "boot\xff\r\n"), "boot\xff\r\n")
+        self.assertEqual(dict(self.hub.metrics())["console_hub.mux_attached"], 1)
+
+    def test_mux_selection_by_port(self):
+
+        port = self.hub.listen("127.0.0.1", 0, raw=True)
+        client = self.connect(port)
+        client.sendall("%d\n" % self.console.port)
+        self.assertEqual(receive(client, "boot\xff\r\n"), "boot\xff\r\n")
+        client.sendall("enable\r")
+        self.assertEqual(receive(self.vm, "enable\r"), "enable\r")
+
+    def test_mux_unknown_console(self):
+
+        port = self.hub.listen("127.0.0.1", 0, raw=True)
+        client = self.connect(port)
+        client.sendall("VM9\n")
+        self.assertEqual(receive(client, "\n"), "unknown console 'VM9'\n")
+        # the client can select another console
+        client.sendall("vm1\n")
+        self.assertEqual(receive(client, "boot\xff\r\n"), "boot\xff\r\n")
+        sync(self.hub)
+        metrics = dict(self.hub.metrics())
+        self.assertEqual(metrics["console_hub.mux_selecting"], 0)
+        self.assertEqual(metrics["console_hub.clients"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
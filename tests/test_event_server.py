@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+from vboxwrapper.event_server import EventServer
+
+
+class Handler(object):
+    """
+    Echoes the requests, "sleep" runs for a while in its own thread.
+    """
+
+    def __init__(self, connection, client_address, server):
+
+        self.connection = connection
+        self.server = server
+        self.close_connection = False
+
+    def process_request(self, line):
+
+        if line == "sleep":
+            self.server.spawn(self.connection, self._sleep)
+        elif line == "quit":
+            self.close_connection = True
+        else:
+            self.connection.write("%s\r\n" % line)
+
+    def _sleep(self):
+
+        time.sleep(0.5)
+        self.connection.write("slept\r\n")
+
+
+def cpu_time():
+
+    times = os.times()
+    return times[0] + times[1]
+
+
+class EventServerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.server = EventServer(("127.0.0.1", 0), Handler, workers=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+
+        self.server.stop()
+        self.thread.join()
+
+    def connect(self):
+
+        client = socket.create_connection(self.server.server_address)
+        client.settimeout(5)
+        return client
+
+    def receive_all(self, client):
+
+        data = ""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_requests(self):
+
+        client = self.connect()
+        client.sendall("a\nb\n")
+        client.sendall("c\nquit\nd\n")
+        self.assertEqual(self.receive_all(client), "a\r\nb\r\nc\r\n")
+
+    def test_pipelined_while_busy(self):
+
+        client = self.connect()
+        client.sendall("sleep\nafter\n")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.receive_all(client), "slept\r\nafter\r\n")
+
+    def test_half_closed_while_busy(self):
+
+        client = self.connect()
+        client.sendall("sleep\n")
+        client.shutdown(socket.SHUT_WR)
+        start = cpu_time()
+        # the connection is closed once the running request replied
+        self.assertEqual(self.receive_all(client), "slept\r\n")
+        self.assertTrue(cpu_time() - start < 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from vboxwrapper.instance_registry import InstanceRegistry
+
+
+class InstanceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.registry = InstanceRegistry()
+        for name in ("R1", "R2"):
+            self.assertTrue(self.registry.add(name, object()))
+
+    def test_mapping(self):
+
+        instance = object()
+        self.assertFalse(self.registry.add("R1", instance))
+        self.assertTrue(self.registry.add("R3", instance))
+        self.assertTrue("R3" in self.registry)
+        self.assertTrue(self.registry["R3"] is instance)
+        self.assertEqual(len(self.registry), 3)
+        self.assertEqual(sorted(self.registry.names()), ["R1", "R2", "R3"])
+        self.assertTrue(self.registry.remove("R3") is instance)
+        self.assertEqual(self.registry.remove("R3"), None)
+        self.assertEqual(self.registry.get("R3", "missing"), "missing")
+
+    def test_lock_created_on_demand(self):
+
+        lock = self.registry.lock("R3")
+        self.assertTrue(self.registry.lock("R3") is lock)
+        # the commands racing with the creation wait for the same lock
+        self.registry.add("R3", object())
+        self.assertTrue(self.registry.lock("R3") is lock)
+        self.registry.remove("R3")
+        self.assertTrue(self.registry.lock("R3") is lock)
+        self.assertFalse(self.registry.lock("R1") is lock)
+
+    def test_lock_excludes(self):
+
+        acquired = []
+        with self.registry.lock("R1"):
+            thread = threading.Thread(target=lambda: acquired.append(self.registry.lock("R1").acquire(False)))
+            thread.start()
+            thread.join()
+            # re-entrant for the holder
+            with self.registry.lock("R1"):
+                pass
+        self.assertEqual(acquired, [False])
+
+    def test_image_index(self):
+
+        self.assertEqual(self.registry.set_image("R1", "Router"), [])
+        self.assertEqual(self.registry.set_image("R2", "Router"), ["R1"])
+        self.assertEqual(self.registry.find_by_image("Router"), ["R1", "R2"])
+        self.assertEqual(self.registry.set_image("R1", "Switch"), [])
+        self.assertEqual(self.registry.find_by_image("Router"), ["R2"])
+        self.assertEqual(self.registry.set_image("R3", "Router"), [])
+        self.assertEqual(self.registry.find_by_image("Router"), ["R2"])
+        self.registry.remove("R2")
+        self.assertEqual(self.registry.find_by_image("Router"), [])
+
+    def test_console_index(self):
+
+        self.assertEqual(self.registry.set_console("R1", "3001"), None)
+        self.assertEqual(self.registry.find_by_console(3001), "R1")
+        self.assertEqual(self.registry.set_console("R2", 3001), "R1")
+        self.assertEqual(self.registry.find_by_console("3001"), "R1")
+        self.assertEqual(self.registry.set_console("R1", 3002), None)
+        self.assertEqual(self.registry.find_by_console(3001), None)
+        self.assertEqual(self.registry.set_console("R2", 3001), None)
+        # the ports of a console swap are freed first
+        self.assertEqual(self.registry.remove_console("R1"), 3002)
+        self.assertEqual(self.registry.remove_console("R1"), None)
+        self.assertEqual(self.registry.set_console("R1", 3001), "R2")
+        self.registry.remove("R2")
+        self.assertEqual(self.registry.set_console("R1", 3001), None)
+
+    def test_udp_index(self):
+
+        self.assertEqual(self.registry.add_udp("R1", 0, 10000), None)
+        self.assertEqual(self.registry.add_udp("R2", 0, "10000"), "R1")
+        self.assertEqual(self.registry.find_by_udp_port(10000), ("R1", 0))
+        # a new port for the same adapter replaces the previous one
+        self.assertEqual(self.registry.add_udp("R1", 0, 10002), None)
+        self.assertEqual(self.registry.find_by_udp_port(10000), None)
+        self.assertEqual(self.registry.add_udp("R1", 1, 10003), None)
+        self.registry.remove_udp("R1", 0)
+        self.assertEqual(self.registry.find_by_udp_port(10002), None)
+        self.registry.remove("R1")
+        self.assertEqual(self.registry.find_by_udp_port(10003), None)
+
+    def test_rename(self):
+
+        self.registry.set_image("R1", "Router")
+        self.registry.set_console("R1", 3001)
+        self.registry.add_udp("R1", 0, 10000)
+        self.assertFalse(self.registry.rename("R1", "R2"))
+        self.assertFalse(self.registry.rename("R3", "R4"))
+        self.assertTrue(self.registry.rename("R1", "R3"))
+        self.assertFalse("R1" in self.registry)
+        self.assertEqual(self.registry.find_by_image("Router"), ["R3"])
+        self.assertEqual(self.registry.find_by_console(3001), "R3")
+        self.assertEqual(self.registry.find_by_udp_port(10000), ("R3", 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from vboxwrapper import jobs
+from vboxwrapper.jobs import Job, JobManager
+
+
+class JobTest(unittest.TestCase):
+
+    def test_run(self):
+
+        job = Job("1", "start R1", lambda: (True, "VBox 'R1' started"))
+        self.assertEqual(job.state, jobs.QUEUED)
+        self.assertFalse(job.finished)
+        job.run()
+        self.assertEqual(job.state, jobs.DONE)
+        self.assertEqual(job.message, "VBox 'R1' started")
+        self.assertTrue(job.finished)
+        self.assertTrue(job.status().startswith("1 done "))
+        self.assertTrue(job.status().endswith(" VBox 'R1' started"))
+
+    def test_failure(self):
+
+        job = Job("1", "start R1", lambda: (False, "unable to start"))
+        job.run()
+        self.assertEqual((job.state, job.message), (jobs.FAILED, "unable to start"))
+
+    def test_exception(self):
+
+        def fail():
+            raise ValueError("no VirtualBox")
+
+        job = Job("1", "start R1", fail)
+        job.run()
+        self.assertEqual((job.state, job.message), (jobs.FAILED, "no VirtualBox"))
+
+    def test_cancel(self):
+
+        calls = []
+        job = Job("1", "start R1", lambda: calls.append("run") or (True, ""))
+        self.assertTrue(job.cancel())
+        self.assertEqual(job.state, jobs.CANCELLED)
+        self.assertTrue(job.finished)
+        # a cancelled job does not run and cannot be cancelled again
+        job.run()
+        self.assertEqual(calls, [])
+        self.assertFalse(job.cancel())
+
+    def test_cancel_started(self):
+
+        job = Job("1", "start R1", lambda: (True, ""))
+        job.run()
+        self.assertFalse(job.cancel())
+        self.assertEqual(job.state, jobs.DONE)
+
+    def test_notify(self):
+
+        notified = []
+        job = Job("1", "start R1", lambda: (True, ""), notified.append)
+        job.run()
+        self.assertEqual(notified, [job])
+        notified = []
+        job = Job("2", "stop R1", lambda: (True, ""), notified.append)
+        job.cancel()
+        self.assertEqual(notified, [job])
+
+    def test_notify_error(self):
+
+        def notify(job):
+            raise IOError("connection closed")
+
+        job = Job("1", "start R1", lambda: (True, ""), notify)
+        job.run()
+        self.assertTrue(job.finished)
+
+    def test_wait(self):
+
+        release = threading.Event()
+        job = Job("1", "start R1", lambda: (release.wait(5), ""))
+        thread = threading.Thread(target=job.run)
+        thread.start()
+        self.assertFalse(job.wait(0.05))
+        release.set()
+        self.assertTrue(job.wait(5))
+        thread.join()
+        self.assertEqual(job.state, jobs.DONE)
+
+
+class JobManagerTest(unittest.TestCase):
+
+    def test_create(self):
+
+        manager = JobManager()
+        first = manager.create("start R1", lambda: (True, ""))
+        second = manager.create("start R2", lambda: (True, ""))
+        self.assertEqual((first.id, second.id), ("1", "2"))
+        self.assertTrue(manager.get("2") is second)
+        self.assertEqual(manager.get("3"), None)
+        self.assertEqual(manager.jobs(), [first, second])
+
+    def test_history(self):
+
+        manager = JobManager(history=2)
+        running = manager.create("start R1", lambda: (True, ""))
+        finished = manager.create("start R2", lambda: (True, ""))
+        finished.run()
+        last = manager.create("start R3", lambda: (True, ""))
+        # only the finished jobs are forgotten
+        self.assertEqual(manager.jobs(), [running, last])
+        manager.create("start R4", lambda: (True, ""))
+        self.assertEqual(len(manager.jobs()), 3)
+        running.run()
+        manager.create("start R5", lambda: (True, ""))
+        self.assertEqual([job.id for job in manager.jobs()], ["3", "4", "5"])
+
+
+if __name__ == '__main__':
+    unittest.main()
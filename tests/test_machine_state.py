@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from vboxwrapper import machine_state
+from vboxwrapper.machine_state import MachineStateCache, FakeEventSource, MachineInfo
+
+POWERED_OFF = 1
+RUNNING = 5
+UNLOCKED = 1
+LOCKED = 2
+
+
+class MachineStateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.source = FakeEventSource([("id-1", "Router", POWERED_OFF, UNLOCKED)],
+                                      [MachineInfo("id-1", "Router", "Linux", 8, "PIIX3"),
+                                       MachineInfo("id-2", "Switch", "Linux", 8, "PIIX3")])
+        self.cache = MachineStateCache()
+        self.cache.attach(self.source)
+        self.reads = []
+
+    def read(self, name):
+
+        self.reads.append(name)
+        if name != "Switch":
+            raise ValueError("no machine named {}".format(name))
+        return "id-2", RUNNING, LOCKED
+
+    def test_snapshot(self):
+
+        self.assertTrue(self.cache.live)
+        entry = self.cache.find("Router")
+        self.assertEqual((entry.id, entry.state, entry.session_state), ("id-1", POWERED_OFF, UNLOCKED))
+        self.assertEqual(self.cache.state("id-1"), POWERED_OFF)
+        self.assertEqual(self.cache.find("Switch"), None)
+
+    def test_state_events(self):
+
+        self.source.emit(machine_state.MACHINE_STATE_CHANGED, "id-1", RUNNING)
+        self.source.emit(machine_state.SESSION_STATE_CHANGED, "id-1", LOCKED)
+        entry = self.cache.find("Router")
+        self.assertEqual((entry.state, entry.session_state), (RUNNING, LOCKED))
+        self.cache.invalidate("id-1")
+        self.assertEqual(self.cache.state("id-1"), None)
+        self.source.emit(machine_state.MACHINE_STATE_CHANGED, "id-1", POWERED_OFF)
+        self.assertEqual(self.cache.state("id-1"), POWERED_OFF)
+
+    def test_describe(self):
+
+        entry = self.cache.find("Router")
+        self.assertEqual(self.cache.describe(entry), (str(POWERED_OFF), str(UNLOCKED)))
+        self.cache.invalidate("id-1")
+        self.assertEqual(self.cache.describe(entry)[0], "unknown")
+
+    def test_registered_after_attach(self):
+
+        # the events of a new machine only carry its ID
+        self.source.emit(machine_state.MACHINE_REGISTERED, "id-2", True)
+        self.source.emit(machine_state.MACHINE_STATE_CHANGED, "id-2", RUNNING)
+        self.assertEqual(self.cache.find("Switch"), None)
+        self.assertEqual(self.cache.lookup("Switch"), None)
+        entry = self.cache.lookup("Switch", self.read)
+        self.assertEqual((entry.id, entry.state, entry.session_state), ("id-2", RUNNING, LOCKED))
+        # the name is known from now on
+        self.assertEqual(self.cache.lookup("Switch", self.read).state, RUNNING)
+        self.assertEqual(self.reads, ["Switch"])
+        self.source.emit(machine_state.MACHINE_STATE_CHANGED, "id-2", POWERED_OFF)
+        self.assertEqual(self.cache.find("Switch").state, POWERED_OFF)
+
+    def test_lookup(self):
+
+        self.assertEqual(self.cache.lookup("Router", self.read).state, POWERED_OFF)
+        self.assertEqual(self.reads, [])
+        self.assertEqual(self.cache.lookup("Missing", self.read), None)
+        # an entry without state is read again
+        self.cache.invalidate("id-1")
+        self.assertEqual(self.cache.lookup("Router", self.read).state, None)
+        self.assertEqual(self.reads, ["Missing", "Router"])
+
+    def test_unregistered(self):
+
+        self.source.emit(machine_state.MACHINE_REGISTERED, "id-1", False)
+        self.assertEqual(self.cache.find("Router"), None)
+        self.assertEqual(self.cache.state("id-1"), None)
+
+    def test_stopped(self):
+
+        self.source.stop()
+        self.assertFalse(self.cache.live)
+        self.assertEqual(self.cache.find("Router"), None)
+        self.assertEqual(self.cache.machines(), None)
+        # not live, the state read is not cached
+        self.assertEqual(self.cache.lookup("Switch", self.read).state, RUNNING)
+        self.assertEqual(self.cache.lookup("Switch", self.read).state, RUNNING)
+        self.assertEqual(self.reads, ["Switch", "Switch"])
+
+    def test_catalogue(self):
+
+        machines = self.cache.machines()
+        self.assertEqual([(info.name, entry.state) for info, entry in machines], [("Router", POWERED_OFF),
+                                                                                  ("Switch", None)])
+        self.assertEqual(self.cache.find("Switch").id, "id-2")
+        self.cache.machines()
+        self.assertEqual(self.source.describe_calls, 1)
+        # only the changed machines are read again
+        self.source.infos[0] = MachineInfo("id-1", "Router 2", "Linux", 8, "PIIX3")
+        self.source.emit(machine_state.MACHINE_DATA_CHANGED, "id-1", None)
+        machines = self.cache.machines()
+        self.assertEqual(self.source.describe_calls, 2)
+        self.assertEqual([info.name for info, entry in machines], ["Router 2", "Switch"])
+        self.assertEqual(self.cache.find("Router"), None)
+        self.assertEqual(self.cache.find("Router 2").id, "id-1")
+        self.source.emit(machine_state.MACHINE_REGISTERED, "id-2", False)
+        self.assertEqual([info.name for info, entry in self.cache.machines()], ["Router 2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
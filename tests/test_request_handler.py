@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from vboxwrapper import vboxwrapper
+from vboxwrapper.worker_pool import WorkerPool, KeyedExecutor
+
+
+class Output(object):
+
+    def __init__(self):
+
+        self.data = []
+
+    def write(self, data):
+
+        self.data.append(data)
+
+
+class Server(object):
+
+    def __init__(self):
+
+        self.executor = KeyedExecutor(WorkerPool(2))
+
+
+class RequestHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        handler = vboxwrapper.VBoxWrapperRequestHandler.__new__(vboxwrapper.VBoxWrapperRequestHandler)
+        handler.wfile = Output()
+        handler.server = Server()
+        handler._init_request_state()
+        self.handler = handler
+
+    def request(self, *lines):
+        """
+        Processes requests one after the other and returns the replies.
+        """
+
+        del self.handler.wfile.data[:]
+        for line in lines:
+            self.handler.process_request(line + "\r\n")
+            while not self.handler.server.executor.idle():
+                time.sleep(0.01)
+        return "".join(self.handler.wfile.data)
+
+    def test_errors(self):
+
+        self.assertEqual(self.request("vbox"), "200-At least a module and a command must be specified\r\n")
+        self.assertEqual(self.request("foo bar"), "201-Unknown module 'foo'\r\n")
+        self.assertEqual(self.request("vbox foo"), "202-Unknown command 'foo'\r\n")
+
+    def test_tagged(self):
+
+        version = vboxwrapper.__version__
+        self.assertEqual(self.request("@1 vboxwrapper version"), "@1 100-%s\r\n" % version)
+        # the tag only applies to its request
+        self.assertEqual(self.request("@2 vboxwrapper version", "vboxwrapper version"),
+                         "@2 100-%s\r\n100-%s\r\n" % (version, version))
+        self.assertEqual(self.request("@3 vbox"), "@3 200-At least a module and a command must be specified\r\n")
+
+    def test_batch(self):
+
+        version = vboxwrapper.__version__
+        replies = self.request("vboxwrapper batch begin",
+                               "vboxwrapper version",
+                               "@1 vboxwrapper version",
+                               "foo bar",
+                               "vboxwrapper batch end")
+        self.assertEqual(replies, "100-%s\r\n@1 100-%s\r\n201-Unknown module 'foo'\r\n"
+                                  "100-batch of 3 commands done\r\n" % (version, version))
+        self.assertEqual(self.request("vboxwrapper batch end"), "204-No batch in progress\r\n")
+
+    def test_status_all(self):
+
+        self.request("vbox create vbox STATUS1", "vbox create vbox STATUS2")
+        try:
+            replies = self.request("vbox status_all")
+            # sent with a single write
+            self.assertEqual(len(self.handler.wfile.data), 1)
+            lines = replies.splitlines()
+            self.assertTrue("101 STATUS1 unknown unknown" in lines)
+            self.assertTrue("101 STATUS2 unknown unknown" in lines)
+            self.assertEqual(lines[-1], "100-OK")
+        finally:
+            self.request("vbox delete STATUS1", "vbox delete STATUS2")
+
+
+if __name__ == '__main__':
+    unittest.main()
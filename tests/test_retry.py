@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from vboxwrapper import retry
+from vboxwrapper.retry import RetryPolicy, RetryError
+
+
+class ComError(Exception):
+
+    def __init__(self, hresult, message="COM error"):
+
+        Exception.__init__(self, message)
+        self.hresult = hresult
+
+
+class FixedRandom(object):
+
+    def __init__(self, value):
+
+        self.value = value
+
+    def random(self):
+
+        return self.value
+
+
+class Failing(object):
+    """
+    Fails a number of times before returning.
+    """
+
+    def __init__(self, failures, exception=None):
+
+        self.failures = failures
+        self.exception = exception or ComError(0x80BB000C)  # VBOX_E_OBJECT_IN_USE
+        self.calls = 0
+
+    def __call__(self):
+
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exception
+        return "done"
+
+
+def policy(random_value=0.0, name="test", **kwargs):
+
+    policy = RetryPolicy(name, **kwargs)
+    policy._random = FixedRandom(random_value)
+    policy.sleeps = []
+    policy._sleep = policy.sleeps.append
+    return policy
+
+
+class ClassificationTest(unittest.TestCase):
+
+    def test_error_code(self):
+
+        # signed on some platforms
+        self.assertEqual(retry.error_code(ComError(0x80BB000C - (1 << 32))), 0x80BB000C)
+        self.assertEqual(retry.error_code(ComError(0x80070057)), 0x80070057)
+        self.assertEqual(retry.error_code(Exception(0x80BB0001, "not found")), 0x80BB0001)
+        self.assertEqual(retry.error_code(ValueError("no code")), None)
+
+    def test_is_retryable(self):
+
+        self.assertTrue(retry.is_retryable(ComError(0x80BB000C)))
+        self.assertFalse(retry.is_retryable(ComError(0x80070057)))
+        self.assertTrue(retry.is_retryable(ValueError("the machine is already locked")))
+        self.assertTrue(retry.is_retryable(ValueError("unknown")))
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_success_after_retries(self):
+
+        retrying = policy(initial_delay=0.01, multiplier=2.0)
+        func = Failing(3)
+        self.assertEqual(retrying.run("start R1", func), "done")
+        self.assertEqual(func.calls, 4)
+        self.assertEqual(retrying.sleeps, [0.01, 0.02, 0.04])
+        values = dict(retrying.metrics.snapshot())
+        self.assertEqual((values["calls"], values["attempts"], values["retries"], values["failures"]), (1, 4, 3, 0))
+        self.assertEqual(values["wait_time"], "0.070")
+
+    def test_backoff_capped(self):
+
+        retrying = policy(initial_delay=0.1, max_delay=0.3, attempts=10)
+        retrying.run("start R1", Failing(5))
+        self.assertEqual(retrying.sleeps, [0.1, 0.2, 0.3, 0.3, 0.3])
+
+    def test_jitter(self):
+
+        delays = policy(0.5, initial_delay=0.1, jitter=0.5).delays()
+        self.assertEqual([round(next(delays), 6) for _ in range(3)], [0.075, 0.15, 0.3])
+        delays = policy(1.0, initial_delay=0.1, jitter=0.5).delays()
+        self.assertEqual(round(next(delays), 6), 0.05)
+
+    def test_attempts(self):
+
+        retrying = policy(attempts=3)
+        func = Failing(5)
+        with self.assertRaises(RetryError) as context:
+            retrying.run("start R1", func)
+        self.assertEqual((context.exception.attempts, context.exception.reason), (3, "attempts"))
+        self.assertEqual(func.calls, 3)
+        self.assertEqual(dict(retrying.metrics.snapshot())["failures"], 1)
+
+    def test_not_retryable(self):
+
+        retrying = policy()
+        func = Failing(5, ComError(0x80070057))
+        with self.assertRaises(RetryError) as context:
+            retrying.run("start R1", func)
+        self.assertEqual((context.exception.attempts, context.exception.reason), (1, "not retryable"))
+        self.assertEqual(retrying.sleeps, [])
+        self.assertEqual(dict(retrying.metrics.snapshot())["not_retryable"], 1)
+
+    def test_policy_deadline(self):
+
+        retrying = policy(initial_delay=0.5, deadline=0.1)
+        with self.assertRaises(RetryError) as context:
+            retrying.run("start R1", Failing(5))
+        self.assertEqual((context.exception.attempts, context.exception.reason), (1, "deadline"))
+
+    def test_command_deadline(self):
+
+        retrying = policy(initial_delay=0.5)
+        with retry.deadline(0.1):
+            with self.assertRaises(RetryError) as context:
+                retrying.run("start R1", Failing(5))
+        self.assertEqual(context.exception.reason, "deadline")
+        self.assertEqual(dict(retrying.metrics.snapshot())["deadline_exceeded"], 1)
+        # the deadline is gone once the command is done
+        self.assertEqual(retrying.run("start R1", Failing(1)), "done")
+
+    def test_nested_deadline(self):
+
+        retrying = policy(initial_delay=0.5)
+        with retry.deadline(0.1):
+            # cannot extend the deadline of the command
+            with retry.deadline(60):
+                self.assertRaises(RetryError, retrying.run, "start R1", Failing(5))
+
+    def test_deadline_per_thread(self):
+
+        retrying = policy(initial_delay=0.5)
+        results = []
+        with retry.deadline(0.1):
+            thread = threading.Thread(target=lambda: results.append(retrying.run("start R2", Failing(1))))
+            thread.start()
+            thread.join()
+        self.assertEqual(results, ["done"])
+        self.assertEqual(retrying.sleeps, [0.5])
+
+    def test_metrics(self):
+
+        retrying = policy(name="metrics")
+        retrying.run("start R1", Failing(0))
+        metrics = retry.metrics()
+        self.assertTrue(("retry.metrics.calls", 1) in metrics)
+        self.assertTrue(("retry.metrics.wait_time", "0.000") in metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from vboxwrapper.scrollback import Scrollback, printable
+
+
+class ScrollbackTest(unittest.TestCase):
+
+    def test_tail(self):
+
+        scrollback = Scrollback(16)
+        self.assertEqual(scrollback.tail(), "")
+        scrollback.append("hello ")
+        scrollback.append("world")
+        self.assertEqual(scrollback.tail(), "hello world")
+        self.assertEqual(scrollback.tail(5), "world")
+        self.assertEqual(scrollback.tail(0), "")
+        self.assertEqual(scrollback.written, 11)
+
+    def test_wrap(self):
+
+        scrollback = Scrollback(8)
+        scrollback.append("abcdef")
+        scrollback.append("ghij")
+        # the ring buffer wraps around in the middle of the output
+        self.assertEqual(scrollback.tail(), "cdefghij")
+        self.assertEqual(scrollback.tail(6), "efghij")
+        scrollback.append("0123456789")
+        # only the end of output longer than the buffer is kept
+        self.assertEqual(scrollback.tail(), "23456789")
+        self.assertEqual(scrollback.written, 20)
+
+    def test_no_scrollback(self):
+
+        scrollback = Scrollback(0)
+        scrollback.append("output")
+        self.assertEqual(scrollback.tail(), "")
+        self.assertEqual(scrollback.written, 6)
+
+    def test_wait_current_line(self):
+
+        scrollback = Scrollback(64)
+        scrollback.append("boot\r\nlogin: ")
+        self.assertEqual(scrollback.wait("login:", 0), "login: ")
+        # the finished lines are not searched again
+        self.assertEqual(scrollback.wait("boot", 0), None)
+
+    def test_wait_output(self):
+
+        scrollback = Scrollback(64)
+        scrollback.append("R1")
+
+        def output():
+            time.sleep(0.1)
+            scrollback.append(">enable\r\nR1#")
+
+        thread = threading.Thread(target=output)
+        thread.start()
+        # the line started before the wait is searched from its start
+        self.assertEqual(scrollback.wait("^R1#$", 5), "R1#")
+        thread.join()
+
+    def test_wait_timeout(self):
+
+        scrollback = Scrollback(64)
+        self.assertEqual(scrollback.wait("never", 0.05), None)
+        scrollback.append("never\n")
+        self.assertEqual(scrollback.wait("never", 0), None)
+
+    def test_wait_since(self):
+
+        scrollback = Scrollback(64)
+        scrollback.append("R1#show clock\r\n12:00\r\nR1#")
+        since = scrollback.written
+        scrollback.append("show version\r\nVersion 15\r\nR1#")
+        # the output before since is skipped, even on the same line
+        self.assertEqual(scrollback.wait("R1#", 0, since), "R1#")
+        self.assertEqual(scrollback.wait("clock", 0, since), None)
+        self.assertEqual(scrollback.wait("Version", 0, since), "Version 15\r")
+        self.assertEqual(scrollback.wait("12:00", 0, since - 10), "12:00\r")
+
+    def test_wait_since_wrapped(self):
+
+        scrollback = Scrollback(16)
+        scrollback.append("first prompt> ")
+        since = scrollback.written
+        scrollback.append("x" * 40 + "\nsecond prompt> ")
+        # the output written since may no longer all be kept
+        self.assertEqual(scrollback.wait("prompt>", 0, since), "second prompt> ")
+
+    def test_wait_since_future_output(self):
+
+        scrollback = Scrollback(64)
+        scrollback.append("R1#")
+        since = scrollback.written
+
+        def output():
+            time.sleep(0.1)
+            scrollback.append("sh ver\r\nR1#")
+
+        thread = threading.Thread(target=output)
+        thread.start()
+        self.assertEqual(scrollback.wait("R1#", 5, since), "R1#")
+        thread.join()
+
+    def test_printable(self):
+
+        self.assertEqual(printable("\x1b[0mR1#\r"), "[0mR1#")
+        self.assertEqual(printable("a\tb\x7f"), "a\tb")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from vboxwrapper.session_pool import SessionPool
+
+
+class Session(object):
+
+    def __init__(self, number):
+
+        self.number = number
+        self.healthy = True
+
+
+class Factory(object):
+
+    def __init__(self):
+
+        self.created = 0
+        self.fail = False
+
+    def __call__(self):
+
+        if self.fail:
+            raise IOError("VirtualBox is busy")
+        self.created += 1
+        return Session(self.created)
+
+
+def validate(session):
+
+    if session.healthy is None:
+        raise IOError("the session object is gone")
+    return session.healthy
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.factory = Factory()
+        self.pool = SessionPool(self.factory, validate, size=2, prefill=False)
+
+    def tearDown(self):
+
+        self.pool.close()
+
+    def metrics(self):
+
+        return dict((name.split(".", 1)[1], value) for name, value in self.pool.metrics())
+
+    def test_checkout_and_return(self):
+
+        first = self.pool.acquire()
+        self.assertEqual(first.number, 1)
+        self.pool.release(first)
+        # the released session is handed out again
+        self.assertTrue(self.pool.acquire() is first)
+        metrics = self.metrics()
+        self.assertEqual((metrics["misses"], metrics["hits"], metrics["created"], metrics["recycled"]), (1, 1, 1, 1))
+
+    def test_full(self):
+
+        sessions = [self.pool.acquire() for _ in range(3)]
+        for session in sessions:
+            self.pool.release(session)
+        metrics = self.metrics()
+        self.assertEqual((metrics["idle"], metrics["recycled"], metrics["discarded"]), (2, 2, 1))
+
+    def test_unhealthy_evicted(self):
+
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.pool.release(first)
+        self.pool.release(second)
+        # the idle sessions are checked when handed out
+        first.healthy = False
+        self.assertTrue(self.pool.acquire() is second)
+        self.assertEqual(self.metrics()["discarded"], 1)
+        # and when given back
+        second.healthy = None
+        self.pool.release(second)
+        self.assertEqual(self.metrics()["idle"], 0)
+        self.assertEqual(self.pool.acquire().number, 3)
+
+    def test_factory_error(self):
+
+        self.factory.fail = True
+        self.assertRaises(IOError, self.pool.acquire)
+        self.assertEqual(self.metrics()["errors"], 1)
+
+    def test_closed(self):
+
+        session = self.pool.acquire()
+        self.pool.close()
+        self.pool.release(session)
+        self.assertEqual(self.metrics()["idle"], 0)
+        self.pool.release(None)
+
+    def test_prefill(self):
+
+        pool = SessionPool(self.factory, validate, size=2)
+        pool.start()
+        try:
+            for _ in range(500):
+                if self.factory.created == 2:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.factory.created, 2)
+            pool.acquire()
+            # refilled in the background
+            for _ in range(500):
+                if self.factory.created == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.factory.created, 3)
+            self.assertEqual(dict(pool.metrics())["session_pool.hits"], 1)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
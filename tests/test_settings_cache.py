@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from vboxwrapper.settings_cache import SettingsCache, file_signature
+
+
+class SettingsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.settings = os.path.join(self.directory, "Router.vbox")
+        self.write_settings("<VirtualBox/>")
+        self.path = os.path.join(self.directory, "cache", "settings.json")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def write_settings(self, content, mtime=1000000000):
+
+        with open(self.settings, "w") as f:
+            f.write(content)
+        os.utime(self.settings, (mtime, mtime))
+
+    def test_file_signature(self):
+
+        self.assertEqual(file_signature(self.settings), [1000000000, 13])
+        self.assertEqual(file_signature(os.path.join(self.directory, "missing.vbox")), None)
+        self.assertEqual(file_signature(None), None)
+
+    def test_load(self):
+
+        cache = SettingsCache()
+        signature = file_signature(self.settings)
+        self.assertEqual(cache.load("id-1", signature), {})
+        cache.store("id-1", signature, {"nic1": "null"})
+        self.assertEqual(cache.load("id-1", signature), {"nic1": "null"})
+        self.assertEqual(cache.load("id-1", None), {})
+        # the caller gets a copy
+        cache.load("id-1", signature)["nic1"] = "udp"
+        self.assertEqual(cache.load("id-1", signature), {"nic1": "null"})
+
+    def test_invalidated_by_signature(self):
+
+        cache = SettingsCache()
+        cache.store("id-1", file_signature(self.settings), {"nic1": "null"})
+        # changed by someone else, same size
+        self.write_settings("<virtualbox/>", mtime=1000000001)
+        self.assertEqual(cache.load("id-1", file_signature(self.settings)), {})
+        cache.store("id-1", file_signature(self.settings), {"nic1": "udp"})
+        # same modification time, different size
+        self.write_settings("<VirtualBox />", mtime=1000000001)
+        self.assertEqual(cache.load("id-1", file_signature(self.settings)), {})
+
+    def test_forget(self):
+
+        cache = SettingsCache()
+        signature = file_signature(self.settings)
+        cache.store("id-1", signature, {"nic1": "null"})
+        cache.forget("id-1")
+        self.assertEqual(cache.load("id-1", signature), {})
+        cache.store("id-1", signature, {"nic1": "null"})
+        # the settings file could not be read after saving
+        cache.store("id-1", None, {"nic1": "udp"})
+        self.assertEqual(cache.load("id-1", signature), {})
+
+    def test_persistent(self):
+
+        signature = file_signature(self.settings)
+        SettingsCache(self.path).store("id-1", signature, {"nic1": "null"})
+        self.assertEqual(SettingsCache(self.path).load("id-1", signature), {"nic1": "null"})
+        SettingsCache(self.path).forget("id-1")
+        self.assertEqual(SettingsCache(self.path).load("id-1", signature), {})
+
+    def test_corrupted(self):
+
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as f:
+            f.write("{")
+        cache = SettingsCache(self.path)
+        self.assertEqual(cache.load("id-1", file_signature(self.settings)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
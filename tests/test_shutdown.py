@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from vboxwrapper import shutdown
+
+
+class Controller(object):
+
+    def __init__(self, running=True, delays=None, errors=None):
+
+        self.running = running
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.calls = []
+
+    def _call(self, step):
+
+        self.calls.append(step)
+        time.sleep(self.delays.get(step, 0))
+        if step in self.errors:
+            raise self.errors[step]
+
+    def stop_console(self):
+
+        self._call(shutdown.CONSOLE)
+
+    def power_down(self):
+
+        self._call(shutdown.POWER_DOWN)
+        return self.running
+
+    def wait_powered_down(self, timeout=3.0):
+
+        self._call(shutdown.WAIT)
+
+    def reset_adapters(self):
+
+        self._call(shutdown.RESET_ADAPTERS)
+
+
+class ResetCounter(Controller):
+
+    def __init__(self, counter):
+
+        Controller.__init__(self)
+        self.counter = counter
+
+    def reset_adapters(self):
+
+        self.counter.enter()
+        try:
+            time.sleep(0.05)
+        finally:
+            self.counter.leave()
+
+
+class Counter(object):
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.current = 0
+        self.highest = 0
+
+    def enter(self):
+
+        with self.lock:
+            self.current += 1
+            self.highest = max(self.highest, self.current)
+
+    def leave(self):
+
+        with self.lock:
+            self.current -= 1
+
+
+class ShutdownTest(unittest.TestCase):
+
+    def test_clean_shutdown(self):
+
+        controllers = {"VM1": Controller(), "VM2": Controller()}
+        self.assertEqual(shutdown.shutdown(controllers, timeout=5), ({}, {}))
+        for controller in controllers.values():
+            self.assertEqual(controller.calls, [shutdown.CONSOLE, shutdown.POWER_DOWN, shutdown.WAIT, shutdown.RESET_ADAPTERS])
+
+    def test_stopped_vm_is_not_reset(self):
+
+        controller = Controller(running=False)
+        self.assertEqual(shutdown.shutdown({"VM1": controller}, timeout=5), ({}, {}))
+        self.assertEqual(controller.calls, [shutdown.CONSOLE, shutdown.POWER_DOWN])
+
+    def test_vms_are_stopped_in_parallel(self):
+
+        delays = {shutdown.POWER_DOWN: 0.2, shutdown.WAIT: 0.2}
+        controllers = dict(("VM%d" % number, Controller(delays=delays)) for number in range(10))
+        start = time.time()
+        self.assertEqual(shutdown.shutdown(controllers, timeout=5), ({}, {}))
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_late_vms_are_returned(self):
+
+        controllers = {"VM1": Controller(),
+                       "VM2": Controller(delays={shutdown.WAIT: 1.0}),
+                       "VM3": Controller(delays={shutdown.RESET_ADAPTERS: 1.0})}
+        start = time.time()
+        late, failed = shutdown.shutdown(controllers, timeout=0.3)
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(late, {"VM2": shutdown.WAIT, "VM3": shutdown.RESET_ADAPTERS})
+        self.assertEqual(failed, {})
+
+    def test_late_step_stops_the_shutdown(self):
+
+        controllers = {"VM1": Controller(),
+                       "VM2": Controller(delays={shutdown.POWER_DOWN: 1.0})}
+        late, failed = shutdown.shutdown(controllers, timeout=0.3)
+        self.assertEqual(late["VM2"], shutdown.POWER_DOWN)
+        self.assertEqual(failed, {})
+        # a late VM is not taken any further
+        time.sleep(1.0)
+        self.assertEqual(controllers["VM2"].calls, [shutdown.CONSOLE, shutdown.POWER_DOWN])
+
+    def test_failed_vms_are_returned(self):
+
+        controllers = {"VM1": Controller(),
+                       "VM2": Controller(errors={shutdown.CONSOLE: IOError("console is gone")}),
+                       "VM3": Controller(errors={shutdown.POWER_DOWN: IOError("session is locked")}),
+                       "VM4": Controller(errors={shutdown.RESET_ADAPTERS: IOError("settings are locked")})}
+        late, failed = shutdown.shutdown(controllers, timeout=5)
+        self.assertEqual(late, {})
+        self.assertEqual(failed, {"VM2": shutdown.CONSOLE,
+                                  "VM3": shutdown.POWER_DOWN,
+                                  "VM4": shutdown.RESET_ADAPTERS})
+        self.assertEqual(controllers["VM2"].calls, [shutdown.CONSOLE])
+        self.assertEqual(controllers["VM3"].calls, [shutdown.CONSOLE, shutdown.POWER_DOWN])
+
+    def test_adapters_are_reset_in_batches(self):
+
+        counter = Counter()
+        controllers = dict(("VM%d" % number, ResetCounter(counter)) for number in range(12))
+        self.assertEqual(shutdown.shutdown(controllers, timeout=5, batch_size=3), ({}, {}))
+        self.assertEqual(counter.highest, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
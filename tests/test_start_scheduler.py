@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from vboxwrapper import start_scheduler
+from vboxwrapper.start_scheduler import StartScheduler
+
+
+class Probe(object):
+
+    def __init__(self, free_memory=None, load=None):
+
+        self.free_memory = free_memory
+        self.load = load
+
+    def sample(self):
+
+        return self.free_memory, self.load
+
+
+class Start(object):
+    """
+    Start running in its own thread until it is released.
+    """
+
+    def __init__(self, scheduler, name, log, success=True):
+
+        self.name = name
+        self.success = success
+        self._log = log
+        self._release = threading.Event()
+        self.thread = threading.Thread(target=scheduler.run, args=(name, self._run))
+        self.thread.start()
+
+    def _run(self):
+
+        self._log.append(self.name)
+        self._release.wait(5)
+        return self.success
+
+    def finish(self):
+
+        self._release.set()
+        self.thread.join()
+
+
+def wait_for(condition):
+
+    for _ in range(500):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class StartSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.probe = Probe()
+        self.scheduler = StartScheduler(max_concurrency=2, memory_reserve=256, probe=self.probe)
+        self.started = []
+
+    def metrics(self):
+
+        return dict((name.split(".", 1)[1], value) for name, value in self.scheduler.metrics())
+
+    def start(self, *names):
+
+        starts = []
+        for name in names:
+            starts.append(Start(self.scheduler, name, self.started))
+            # queued in this order
+            self.assertTrue(wait_for(lambda: name in [entry[0] for entry in self.scheduler.queue()]))
+        return starts
+
+    def test_concurrency_cap(self):
+
+        starts = self.start("R1", "R2", "R3", "R4")
+        self.assertTrue(wait_for(lambda: len(self.started) == 2))
+        time.sleep(0.05)
+        self.assertEqual(self.started, ["R1", "R2"])
+        self.assertEqual(self.metrics()["queued"], 2)
+        starts[1].finish()
+        # admitted in arrival order
+        self.assertTrue(wait_for(lambda: len(self.started) == 3))
+        self.assertEqual(self.started[2], "R3")
+        for start in starts:
+            start.finish()
+        self.assertEqual(self.started, ["R1", "R2", "R3", "R4"])
+        self.assertEqual(self.metrics()["starts"], 4)
+
+    def test_memory_reserve(self):
+
+        # room for a single start
+        self.probe.free_memory = 300
+        starts = self.start("R1", "R2")
+        self.assertTrue(wait_for(lambda: self.metrics()["throttled"] == 1))
+        self.assertEqual(self.started, ["R1"])
+        self.probe.free_memory = 600
+        # the host is sampled again while waiting
+        self.assertTrue(wait_for(lambda: len(self.started) == 2))
+        for start in starts:
+            start.finish()
+
+    def test_no_memory(self):
+
+        # one start at a time is always possible
+        self.probe.free_memory = 100
+        starts = self.start("R1", "R2")
+        self.assertTrue(wait_for(lambda: self.started == ["R1"]))
+        starts[0].finish()
+        self.assertTrue(wait_for(lambda: len(self.started) == 2))
+        starts[1].finish()
+
+    def test_load(self):
+
+        self.probe.load = 3.0
+        starts = self.start("R1", "R2")
+        self.assertTrue(wait_for(lambda: self.metrics()["throttled"] == 1))
+        self.assertEqual(self.started, ["R1"])
+        for start in starts:
+            start.finish()
+
+    def test_adaptive_limit(self):
+
+        scheduler = StartScheduler(max_concurrency=4, memory_reserve=0, probe=self.probe)
+        self.assertFalse(scheduler.run("R1", lambda: False))
+        self.assertEqual(dict(scheduler.metrics())["start_scheduler.limit"], 2)
+        scheduler.run("R1", lambda: False)
+        scheduler.run("R1", lambda: False)
+        self.assertEqual(dict(scheduler.metrics())["start_scheduler.limit"], 1)
+        self.assertTrue(scheduler.run("R1", lambda: True))
+        self.assertEqual(dict(scheduler.metrics())["start_scheduler.limit"], 2)
+        scheduler.configure(max_concurrency=1)
+        self.assertEqual(dict(scheduler.metrics())["start_scheduler.limit"], 1)
+        self.assertEqual(dict(scheduler.metrics())["start_scheduler.failures"], 3)
+
+    def test_exception(self):
+
+        def fail():
+            raise ValueError("no VirtualBox")
+
+        self.assertRaises(ValueError, self.scheduler.run, "R1", fail)
+        self.assertEqual((self.metrics()["failures"], self.metrics()["running"]), (1, 0))
+
+    def test_queue(self):
+
+        starts = self.start("R1", "R2", "R3")
+        self.assertTrue(wait_for(lambda: len(self.started) == 2))
+        entries = self.scheduler.queue()
+        self.assertEqual([entry[:3] for entry in entries], [("R1", start_scheduler.RUNNING, 0),
+                                                            ("R2", start_scheduler.RUNNING, 0),
+                                                            ("R3", start_scheduler.QUEUED, 1)])
+        # R3 starts once a running start is done and runs for a whole start
+        duration = StartScheduler.default_duration
+        self.assertTrue(duration < entries[2][3] <= 2 * duration)
+        self.assertEqual(self.scheduler.status("R3")[:3], entries[2][:3])
+        self.assertEqual(self.scheduler.status("R4"), None)
+        for start in starts:
+            start.finish()
+        self.assertEqual(self.scheduler.queue(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import random
+import socket
+import unittest
+
+from vboxwrapper.tcp_pipe_proxy import RawClient, TelnetClient, OutputBufferFull, escape, scrollback_replay, \
+    DROP_OLDEST, DISCONNECT, IAC, DO, DONT, WILL, WONT, SB, SE, NOP, ECHO, \
+    TERMTYPE, TERMTYPE_IS, TERMTYPE_SEND, M_NORMAL, M_IAC_SEEN, M_NEGOTIATE
+
+
+class Socket(object):
+    """
+    Records what is sent to a client, which only accepts
+    a number of bytes when it has a capacity.
+    """
+
+    def __init__(self, capacity=None):
+
+        self.sent = []
+        self.capacity = capacity
+
+    def fileno(self):
+
+        return 99
+
+    def send(self, data):
+
+        size = len(data)
+        if self.capacity is not None:
+            if self.capacity == 0:
+                raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+            size = min(size, self.capacity)
+            self.capacity -= size
+        self.sent.append(str(data[:size]))
+        return size
+
+    def received(self):
+
+        data = "".join(self.sent)
+        del self.sent[:]
+        return data
+
+
+def client():
+
+    sock = Socket()
+    telnet = TelnetClient(sock, ("127.0.0.1", 50000))
+    # the options requested on connection
+    sock.received()
+    return telnet, sock
+
+
+class ByteTelnetClient(TelnetClient):
+    """
+    Filters the Telnet commands one byte at a time, as the bulk filter
+    must do.
+    """
+
+    def filter(self, data):
+
+        output = []
+        for byte in data:
+            if self.mode == M_NORMAL:
+                if byte == IAC:
+                    self.mode = M_IAC_SEEN
+                else:
+                    self._data(byte, output)
+            elif self.mode == M_IAC_SEEN:
+                if byte == IAC:
+                    self._data(byte, output)
+                    self.mode = M_NORMAL
+                elif byte == SB:
+                    self.suboption = bytearray()
+                    self.mode = M_NORMAL
+                elif byte == SE:
+                    if self.suboption is not None:
+                        self._telnetProcessSubnegotiation(bytes(self.suboption))
+                    self.suboption = None
+                    self.mode = M_NORMAL
+                elif byte in (DO, DONT, WILL, WONT):
+                    self.telnet_command = byte
+                    self.mode = M_NEGOTIATE
+                else:
+                    self.mode = M_NORMAL
+            elif self.mode == M_NEGOTIATE:
+                self._telnetNegotiateOption(self.telnet_command, byte)
+                self.mode = M_NORMAL
+        return "".join(output)
+
+
+def random_stream(generator, size):
+    """
+    Returns Telnet client input mixing data, doubled IACs,
+    negotiations, sub options and other commands.
+    """
+
+    parts = []
+    while size > 0:
+        kind = generator.randrange(6)
+        if kind == 0:
+            part = IAC + IAC
+        elif kind == 1:
+            part = IAC + generator.choice((DO, DONT, WILL, WONT)) + chr(generator.randrange(40))
+        elif kind == 2:
+            part = IAC + SB + TERMTYPE + TERMTYPE_IS + "vt%d" % generator.randrange(300) + IAC + IAC + IAC + SE
+        elif kind == 3:
+            part = IAC + NOP
+        else:
+            part = "".join(chr(generator.randrange(255)) for _ in range(generator.randrange(1, 200)))
+        parts.append(part)
+        size -= len(part)
+    return "".join(parts)
+
+
+class EscapeTest(unittest.TestCase):
+
+    def test_escape(self):
+
+        self.assertEqual(escape("login: "), "login: ")
+        self.assertEqual(escape(IAC), IAC + IAC)
+        self.assertEqual(escape("a" + IAC + IAC + "b" + IAC), "a" + IAC * 4 + "b" + IAC * 2)
+        self.assertEqual(escape(""), "")
+
+
+def raw_client(capacity, size, policy):
+
+    return RawClient(Socket(capacity), ("127.0.0.1", 50000), size, policy)
+
+
+class OutputBufferTest(unittest.TestCase):
+
+    def test_sent_when_writable(self):
+
+        client = raw_client(0, 16, DROP_OLDEST)
+        self.assertEqual(client.write("abcd"), 0)
+        self.assertEqual(client.write("efgh"), 0)
+        self.assertEqual(client.pending(), 8)
+        self.assertFalse(client.flush())
+        client.sock.capacity = None
+        self.assertTrue(client.flush())
+        self.assertEqual(client.pending(), 0)
+        self.assertEqual(client.sock.received(), "abcdefgh")
+
+    def test_drop_oldest(self):
+
+        client = raw_client(0, 10, DROP_OLDEST)
+        client.write("aaaa")
+        client.write("bbbb")
+        self.assertEqual(client.write("cccc"), 4)
+        self.assertEqual(client.write("dd"), 0)
+        self.assertEqual(client.write("eeeeeeee"), 8)
+        self.assertEqual(client.dropped, 12)
+        self.assertTrue(client.active)
+        client.sock.capacity = None
+        client.flush()
+        self.assertEqual(client.sock.received(), "ddeeeeeeee")
+
+    def test_drop_oldest_keeps_the_chunk_being_sent(self):
+
+        client = raw_client(2, 8, DROP_OLDEST)
+        client.write("aaaa")
+        self.assertEqual(client.sock.received(), "aa")
+        client.write("bbbb")
+        self.assertEqual(client.write("cccc"), 4)
+        client.sock.capacity = None
+        client.flush()
+        # the rest of a chunk is never dropped, it may end an escape sequence
+        self.assertEqual(client.sock.received(), "aacccc")
+
+    def test_disconnect(self):
+
+        client = raw_client(0, 10, DISCONNECT)
+        client.write("aaaa")
+        client.write("bbbbbb")
+        self.assertRaises(OutputBufferFull, client.write, "c")
+        self.assertFalse(client.active)
+        self.assertEqual(client.dropped, 0)
+
+
+class ScrollbackReplayTest(unittest.TestCase):
+
+    def test_replay_fits(self):
+
+        client = raw_client(None, 64, DISCONNECT)
+        self.assertEqual(scrollback_replay(client, "boot\r\n"), "boot\r\n")
+
+    def test_replay_cut_to_the_output_buffer(self):
+
+        client = raw_client(0, 64, DISCONNECT)
+        client.write("x" * 14)
+        self.assertEqual(scrollback_replay(client, "a" * 100), "a" * 50)
+        client.write(scrollback_replay(client, "a" * 100))
+        self.assertEqual(client.pending(), 64)
+        self.assertEqual(scrollback_replay(client, "a" * 100), "")
+
+    def test_telnet_replay_cut_to_the_output_buffer(self):
+
+        generator = random.Random(18)
+        tail = "".join(chr(generator.randrange(256)) for _ in range(100000))
+        for size in (64, 65, 1000, 65536):
+            sock = Socket()
+            client = TelnetClient(sock, ("127.0.0.1", 50000), size, DISCONNECT)
+            sock.capacity = 0
+            replay = scrollback_replay(client, tail)
+            self.assertTrue(len(replay) <= size - client.pending())
+            self.assertTrue(len(replay) >= (size - client.pending()) // 2)
+            # the replay is the escaped end of the tail, without a split doubled IAC
+            reader = TelnetClient(Socket(), ("127.0.0.1", 50000))
+            self.assertTrue(tail.endswith(reader.filter(replay)))
+            self.assertEqual(reader.mode, M_NORMAL)
+            client.write(replay)
+
+
+class FilterTest(unittest.TestCase):
+
+    def test_plain_data(self):
+
+        telnet, sock = client()
+        self.assertEqual(telnet.filter("show version\r\n"), "show version\r\n")
+        self.assertEqual(sock.received(), "")
+
+    def test_doubled_iac(self):
+
+        telnet, sock = client()
+        self.assertEqual(telnet.filter("a" + IAC + IAC + "b"), "a" + IAC + "b")
+        # split across two reads
+        self.assertEqual(telnet.filter("c" + IAC), "c")
+        self.assertEqual(telnet.filter(IAC + "d"), IAC + "d")
+
+    def test_negotiation(self):
+
+        telnet, sock = client()
+        # the unknown options asked for are refused
+        self.assertEqual(telnet.filter("a" + IAC + DO + chr(5) + "b"), "ab")
+        self.assertEqual(sock.received(), IAC + WONT + chr(5))
+        # split after the IAC and after the command
+        self.assertEqual(telnet.filter("c" + IAC), "c")
+        self.assertEqual(telnet.filter(WILL), "")
+        self.assertEqual(telnet.filter(chr(5) + "d"), "d")
+        self.assertEqual(sock.received(), IAC + DONT + chr(5))
+        # a requested option is only acknowledged
+        self.assertEqual(telnet.filter(IAC + DO + ECHO), "")
+        self.assertEqual(sock.received(), "")
+
+    def test_other_commands_ignored(self):
+
+        telnet, sock = client()
+        self.assertEqual(telnet.filter("a" + IAC + NOP + "b"), "ab")
+
+    def test_terminal_type(self):
+
+        telnet, sock = client()
+        self.assertEqual(telnet.filter(IAC + WILL + TERMTYPE), "")
+        self.assertEqual(sock.received(), IAC + SB + TERMTYPE + TERMTYPE_SEND + IAC + SE)
+        self.assertEqual(telnet.filter(IAC + SB + TERMTYPE + TERMTYPE_IS + "VM1" + IAC + SE + "a"), "a")
+        self.assertEqual(telnet.terminal_type, "VM1")
+
+    def test_sub_option_split_across_reads(self):
+
+        data = "a" + IAC + SB + TERMTYPE + TERMTYPE_IS + "x" + IAC + IAC + "y" + IAC + SE + "b"
+        for position in range(1, len(data)):
+            telnet, sock = client()
+            output = telnet.filter(data[:position]) + telnet.filter(data[position:])
+            self.assertEqual(output, "ab")
+            self.assertEqual(telnet.terminal_type, "x" + IAC + "y")
+            self.assertEqual(telnet.mode, M_NORMAL)
+            self.assertEqual(telnet.suboption, None)
+
+    def test_same_as_byte_filter(self):
+
+        generator = random.Random(17)
+        for _ in range(100):
+            stream = random_stream(generator, 2000)
+            telnet, sock = client()
+            reference = ByteTelnetClient(Socket(), ("127.0.0.1", 50000))
+            reference.sock.received()
+            output = []
+            expected = []
+            position = 0
+            while position < len(stream):
+                size = generator.randrange(1, 64)
+                chunk = stream[position:position + size]
+                output.append(telnet.filter(chunk))
+                expected.append(reference.filter(chunk))
+                position += size
+            self.assertEqual("".join(output), "".join(expected))
+            self.assertEqual(sock.received(), reference.sock.received())
+            self.assertEqual(telnet.terminal_type, reference.terminal_type)
+            self.assertEqual(telnet.mode, reference.mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from vboxwrapper.tokenizer import tokenize, quote, _csv_tokenize
+
+
+class TokenizerTest(unittest.TestCase):
+
+    REQUESTS = [
+        '',
+        ' ',
+        'vbox create R1',
+        'vbox  create',
+        'vbox create R1 ',
+        '"vbox" create',
+        'vbox setattr R1 image "Router 1"',
+        'vbox setattr R1 image ""',
+        'vbox setattr R1 image """quoted"""',
+        'vbox setattr R1 image "a ""b"" c" next',
+        '"a" "b" "c"',
+        '"a"  "b"',
+        '"a" b "c" d',
+        'vbox "unterminated',
+        'vbox ab"cd',
+        'vbox "ab"cd',
+        'vbox "ab" cd"',
+        'vbox with\rcarriage return',
+        'vbox nul\0byte',
+        '-t 12 vbox console_send R1 "show version" "R1#"',
+    ]
+
+    def test_same_tokens_as_csv(self):
+
+        for request in self.REQUESTS:
+            try:
+                expected = _csv_tokenize(request)
+            except Exception as e:
+                self.assertRaises(type(e), tokenize, request)
+                continue
+            self.assertEqual(tokenize(request), expected, repr(request))
+
+    def test_quoted_token(self):
+
+        self.assertEqual(tokenize('vbox setattr R1 image "My Router"'),
+                         ['vbox', 'setattr', 'R1', 'image', 'My Router'])
+        self.assertEqual(tokenize('a "say ""hi"""'), ['a', 'say "hi"'])
+
+    def test_quote(self):
+
+        self.assertEqual(quote('R1'), 'R1')
+        self.assertEqual(quote(''), '""')
+        self.assertEqual(quote('My Router'), '"My Router"')
+        self.assertEqual(quote('say "hi"'), '"say ""hi"""')
+        for token in ('', 'R1', 'a b', '"', '" "', 'x""y'):
+            self.assertEqual(tokenize('vbox %s end' % quote(token)), ['vbox', token, 'end'])
+
+
+if __name__ == '__main__':
+    unittest.main()
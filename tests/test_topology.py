@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+
+from vboxwrapper import topology
+from vboxwrapper.topology import TopologyError
+
+
+class Link(object):
+
+    def __init__(self, lport, rhost, rport):
+
+        self.lport = lport
+        self.rhost = rhost
+        self.rport = rport
+
+
+class Instance(object):
+
+    def __init__(self, **attributes):
+
+        self.image = "Router"
+        self.console = 3001
+        self.nics = 2
+        self.netcard = "virtio"
+        self.headless_mode = False
+        self.enable_console = True
+        self.console_mode = "telnet"
+        self.nic_start_index = 1
+        self.capture = {}
+        self.udp = {}
+        for attribute, value in attributes.items():
+            setattr(self, attribute, value)
+
+
+def parse(vms):
+
+    return topology.parse(json.dumps({"vms": vms}))
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse(self):
+
+        vms = parse({"R1": {"image": "Router", "console": 3001, "headless_mode": True,
+                            "links": {"1": {"sport": 10000, "daddr": "127.0.0.1", "dport": 10001}},
+                            "captures": {"0": "/tmp/R1_0.pcap"}}})
+        self.assertEqual(vms, {"R1": {"attributes": {"image": "Router", "console": "3001", "headless_mode": True},
+                                      "links": {1: ("10000", "127.0.0.1", "10001")},
+                                      "captures": {0: "/tmp/R1_0.pcap"}}})
+
+    def test_names_are_not_normalized(self):
+
+        vms = parse({"True": {"headless_mode": "False", "captures": {"0": "False"},
+                              "links": {"0": {"sport": 10000, "daddr": "True", "dport": 10001}}},
+                     u"R\u00e9": {}})
+        self.assertEqual(sorted(vms), ["R\xc3\xa9", "True"])
+        self.assertEqual(vms["True"], {"attributes": {"headless_mode": False},
+                                       "links": {0: ("10000", "True", "10001")},
+                                       "captures": {0: "False"}})
+        instances = {"True": Instance(headless_mode=True), "R\xc3\xa9": Instance()}
+        self.assertEqual(topology.diff(vms, instances), [("setattr", "True", "headless_mode", False),
+                                                         ("create_capture", "True", 0, "False"),
+                                                         ("create_udp", "True", 0, "10000", "True", "10001")])
+
+    def test_invalid(self):
+
+        self.assertRaises(TopologyError, topology.parse, "{")
+        self.assertRaises(TopologyError, topology.parse, "[]")
+        self.assertRaises(TopologyError, parse, {"R1": []})
+        self.assertRaises(TopologyError, parse, {"R1": {"memory": 256}})
+        self.assertRaises(TopologyError, parse, {"R1": {"links": {"a": {}}}})
+        self.assertRaises(TopologyError, parse, {"R1": {"links": {"0": {"sport": 1}}}})
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_unchanged(self):
+
+        instance = Instance(udp={0: Link(10000, "127.0.0.1", 10001)})
+        vms = parse({"R1": {"image": "Router", "console": 3001,
+                            "links": {"0": {"sport": 10000, "daddr": "127.0.0.1", "dport": 10001}}}})
+        self.assertEqual(topology.diff(vms, {"R1": instance}), [])
+
+    def test_create(self):
+
+        vms = parse({"R1": {"image": "Router", "console": 3001,
+                            "links": {"0": {"sport": 10000, "daddr": "127.0.0.1", "dport": 10001}},
+                            "captures": {"0": "/tmp/R1_0.pcap"}}})
+        self.assertEqual(topology.diff(vms, {}), [("create", "R1"),
+                                                  ("setattr", "R1", "image", "Router"),
+                                                  ("setattr", "R1", "console", "3001"),
+                                                  ("create_capture", "R1", 0, "/tmp/R1_0.pcap"),
+                                                  ("create_udp", "R1", 0, "10000", "127.0.0.1", "10001")])
+
+    def test_attributes(self):
+
+        instances = {"R1": Instance(), "R2": Instance(console=3002)}
+        # the attributes not described are left unchanged
+        vms = parse({"R1": {"console": 3002, "headless_mode": "True"}, "R2": {"console": 3001}})
+        self.assertEqual(topology.diff(vms, instances), [("setattr", "R1", "console", "3002"),
+                                                         ("setattr", "R1", "headless_mode", True),
+                                                         ("setattr", "R2", "console", "3001")])
+
+    def test_captures(self):
+
+        instance = Instance(capture={0: "/tmp/old.pcap", 1: "/tmp/R1_1.pcap"})
+        vms = parse({"R1": {"captures": {"1": "/tmp/R1_1.pcap", "0": "/tmp/new.pcap"}}})
+        self.assertEqual(topology.diff(vms, {"R1": instance}), [("create_capture", "R1", 0, "/tmp/new.pcap")])
+        vms = parse({"R1": {}})
+        self.assertEqual(topology.diff(vms, {"R1": instance}), [("delete_capture", "R1", 0),
+                                                                ("delete_capture", "R1", 1)])
+
+    def test_links_deleted_first(self):
+
+        instances = {"R1": Instance(udp={0: Link(10000, "127.0.0.1", 10001)}),
+                     "R2": Instance(udp={0: Link(10001, "127.0.0.1", 10000)})}
+        # R2 takes over the port of R1, whose link is deleted before any link is created
+        vms = parse({"R1": {"links": {"0": {"sport": 10002, "daddr": "127.0.0.1", "dport": 10000}}},
+                     "R2": {"links": {"0": {"sport": 10000, "daddr": "127.0.0.1", "dport": 10002}},
+                            "console": 3005}})
+        self.assertEqual(topology.diff(vms, instances), [("setattr", "R2", "console", "3005"),
+                                                         ("delete_udp", "R1", 0),
+                                                         ("delete_udp", "R2", 0),
+                                                         ("create_udp", "R1", 0, "10002", "127.0.0.1", "10000"),
+                                                         ("create_udp", "R2", 0, "10000", "127.0.0.1", "10002")])
+
+    def test_links_removed(self):
+
+        instance = Instance(udp={0: Link(10000, "127.0.0.1", 10001), 1: Link(10002, "127.0.0.1", 10003)})
+        vms = parse({"R1": {"links": {"1": {"sport": 10002, "daddr": "127.0.0.1", "dport": 10003}}}})
+        self.assertEqual(topology.diff(vms, {"R1": instance}), [("delete_udp", "R1", 0)])
+
+    def test_resolve(self):
+
+        instance = Instance(udp={0: Link(10000, "127.0.0.1", 10001)})
+        vms = parse({"R1": {"links": {"0": {"sport": 10000, "daddr": "localhost", "dport": 10001}}}})
+        resolve = {"localhost": "127.0.0.1"}.get
+        self.assertEqual(topology.diff(vms, {"R1": instance}, resolve=resolve), [])
+        self.assertEqual(topology.diff(vms, {"R1": instance}), [("delete_udp", "R1", 0),
+                                                                ("create_udp", "R1", 0, "10000", "localhost", "10001")])
+
+    def test_prune(self):
+
+        instances = {"R1": Instance(), "R2": Instance(), "R3": Instance()}
+        vms = parse({"R2": {}, "R4": {}})
+        self.assertEqual(topology.diff(vms, instances), [("create", "R4")])
+        self.assertEqual(topology.diff(vms, instances, prune=True), [("delete", "R1"),
+                                                                     ("delete", "R3"),
+                                                                     ("create", "R4")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from vboxwrapper.transcript import Transcripts
+
+
+class TranscriptTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.transcripts = Transcripts(self.directory, segment_size=16, index_interval=1.0)
+
+    def tearDown(self):
+
+        self.transcripts.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, transcript, entries):
+        """
+        Writes output with given timestamps, the way the writer thread does.
+        """
+
+        with self.transcripts.io_lock:
+            for timestamp, data in entries:
+                transcript._write(timestamp, data)
+
+    def reopen(self):
+        """
+        Opens the transcript again, as after a restart.
+        """
+
+        self.transcripts.close()
+        self.transcripts = Transcripts(self.directory, segment_size=16, index_interval=1.0)
+        return self.transcripts.open("R1")
+
+    def sample(self):
+        """
+        Three segments starting at the offsets 0, 20 and 40:
+        a and b (not indexed) in the first one, c and d in the second
+        one and e in the last one.
+        """
+
+        transcript = self.transcripts.open("R1")
+        self.write(transcript, [(100.0, "a" * 10), (100.5, "b" * 10), (101.0, "c" * 10),
+                                (103.0, "d" * 10), (105.0, "e" * 10)])
+        return transcript
+
+    def test_empty(self):
+
+        transcript = self.transcripts.open("R1")
+        self.assertEqual(transcript.read(0), ("", 0, 0))
+
+    def test_segments(self):
+
+        self.sample()
+        names = sorted(os.listdir(os.path.join(self.directory, "R1")))
+        self.assertEqual(names, ["%016d%s" % (offset, suffix) for offset in (0, 20, 40) for suffix in (".idx", ".log")])
+
+    def test_read_all(self):
+
+        transcript = self.sample()
+        output = "a" * 10 + "b" * 10 + "c" * 10 + "d" * 10 + "e" * 10
+        self.assertEqual(transcript.read(0), (output, 0, 50))
+        self.assertEqual(transcript.read(100.0), (output, 0, 50))
+
+    def test_read_range(self):
+
+        transcript = self.sample()
+        self.assertEqual(transcript.read(101.5, 103.5), ("c" * 10 + "d" * 10, 20, 40))
+        self.assertEqual(transcript.read(103.0, 104.0), ("d" * 10, 30, 40))
+        self.assertEqual(transcript.read(106.0), ("e" * 10, 40, 50))
+
+    def test_read_across_segments(self):
+
+        transcript = self.sample()
+        # b is not indexed, the range starts with the indexed output before it
+        self.assertEqual(transcript.read(100.7, 101.5), ("a" * 10 + "b" * 10 + "c" * 10, 0, 30))
+        self.assertEqual(transcript.read(103.0, limit=15), ("d" * 10 + "e" * 5, 30, 45))
+        self.assertEqual(transcript._read(15, 45), "b" * 5 + "c" * 10 + "d" * 10 + "e" * 5)
+
+    def test_resume(self):
+
+        self.sample()
+        transcript = self.reopen()
+        self.assertEqual(transcript.read(101.5, 103.5), ("c" * 10 + "d" * 10, 20, 40))
+        # the new output starts a new segment after the previous ones
+        self.write(transcript, [(107.0, "f" * 4)])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "R1", "%016d.log" % 50)))
+        self.assertEqual(transcript.read(106.0), ("e" * 10 + "f" * 4, 40, 54))
+        self.assertEqual(transcript.read(107.0), ("f" * 4, 50, 54))
+        self.assertEqual(transcript.read(0)[2], 54)
+
+    def test_load_skips_other_files(self):
+
+        self.sample()
+        directory = os.path.join(self.directory, "R1")
+        open(os.path.join(directory, "notes.log"), "wb").close()
+        # a segment without index and a segment with an empty index
+        open(os.path.join(directory, "%016d.log" % 50), "wb").close()
+        open(os.path.join(directory, "%016d.log" % 60), "wb").close()
+        open(os.path.join(directory, "%016d.idx" % 60), "wb").close()
+        transcript = self.reopen()
+        self.assertEqual(transcript.read(0)[1:], (0, 50))
+
+    def test_writer_thread(self):
+
+        transcript = self.transcripts.open("VM 1/x")
+        transcript.append("hello ")
+        transcript.append("world")
+        transcript.close()
+        self.transcripts.close()
+        self.assertEqual(transcript.read(0), ("hello world", 0, 11))
+        # the instance name is made safe for the file system
+        self.assertEqual(os.listdir(self.directory), ["VM_1_x"])
+        self.assertIn(("transcripts.written_bytes", 11), self.transcripts.metrics())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from vboxwrapper.worker_pool import WorkerPool, KeyedExecutor
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.pool = WorkerPool(2, name="test-worker")
+
+    def tearDown(self):
+
+        self.pool.shutdown()
+
+    def test_submit(self):
+
+        results = []
+        done = threading.Event()
+        self.pool.submit(results.append, (1,), done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [1])
+
+    def test_callback_after_exception(self):
+
+        done = threading.Event()
+        self.pool.submit(lambda: 1 / 0, (), done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_size(self):
+
+        self.assertEqual(WorkerPool(0).size, 1)
+        self.assertEqual(self.pool.size, 2)
+
+
+class KeyedExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.pool = WorkerPool(4, name="test-worker")
+        self.executor = KeyedExecutor(self.pool)
+
+    def tearDown(self):
+
+        self.pool.shutdown()
+
+    def wait_idle(self):
+
+        for _ in range(500):
+            if self.executor.idle():
+                return
+            time.sleep(0.01)
+        self.fail("the executor is still busy")
+
+    def test_same_key_in_order(self):
+
+        results = []
+        running = []
+        overlaps = []
+
+        def task(index):
+            running.append(index)
+            if len(running) > 1:
+                overlaps.append(index)
+            time.sleep(0.001)
+            results.append(index)
+            running.remove(index)
+
+        for index in range(20):
+            self.executor.submit("R1", task, (index,))
+        self.wait_idle()
+        self.assertEqual(results, range(20))
+        # no other task of the key ran meanwhile
+        self.assertEqual(overlaps, [])
+
+    def test_keys_run_concurrently(self):
+
+        first = threading.Event()
+        second = threading.Event()
+        done = threading.Event()
+
+        results = []
+
+        def task(own, other):
+            own.set()
+            results.append(other.wait(5))
+
+        self.executor.submit("R1", task, (first, second))
+        self.executor.submit("R2", task, (second, first), done.set)
+        self.assertTrue(done.wait(5))
+        self.wait_idle()
+        # each task only returned once the other one started
+        self.assertEqual(results, [True, True])
+
+    def test_pending(self):
+
+        release = threading.Event()
+        self.assertTrue(self.executor.idle())
+        self.executor.submit("R1", release.wait, (5,))
+        self.assertTrue(self.executor.pending("R1"))
+        self.assertFalse(self.executor.pending("R2"))
+        self.assertFalse(self.executor.idle())
+        release.set()
+        self.wait_idle()
+        self.assertFalse(self.executor.pending("R1"))
+
+    def test_callbacks(self):
+
+        calls = []
+        done = threading.Event()
+        self.executor.submit("R1", lambda: 1 / 0, (), lambda: calls.append("failed"))
+        self.executor.submit("R1", calls.append, ("task",), done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ["failed", "task"])
+
+    def test_hold(self):
+
+        with self.executor.hold(["R1", "R2"]):
+            self.assertTrue(self.executor.pending("R1"))
+            self.assertFalse(self.executor.idle())
+            with self.executor.hold(["R1"]):
+                self.assertTrue(self.executor.pending("R1"))
+            # still held by the outer hold
+            self.assertTrue(self.executor.pending("R1"))
+        self.assertFalse(self.executor.pending("R1"))
+        self.assertFalse(self.executor.pending("R2"))
+        self.assertTrue(self.executor.idle())
+
+    def test_hold_released_on_error(self):
+
+        try:
+            with self.executor.hold(["R1"]):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(self.executor.idle())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,756 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serial consoles of all the VMs served by a single thread.
+
+A PipeProxy thread per VM wakes up ten times a second to check if it
+must stop, even when nobody is connected. The hub watches the serial
+pipes, the console servers and the Telnet clients of all the VMs with
+one Poller and only wakes up when one of them is ready or when a Waker
+asks it to add or remove a console. The client sockets never block:
+the output of each client is queued up to a limit and only sent when
+the client is writable, so a slow client does not hold back the others
+or the reads from the serial pipe. The serial pipes do not block either,
+the input of a VM not reading it is queued and its clients are no longer
+read until it catches up.
+
+When the serial pipe of a VM is closed, because the VM process went
+away, the console keeps its server and its clients and reconnects to
+the pipe with a fast backoff once the VM process is back.
+
+The hub can also serve all the consoles on one multiplexed port: a
+client connecting to it selects a VM by typing its name or its console
+port, or by sending the VM name as its Telnet terminal type, then it is
+served like the clients of the console port of the VM.
+
+A console can serve raw TCP clients instead of Telnet clients, for the
+automation tools: the bytes are copied between the sockets and the pipe
+without any negotiation, escaping or banner, the input of a client is
+received into a buffer of its own and sent to the pipe from there. A
+raw multiplexed port reads the name or the port of the VM on the first
+line, without prompt or echo, anything after it goes to the VM.
+
+Windows named pipes cannot be polled, PipeProxy threads are still
+used there.
+"""
+
+import collections
+import errno
+import functools
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+from poller import Poller, Waker, READ, WRITE
+from tcp_pipe_proxy import create_server, accept_client, from_client, banner, escape, scrollback_replay, \
+    OutputBufferFull, pipe_notice, PIPE_READ_SIZE
+
+import logging
+log = logging.getLogger(__name__)
+
+# bytes of input queued for a VM not reading its serial pipe
+PIPE_INPUT_SIZE = 1024 * 1024
+
+# seconds between the attempts to reconnect to a closed serial pipe, doubled after each failure
+RECONNECT_DELAY = 0.05
+MAX_RECONNECT_DELAY = 0.5
+
+MUX_PROMPT = "VM name or console port: "
+# longest selection typed on the multiplexed port
+MAX_SELECTOR = 256
+
+
+class HubConsole(object):
+    """
+    Serial console of a VM served by a ConsoleHub, it has
+    the stop(), join() and isAlive() methods of PipeProxy.
+
+    :param hub: ConsoleHub instance
+    :param name: VM name
+    :param pipe: connected serial pipe socket
+    :param server: listening socket for the Telnet clients
+    :param scrollback: Scrollback instance recording the output
+    :param transcript: Transcript instance recording the output
+    :param reconnect: function returning a new connected serial pipe
+    socket, called when the pipe is closed
+    :param raw: True to serve raw TCP clients instead of Telnet clients
+    """
+
+    def __init__(self, hub, name, pipe, server, scrollback=None, transcript=None, reconnect=None, raw=False):
+
+        self.devname = name
+        self.raw = raw
+        self.pipe = pipe
+        self.server = server
+        self.port = server.getsockname()[1]
+        self.scrollback = scrollback
+        self.transcript = transcript
+        self.clients = {}
+        self.reconnections = 0
+        self._hub = hub
+        self._closed = threading.Event()
+        self._reconnect = reconnect
+        self._reconnect_delay = RECONNECT_DELAY
+        # the pipes opened by reconnecting are closed by the console
+        self._own_pipe = False
+        # input not written to the pipe yet
+        self._input = collections.deque()
+        self._input_size = 0
+
+    def _open(self):
+
+        self._hub.watch(self.server.fileno(), self._accept)
+        self._watch_pipe()
+
+    def _watch_pipe(self):
+
+        self.pipe.setblocking(0)
+        self._hub.watch(self.pipe.fileno(), self._pipe_event)
+
+    def _accept(self, mask):
+
+        try:
+            client = accept_client(self.server, self.raw)
+        except socket.error as e:
+            log.warning("{}: accept error: {}".format(self.devname, e))
+            return
+        self.attach(client)
+
+    def attach(self, client):
+        """
+        Serves the console to a client, only from the hub thread.
+
+        :param client: TelnetClient or RawClient instance
+        """
+
+        log.info("{}: new console client {}".format(self.devname, client.addrport()))
+        self.clients[client.fileno] = client
+        self._hub.watch(client.fileno, functools.partial(self._client_event, client))
+        self._update(client)
+        if client.telnet:
+            self._write(client, banner(self.devname))
+        if self.scrollback is not None and client.fileno in self.clients:
+            self._write(client, scrollback_replay(client, self.scrollback.tail()))
+
+    def _pipe_event(self, mask):
+
+        if mask & WRITE:
+            self._flush_pipe()
+        if mask & READ and self.pipe is not None:
+            self._read_pipe()
+
+    def _read_pipe(self):
+
+        try:
+            data = self.pipe.recv(PIPE_READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            log.info("{}: pipe has been closed!".format(self.devname))
+            if self._reconnect is None:
+                self._close()
+            else:
+                self._pipe_lost()
+            return
+        if self.scrollback is not None:
+            self.scrollback.append(data)
+        if self.transcript is not None:
+            self.transcript.append(data)
+        # escaped once for all the Telnet clients
+        escaped = None
+        for client in list(self.clients.values()):
+            if client.telnet:
+                if escaped is None:
+                    escaped = escape(data)
+                self._write(client, escaped)
+            else:
+                self._write(client, data)
+
+    def _pipe_lost(self):
+        """
+        Keeps the clients while reconnecting to the serial pipe.
+        """
+
+        self._close_pipe()
+        self._notify(False)
+        self._reconnect_delay = RECONNECT_DELAY
+        self._hub.call_later(self._reconnect_delay, self._try_reconnect)
+
+    def _try_reconnect(self):
+
+        if self._closed.isSet():
+            return
+        try:
+            pipe = self._reconnect()
+        except Exception as e:
+            log.debug("{}: cannot reconnect to the pipe: {}".format(self.devname, e))
+            self._reconnect_delay = min(self._reconnect_delay * 2, MAX_RECONNECT_DELAY)
+            self._hub.call_later(self._reconnect_delay, self._try_reconnect)
+            return
+        log.info("{}: reconnected to the pipe".format(self.devname))
+        self.pipe = pipe
+        self._own_pipe = True
+        self.reconnections += 1
+        self._hub.count("reconnections")
+        self._watch_pipe()
+        self._notify(True)
+
+    def _notify(self, connected):
+        """
+        Tells the Telnet clients about the state of the pipe, the raw
+        clients only get the output of the VM.
+        """
+
+        for client in list(self.clients.values()):
+            if client.telnet:
+                self._write(client, pipe_notice(self.devname, connected))
+
+    def send_to_pipe(self, data):
+        """
+        Sends bytes to the serial pipe after the input already
+        received from the clients, can be called from any thread.
+
+        :param data: string
+
+        :returns: False if the pipe is closed
+        """
+
+        if self.pipe is None or self._closed.isSet():
+            return False
+        self._hub.call(self.write_pipe, data)
+        return True
+
+    def write_pipe(self, data):
+        """
+        Writes input to the serial pipe without blocking, only from the
+        hub thread. What the VM does not read yet is queued and the
+        clients are not read while the queue is over a limit, the input
+        is discarded while reconnecting to the pipe.
+
+        :param data: string or buffer, only used during the call
+        """
+
+        if self.pipe is None:
+            log.debug("{}: pipe closed, {} bytes of input discarded".format(self.devname, len(data)))
+            return
+        sent = 0
+        if not self._input:
+            sent = self._send_pipe(data)
+            if sent is None or sent == len(data):
+                return
+        reading = self._input_size < PIPE_INPUT_SIZE
+        # the buffers of the clients are reused, the input is copied
+        self._input.append(bytearray(data[sent:]))
+        self._input_size += len(data) - sent
+        self._hub.modify(self.pipe.fileno(), READ | WRITE)
+        if reading and self._input_size >= PIPE_INPUT_SIZE:
+            log.info("{}: the VM does not read its input, pausing the console clients".format(self.devname))
+            self._update_clients()
+
+    def _send_pipe(self, data):
+        """
+        Sends as much input as possible without blocking.
+
+        :returns: number of bytes sent, None if the pipe failed
+        """
+
+        try:
+            return self.pipe.send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            # the closed pipe is noticed by the next read
+            log.warning("{}: cannot write to the pipe: {}".format(self.devname, e))
+            self._clear_input()
+            return None
+
+    def _flush_pipe(self):
+
+        paused = self._input_size >= PIPE_INPUT_SIZE
+        self._drain_pipe()
+        if paused and self._input_size < PIPE_INPUT_SIZE:
+            self._update_clients()
+
+    def _drain_pipe(self):
+
+        while self._input and self.pipe is not None:
+            chunk = self._input[0]
+            sent = self._send_pipe(chunk)
+            if sent is None:
+                break
+            self._input_size -= sent
+            if sent < len(chunk):
+                del chunk[:sent]
+                return
+            self._input.popleft()
+        if self.pipe is not None:
+            self._hub.modify(self.pipe.fileno(), READ)
+
+    def _clear_input(self):
+
+        paused = self._input_size >= PIPE_INPUT_SIZE
+        if self._input_size:
+            self._hub.count("dropped_input_bytes", self._input_size)
+        self._input.clear()
+        self._input_size = 0
+        if paused:
+            self._update_clients()
+
+    def _close_pipe(self):
+
+        if self.pipe is None:
+            return
+        self._hub.unwatch(self.pipe.fileno())
+        if self._own_pipe:
+            self.pipe.close()
+        self.pipe = None
+        self._own_pipe = False
+        self._clear_input()
+
+    def _write(self, client, data):
+
+        try:
+            dropped = client.write(data)
+        except OutputBufferFull as e:
+            log.info("{}: {}, disconnecting it".format(self.devname, e))
+            self._hub.count("slow_disconnects")
+            self._drop(client)
+            return
+        except Exception as e:
+            log.debug("{}: {}".format(self.devname, e))
+            self._drop(client)
+            return
+        if dropped:
+            self._hub.count("dropped_bytes", dropped)
+        self._update(client)
+
+    def _update(self, client):
+        """
+        Waits for a client to be writable only while it has output queued
+        and readable only while the input of the VM is not over its limit.
+        """
+
+        if client.fileno in self.clients:
+            mask = READ if self._input_size < PIPE_INPUT_SIZE else 0
+            if client.pending():
+                mask |= WRITE
+            self._hub.modify(client.fileno, mask)
+
+    def _update_clients(self):
+
+        for client in list(self.clients.values()):
+            self._update(client)
+
+    def _client_event(self, client, mask):
+
+        try:
+            if mask & WRITE:
+                client.flush()
+            if mask & READ:
+                client.forward(self.write_pipe)
+        except Exception as e:
+            log.debug("{}: {}".format(self.devname, e))
+            self._drop(client)
+            return
+        # the Telnet negotiation may have queued replies
+        self._update(client)
+
+    def _drop(self, client):
+
+        log.info("{}: lost console client {}".format(self.devname, client.addrport()))
+        self._hub.unwatch(client.fileno)
+        self.clients.pop(client.fileno, None)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def _close(self):
+
+        if self._closed.isSet():
+            return
+        for client in list(self.clients.values()):
+            self._drop(client)
+        self._close_pipe()
+        self._hub.unwatch(self.server.fileno())
+        self.server.close()
+        self._hub.closed(self)
+        self._closed.set()
+
+    def stop(self):
+        """
+        Stops serving the console, the pipe it was given is left open.
+        """
+
+        self._hub.call(self._close)
+
+    def join(self, timeout=None):
+
+        self._closed.wait(timeout)
+
+    def isAlive(self):
+
+        return not self._closed.isSet()
+
+
+class ConsoleHub(object):
+    """
+    Serves the serial consoles of the VMs with one thread.
+    """
+
+    def __init__(self):
+
+        self._poller = Poller()
+        self._waker = Waker()
+        self._handlers = {}
+        self._consoles = set()
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._wakeups = 0
+        self._counters = dict.fromkeys(("dropped_bytes", "dropped_input_bytes", "slow_disconnects", "reconnections",
+                                        "mux_attached"), 0)
+        self._timers = []
+        self._sequence = itertools.count()
+        self._mux_servers = {}  # listening sockets of the multiplexed ports and raw flags, by file descriptor
+        self._selecting = {}    # lines typed by the clients of the multiplexed port, by file descriptor
+
+    def add_console(self, name, pipe, host, port, scrollback=None, transcript=None, reconnect=None, raw=False):
+        """
+        Starts serving the console of a VM.
+
+        :param name: VM name
+        :param pipe: connected serial pipe socket
+        :param host: IP address the Telnet clients connect to
+        :param port: TCP port the Telnet clients connect to
+        :param scrollback: Scrollback instance recording the output
+        :param transcript: Transcript instance recording the output
+        :param reconnect: function returning a new connected serial pipe
+        socket, called when the pipe is closed
+        :param raw: True to serve raw TCP clients instead of Telnet clients
+
+        :returns: HubConsole instance
+        """
+
+        console = HubConsole(self, name, pipe, create_server(host, port), scrollback, transcript, reconnect, raw)
+        with self._lock:
+            self._consoles.add(console)
+        self._start()
+        self.call(console._open)
+        return console
+
+    def listen(self, host, port, raw=False):
+        """
+        Serves all the consoles on one multiplexed port.
+
+        :param host: IP address the clients connect to
+        :param port: TCP port the clients connect to
+        :param raw: True to serve raw TCP clients instead of Telnet clients
+
+        :returns: TCP port the clients connect to
+        """
+
+        server = create_server(host, port)
+        self._start()
+        self.call(self._open_mux, server, raw)
+        return server.getsockname()[1]
+
+    def _start(self):
+
+        with self._lock:
+            if self._thread is None:
+                self._running = True
+                self._poller.register(self._waker.fileno(), READ)
+                self._thread = threading.Thread(target=self._run, name="console-hub")
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _open_mux(self, server, raw):
+
+        self._mux_servers[server.fileno()] = (server, raw)
+        self.watch(server.fileno(), functools.partial(self._mux_accept, server, raw))
+
+    def _close_mux(self):
+
+        for client, line in list(self._selecting.values()):
+            self._mux_drop(client)
+        for fd, (server, raw) in list(self._mux_servers.items()):
+            self.unwatch(fd)
+            server.close()
+        self._mux_servers.clear()
+
+    def _mux_accept(self, server, raw, mask):
+
+        try:
+            client = accept_client(server, raw)
+        except socket.error as e:
+            log.warning("multiplexed console accept error: {}".format(e))
+            return
+        log.info("new multiplexed console client {}".format(client.addrport()))
+        self._selecting[client.fileno] = [client, ""]
+        self.watch(client.fileno, functools.partial(self._mux_event, client))
+        if client.telnet:
+            self._mux_write(client, MUX_PROMPT)
+
+    def _mux_write(self, client, data):
+
+        try:
+            client.write(data)
+        except Exception as e:
+            log.debug("{}".format(e))
+            self._mux_drop(client)
+            return
+        if client.fileno in self._selecting:
+            self.modify(client.fileno, READ | WRITE if client.pending() else READ)
+
+    def _mux_drop(self, client):
+
+        self.unwatch(client.fileno)
+        self._selecting.pop(client.fileno, None)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def _mux_event(self, client, mask):
+
+        try:
+            if mask & WRITE:
+                client.flush()
+            data = client.socket_recv() if mask & READ else ""
+        except Exception as e:
+            log.debug("{}".format(e))
+            self._mux_drop(client)
+            return
+        console = None
+        if client.terminal_type:
+            console = self.find_console(client.terminal_type)
+        entry = self._selecting[client.fileno]
+        position = 0
+        for char in data:
+            if console is not None:
+                break
+            position += 1
+            if char in "\r\n":
+                selector = entry[1].strip()
+                entry[1] = ""
+                if selector:
+                    console = self.find_console(selector)
+                    if console is None:
+                        if client.telnet:
+                            self._mux_write(client, "\r\nunknown console '%s'" % selector)
+                        else:
+                            self._mux_write(client, "unknown console '%s'\n" % selector)
+                if console is None and client.telnet:
+                    self._mux_write(client, "\r\n" + MUX_PROMPT)
+            elif char in "\x7f\x08":
+                if entry[1]:
+                    entry[1] = entry[1][:-1]
+                    if client.telnet:
+                        self._mux_write(client, "\x08 \x08")
+            elif " " <= char < "\x7f" and len(entry[1]) < MAX_SELECTOR:
+                entry[1] += char
+                # the Telnet clients do not echo, they have been told the server does
+                if client.telnet:
+                    self._mux_write(client, char)
+        if client.fileno not in self._selecting:
+            return
+        if console is None:
+            self.modify(client.fileno, READ | WRITE if client.pending() else READ)
+            return
+        del self._selecting[client.fileno]
+        self.unwatch(client.fileno)
+        if client.telnet:
+            self._mux_write(client, "\r\n")
+        self.count("mux_attached")
+        console.attach(client)
+        # the input following the selection goes to the VM
+        if data[position - 1:position] == "\r" and data[position:position + 1] == "\n":
+            position += 1
+        rest = data[position:]
+        if rest and client.fileno in console.clients:
+            console.write_pipe(from_client(rest) if client.telnet else rest)
+
+    def find_console(self, selector):
+        """
+        Finds a console by VM name or console port.
+
+        :param selector: VM name or console port
+
+        :returns: HubConsole instance or None
+        """
+
+        with self._lock:
+            consoles = list(self._consoles)
+        for console in consoles:
+            if console.devname == selector or str(console.port) == selector:
+                return console
+        for console in consoles:
+            if console.devname.lower() == selector.lower():
+                return console
+        return None
+
+    def call(self, func, *args):
+        """
+        Runs a function in the hub thread, can be called from any thread.
+        """
+
+        with self._lock:
+            self._calls.append((func, args))
+        self._waker.wake()
+
+    def call_later(self, delay, func, *args):
+        """
+        Runs a function in the hub thread after a delay, only from the hub thread.
+        """
+
+        heapq.heappush(self._timers, (time.time() + delay, next(self._sequence), func, args))
+
+    def _run_timers(self):
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, sequence, func, args = heapq.heappop(self._timers)
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("exception in console hub: {}".format(e))
+
+    def watch(self, fd, handler):
+        """
+        Calls a handler with the event mask when a file descriptor
+        is readable, only from the hub thread.
+        """
+
+        self._handlers[fd] = handler
+        self._poller.register(fd, READ)
+
+    def modify(self, fd, mask):
+        """
+        Changes the events a file descriptor is watched for, only from the hub thread.
+        """
+
+        if fd in self._handlers:
+            self._poller.modify(fd, mask)
+
+    def count(self, name, value=1):
+        """
+        Increments a hub counter, only from the hub thread.
+        """
+
+        self._counters[name] += value
+
+    def unwatch(self, fd):
+        """
+        Stops watching a file descriptor, only from the hub thread.
+        """
+
+        if self._handlers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def closed(self, console):
+
+        with self._lock:
+            self._consoles.discard(console)
+
+    def _run_calls(self):
+
+        while True:
+            with self._lock:
+                if not self._calls:
+                    return
+                func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("exception in console hub: {}".format(e))
+
+    def _run(self):
+
+        waker_fd = self._waker.fileno()
+        while self._running:
+            # only the pending timers make the hub wake up on its own
+            timeout = None
+            if self._timers:
+                timeout = max(0.0, self._timers[0][0] - time.time())
+            events = self._poller.poll(timeout)
+            self._wakeups += 1
+            self._run_timers()
+            for fd, mask in events:
+                if fd == waker_fd:
+                    self._waker.drain()
+                    self._run_calls()
+                    continue
+                # the handler may be gone with a console closed by a previous event
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    handler(mask)
+                except Exception as e:
+                    log.error("exception in console hub: {}".format(e))
+
+    def stop(self):
+        """
+        Stops the consoles and the hub thread.
+        """
+
+        with self._lock:
+            consoles = list(self._consoles)
+            thread = self._thread
+        for console in consoles:
+            console.stop()
+        if thread is None:
+            return
+
+        def stop():
+            self._close_mux()
+            self._running = False
+
+        self.call(stop)
+        thread.join(1)
+        with self._lock:
+            self._thread = None
+            self._timers = []
+            self._poller.unregister(self._waker.fileno())
+
+    def metrics(self):
+        """
+        Returns the hub counters.
+
+        :returns: list of (name, value) tuples
+        """
+
+        with self._lock:
+            consoles = list(self._consoles)
+        clients = [client for console in consoles for client in console.clients.values()]
+        return [("console_hub.consoles", len(consoles)),
+                ("console_hub.clients", len(clients)),
+                ("console_hub.wakeups", self._wakeups),
+                ("console_hub.queued_bytes", sum(client.pending() for client in clients)),
+                ("console_hub.dropped_bytes", self._counters["dropped_bytes"]),
+                ("console_hub.dropped_input_bytes", self._counters["dropped_input_bytes"]),
+                ("console_hub.slow_disconnects", self._counters["slow_disconnects"]),
+                ("console_hub.reconnections", self._counters["reconnections"]),
+                ("console_hub.mux_selecting", len(self._selecting)),
+                ("console_hub.mux_attached", self._counters["mux_attached"])]
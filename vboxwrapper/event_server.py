@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event-driven TCP control server.
+
+All the client connections are served by a single thread waiting on
+a Poller. Requests are parsed as soon as a full line is received and
+handlers may defer slow calls to a bounded WorkerPool, replies are
+queued and flushed when the sockets are writable.
+"""
+
+from __future__ import print_function
+
+import collections
+import errno
+import socket
+import threading
+
+from poller import Poller, Waker, READ, WRITE
+from worker_pool import WorkerPool, KeyedExecutor
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class EventConnection(object):
+    """
+    Client connection served by the EventServer.
+
+    This object is given as the request to the handler,
+    replies are written to it as if it was a file.
+
+    :param server: EventServer instance
+    :param sock: client socket
+    :param client_address: client address tuple
+    """
+
+    def __init__(self, server, sock, client_address):
+
+        self.server = server
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.client_address = client_address
+        self.handler = None
+        self.busy = False
+        self.closing = False
+        self.lines = collections.deque()
+        self._in_buffer = ""
+        self._out_buffer = []
+        self._out_lock = threading.Lock()
+
+    def write(self, data):
+        """
+        Queues data to be sent, can be called from any thread.
+
+        :param data: data to send
+        """
+
+        with self._out_lock:
+            self._out_buffer.append(data)
+        self.server.schedule(self)
+
+    def feed(self, data):
+        """
+        Splits received data into request lines.
+
+        :param data: received data, an empty string on end of file
+        """
+
+        if not data:
+            if self._in_buffer:
+                # end of file, the last request has no delimiter
+                self.lines.append(self._in_buffer)
+                self._in_buffer = ""
+            return
+        self._in_buffer += data
+        if "\n" not in data:
+            return
+        lines = self._in_buffer.split("\n")
+        self._in_buffer = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        """
+        Sends as much queued data as the socket accepts.
+
+        :returns: True if all the data has been sent
+        """
+
+        with self._out_lock:
+            if not self._out_buffer:
+                return True
+            data = "".join(self._out_buffer)
+            self._out_buffer = []
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+            sent = 0
+        if sent < len(data):
+            with self._out_lock:
+                self._out_buffer.insert(0, data[sent:])
+            return False
+        return True
+
+
+class EventServer(object):
+    """
+    Single-threaded TCP server with a pool of workers for slow requests.
+
+    The handler class is instantiated once per connection with
+    (connection, client_address, server) and must implement
+    process_request(line) and a close_connection attribute.
+
+    :param server_address: (host, port) tuple
+    :param RequestHandlerClass: handler class
+    :param workers: number of worker threads
+    """
+
+    address_family = socket.AF_INET
+    allow_reuse_address = True
+    request_queue_size = 128
+    recv_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass, workers=8):
+
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+
+        self.stopping = threading.Event()
+        self._pool = WorkerPool(workers, name="vbox-worker")
+        self.executor = KeyedExecutor(self._pool)
+        self._connections = {}
+        self._scheduled = collections.deque()
+        self._loop_thread = None
+        self._waker = Waker()
+        self._poller = Poller()
+        self._poller.register(self.socket.fileno(), READ)
+        self._poller.register(self._waker.fileno(), READ)
+
+    def serve_forever(self):
+        """
+        Runs the event loop until stop() is called.
+        """
+
+        self._loop_thread = threading.current_thread()
+        listener = self.socket.fileno()
+        waker = self._waker.fileno()
+        try:
+            while not self.stopping.isSet():
+                for fd, mask in self._poller.poll():
+                    if fd == listener:
+                        self._accept()
+                    elif fd == waker:
+                        self._waker.drain()
+                    else:
+                        connection = self._connections.get(fd)
+                        if connection is None:
+                            continue
+                        if mask & READ:
+                            self._read(connection)
+                        if mask & WRITE and fd in self._connections:
+                            self._flush(connection)
+                self._run_scheduled()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """
+        Stops the event loop, can be called from any thread.
+        """
+
+        self.stopping.set()
+        self._waker.wake()
+
+    def defer(self, connection, key, func, args=()):
+        """
+        Runs a slow call in the worker pool, after the calls
+        already submitted to the executor with the same key.
+
+        The connection does not process further requests until
+        the call has returned, so replies keep the request order.
+
+        :param connection: EventConnection instance
+        :param key: executor key
+        :param func: function to call
+        :param args: function arguments
+        """
+
+        connection.busy = True
+        self.executor.submit(key, func, args, self._resume_callback(connection))
+
+    def spawn(self, connection, func, args=()):
+        """
+        Runs a call in its own thread, for calls that may wait
+        for other tasks of the worker pool.
+
+        :param connection: EventConnection instance
+        :param func: function to call
+        :param args: function arguments
+        """
+
+        connection.busy = True
+        resume = self._resume_callback(connection)
+
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("exception in thread: {}".format(e))
+            finally:
+                resume()
+
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _resume_callback(self, connection):
+
+        def resume():
+            connection.busy = False
+            self.schedule(connection)
+        return resume
+
+    def schedule(self, connection):
+        """
+        Asks the event loop to flush a connection and to resume
+        processing its requests.
+
+        :param connection: EventConnection instance
+        """
+
+        if threading.current_thread() is self._loop_thread:
+            # the event loop flushes after processing requests
+            return
+        self._scheduled.append(connection)
+        self._waker.wake()
+
+    def _accept(self):
+
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                log.error("accept error: {}".format(e))
+                return
+            print("Connection from", client_address)
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = EventConnection(self, sock, client_address)
+            connection.handler = self.RequestHandlerClass(connection, client_address, self)
+            self._connections[connection.fileno] = connection
+            self._poller.register(connection.fileno, READ)
+
+    def _read(self, connection):
+
+        try:
+            data = connection.sock.recv(self.recv_size)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            log.error("{}".format(e))
+            self._close(connection)
+            return
+        connection.feed(data)
+        if not data:
+            connection.closing = True
+        self._process(connection)
+
+    def _process(self, connection):
+
+        while connection.lines and not connection.busy:
+            if connection.handler.close_connection:
+                connection.lines.clear()
+                break
+            line = connection.lines.popleft()
+            try:
+                connection.handler.process_request(line)
+            except Exception as e:
+                log.error("exception while processing request: {}".format(e))
+        if connection.handler.close_connection and not connection.busy:
+            connection.closing = True
+        self._flush(connection)
+
+    def _flush(self, connection):
+
+        try:
+            flushed = connection.flush()
+        except socket.error as e:
+            log.error("{}".format(e))
+            self._close(connection)
+            return
+        # nothing is read while a request is running or once the client closed its side,
+        # a closed socket would otherwise be readable on every poll
+        mask = 0 if connection.closing or connection.busy else READ
+        if not flushed:
+            self._poller.modify(connection.fileno, mask | WRITE)
+            return
+        if connection.closing and not connection.busy and not connection.lines:
+            self._close(connection)
+        else:
+            self._poller.modify(connection.fileno, mask)
+
+    def _run_scheduled(self):
+
+        while self._scheduled:
+            connection = self._scheduled.popleft()
+            # the file descriptor of a closed connection may have been reused
+            if self._connections.get(connection.fileno) is connection:
+                self._process(connection)
+
+    def _close(self, connection):
+
+        if self._connections.pop(connection.fileno, None) is None:
+            return
+        self._poller.unregister(connection.fileno)
+        try:
+            connection.sock.close()
+        except socket.error:
+            pass
+        print("Disconnection from", connection.client_address)
+
+    def _shutdown(self):
+
+        # give a last chance to the replies queued before stopping
+        for connection in self._connections.values():
+            try:
+                connection.sock.settimeout(1)
+                while not connection.flush():
+                    pass
+            except socket.error:
+                pass
+            self._close(connection)
+        self._pool.shutdown()
+        self._poller.close()
+        self._waker.close()
+        self.socket.close()
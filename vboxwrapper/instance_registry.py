@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Registry of the VirtualBox instances managed by the wrapper.
+"""
+
+import threading
+
+
+class _IndexEntries(object):
+    """
+    Index keys of one instance, to update the indexes without scanning them.
+    """
+
+    __slots__ = ("image", "console", "udp")
+
+    def __init__(self):
+
+        self.image = None
+        self.console = None
+        self.udp = {}
+
+
+class InstanceRegistry(object):
+    """
+    Thread-safe mapping of instance names to instances.
+
+    Every instance name has its own lock so commands on different instances
+    do not wait for each other. The locks are created on demand and kept
+    for the names no longer registered, the commands racing with the
+    creation, deletion or renaming of an instance wait for the same lock
+    as the commands run once it is done. Secondary indexes find the instances using
+    a VirtualBox image, a console port or an UDP local port in constant time.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._locks = {}
+        self._entries = {}
+        self._by_image = {}
+        self._by_console = {}
+        self._by_udp_port = {}
+
+    @staticmethod
+    def _port_key(port):
+
+        try:
+            return int(port)
+        except (TypeError, ValueError):
+            return port
+
+    def __contains__(self, name):
+
+        return name in self._instances
+
+    def __getitem__(self, name):
+
+        return self._instances[name]
+
+    def __len__(self):
+
+        return len(self._instances)
+
+    def get(self, name, default=None):
+        """
+        Returns an instance.
+
+        :param name: instance name
+        :param default: returned if the instance is unknown
+
+        :returns: instance
+        """
+
+        return self._instances.get(name, default)
+
+    def names(self):
+        """
+        Returns a snapshot of the instance names.
+
+        :returns: list of names
+        """
+
+        with self._lock:
+            return list(self._instances)
+
+    def items(self):
+        """
+        Returns a snapshot of the (name, instance) pairs.
+
+        :returns: list of tuples
+        """
+
+        with self._lock:
+            return list(self._instances.items())
+
+    def lock(self, name):
+        """
+        Returns the lock of an instance name, use it as a context manager.
+
+        :param name: instance name, registered or not
+
+        :returns: re-entrant lock
+        """
+
+        lock = self._locks.get(name)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(name, threading.RLock())
+        return lock
+
+    def add(self, name, instance):
+        """
+        Registers an instance.
+
+        :param name: instance name
+        :param instance: instance
+
+        :returns: False if the name is already registered
+        """
+
+        with self._lock:
+            if name in self._instances:
+                return False
+            self._instances[name] = instance
+            self._locks.setdefault(name, threading.RLock())
+            self._entries[name] = _IndexEntries()
+            return True
+
+    def remove(self, name):
+        """
+        Unregisters an instance and removes it from the indexes.
+
+        :param name: instance name
+
+        :returns: the instance or None if it is unknown
+        """
+
+        with self._lock:
+            instance = self._instances.pop(name, None)
+            if instance is None:
+                return None
+            entries = self._entries.pop(name)
+            self._unindex_image(name, entries)
+            if entries.console is not None:
+                del self._by_console[entries.console]
+            for key in entries.udp.values():
+                del self._by_udp_port[key]
+            return instance
+
+    def rename(self, old_name, new_name):
+        """
+        Renames an instance, its index entries follow it while
+        the locks stay with the names.
+
+        :param old_name: current name
+        :param new_name: new name
+
+        :returns: False if old_name is unknown or new_name already registered
+        """
+
+        with self._lock:
+            if old_name not in self._instances or new_name in self._instances:
+                return False
+            self._instances[new_name] = self._instances.pop(old_name)
+            entries = self._entries.pop(old_name)
+            self._entries[new_name] = entries
+            if entries.image is not None:
+                users = self._by_image[entries.image]
+                users.discard(old_name)
+                users.add(new_name)
+            if entries.console is not None:
+                self._by_console[entries.console] = new_name
+            for adapter_id, key in entries.udp.items():
+                self._by_udp_port[key] = (new_name, adapter_id)
+            return True
+
+    def _unindex_image(self, name, entries):
+
+        if entries.image is None:
+            return
+        users = self._by_image[entries.image]
+        users.discard(name)
+        if not users:
+            del self._by_image[entries.image]
+        entries.image = None
+
+    def set_image(self, name, image):
+        """
+        Indexes the VirtualBox image (VM name) used by an instance.
+
+        :param name: instance name
+        :param image: VirtualBox VM name
+
+        :returns: names of the other instances using the same image
+        """
+
+        with self._lock:
+            entries = self._entries.get(name)
+            if entries is None:
+                return []
+            self._unindex_image(name, entries)
+            users = self._by_image.setdefault(image, set())
+            others = sorted(users)
+            users.add(name)
+            entries.image = image
+            return others
+
+    def set_console(self, name, port):
+        """
+        Indexes the console port of an instance.
+
+        :param name: instance name
+        :param port: TCP port
+
+        :returns: the name of the instance already using the port
+        (nothing is changed in that case) or None
+        """
+
+        key = self._port_key(port)
+        with self._lock:
+            entries = self._entries.get(name)
+            if entries is None:
+                return None
+            owner = self._by_console.get(key)
+            if owner is not None and owner != name:
+                return owner
+            if entries.console is not None:
+                del self._by_console[entries.console]
+            self._by_console[key] = name
+            entries.console = key
+            return None
+
+    def remove_console(self, name):
+        """
+        Removes the console port of an instance from the index.
+
+        :param name: instance name
+
+        :returns: the port removed or None
+        """
+
+        with self._lock:
+            entries = self._entries.get(name)
+            if entries is None or entries.console is None:
+                return None
+            key = entries.console
+            del self._by_console[key]
+            entries.console = None
+            return key
+
+    def add_udp(self, name, adapter_id, lport):
+        """
+        Indexes the local port of an UDP tunnel.
+
+        :param name: instance name
+        :param adapter_id: adapter ID
+        :param lport: UDP local port
+
+        :returns: the name of the instance already using the port
+        (nothing is changed in that case) or None
+        """
+
+        key = self._port_key(lport)
+        with self._lock:
+            entries = self._entries.get(name)
+            if entries is None:
+                return None
+            owner = self._by_udp_port.get(key)
+            if owner is not None and owner != (name, adapter_id):
+                return owner[0]
+            previous = entries.udp.pop(adapter_id, None)
+            if previous is not None:
+                del self._by_udp_port[previous]
+            self._by_udp_port[key] = (name, adapter_id)
+            entries.udp[adapter_id] = key
+            return None
+
+    def remove_udp(self, name, adapter_id):
+        """
+        Removes the UDP tunnel of an adapter from the index.
+
+        :param name: instance name
+        :param adapter_id: adapter ID
+        """
+
+        with self._lock:
+            entries = self._entries.get(name)
+            if entries is None:
+                return
+            key = entries.udp.pop(adapter_id, None)
+            if key is not None:
+                del self._by_udp_port[key]
+
+    def find_by_image(self, image):
+        """
+        Returns the instances using a VirtualBox image.
+
+        :param image: VirtualBox VM name
+
+        :returns: list of instance names
+        """
+
+        with self._lock:
+            return sorted(self._by_image.get(image, ()))
+
+    def find_by_console(self, port):
+        """
+        Returns the instance using a console port.
+
+        :param port: TCP port
+
+        :returns: instance name or None
+        """
+
+        return self._by_console.get(self._port_key(port))
+
+    def find_by_udp_port(self, lport):
+        """
+        Returns the instance and adapter using an UDP local port.
+
+        :param lport: UDP local port
+
+        :returns: (instance name, adapter ID) or None
+        """
+
+        return self._by_udp_port.get(self._port_key(lport))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Asynchronous jobs for long running instance operations.
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Job(object):
+    """
+    Operation running in the background.
+
+    :param job_id: job identifier
+    :param description: what the job does
+    :param func: callable returning a (success, message) tuple
+    :param notify: callable called with the job once it is finished
+    """
+
+    def __init__(self, job_id, description, func, notify=None):
+
+        self._id = job_id
+        self._description = description
+        self._func = func
+        self._notify = notify
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._state = QUEUED
+        self._message = ""
+        self._created = time.time()
+        self._started = None
+        self._ended = None
+
+    @property
+    def id(self):
+
+        return self._id
+
+    @property
+    def description(self):
+
+        return self._description
+
+    @property
+    def state(self):
+
+        return self._state
+
+    @property
+    def message(self):
+
+        return self._message
+
+    @property
+    def finished(self):
+
+        return self._finished.isSet()
+
+    def run(self):
+        """
+        Runs the job, does nothing if it has been cancelled.
+        """
+
+        with self._lock:
+            if self._state != QUEUED:
+                return
+            self._state = RUNNING
+            self._started = time.time()
+        try:
+            success, message = self._func()
+        except Exception as e:
+            log.error("job {} ({}) failed: {}".format(self._id, self._description, e))
+            success, message = False, str(e)
+        with self._lock:
+            self._state = DONE if success else FAILED
+            self._message = message
+            self._ended = time.time()
+        self._finish()
+
+    def cancel(self):
+        """
+        Cancels the job if it has not started yet.
+
+        :returns: True if the job has been cancelled
+        """
+
+        with self._lock:
+            if self._state != QUEUED:
+                return False
+            self._state = CANCELLED
+            self._ended = time.time()
+        self._finish()
+        return True
+
+    def _finish(self):
+
+        self._finished.set()
+        if self._notify:
+            try:
+                self._notify(self)
+            except Exception as e:
+                log.warning("could not notify the end of job {}: {}".format(self._id, e))
+
+    def wait(self, timeout=None):
+        """
+        Waits for the job to finish.
+
+        :param timeout: timeout in seconds (None waits forever)
+
+        :returns: True if the job is finished
+        """
+
+        self._finished.wait(timeout)
+        return self._finished.isSet()
+
+    def status(self):
+        """
+        Returns a one line status of the job.
+
+        :returns: "<id> <state> <elapsed seconds> <message>"
+        """
+
+        with self._lock:
+            start = self._started or self._created
+            end = self._ended or time.time()
+            status = "%s %s %.3f" % (self._id, self._state, end - start)
+            if self._message:
+                status += " " + self._message
+            return status
+
+
+class JobManager(object):
+    """
+    Keeps track of the jobs, the oldest finished jobs
+    are forgotten once the history is full.
+
+    :param history: number of jobs to remember
+    """
+
+    def __init__(self, history=1000):
+
+        self._history = history
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    def create(self, description, func, notify=None):
+        """
+        Creates a job, the caller is responsible for running it.
+
+        :param description: what the job does
+        :param func: callable returning a (success, message) tuple
+        :param notify: callable called with the job once it is finished
+
+        :returns: Job instance
+        """
+
+        with self._lock:
+            job = Job(str(next(self._ids)), description, func, notify)
+            self._jobs[job.id] = job
+            if len(self._jobs) > self._history:
+                for job_id, old_job in list(self._jobs.items()):
+                    if len(self._jobs) <= self._history:
+                        break
+                    if old_job.finished:
+                        del self._jobs[job_id]
+            return job
+
+    def get(self, job_id):
+        """
+        Returns a job.
+
+        :param job_id: job identifier
+
+        :returns: Job instance or None
+        """
+
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        """
+        Returns a snapshot of the known jobs.
+
+        :returns: list of Job instances
+        """
+
+        with self._lock:
+            return list(self._jobs.values())
@@ -0,0 +1,608 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of the VirtualBox machine states and catalogue.
+
+The states and the catalogue of registered machines are kept current
+by a passive VirtualBox event listener so they can be read without
+a COM/XPCOM round trip. An event source
+delivers (kind, machine ID, value) events to a callback:
+VirtualBoxEventSource listens to VirtualBox and FakeEventSource lets
+the cache be driven without VirtualBox.
+"""
+
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+# event kinds
+MACHINE_STATE_CHANGED = "machine_state"
+SESSION_STATE_CHANGED = "session_state"
+MACHINE_REGISTERED = "registered"
+MACHINE_DATA_CHANGED = "data_changed"
+SOURCE_STOPPED = "stopped"
+
+
+class MachineEntry(object):
+    """
+    Cached state of one machine.
+    """
+
+    __slots__ = ("id", "name", "state", "session_state", "updated")
+
+    def __init__(self, machine_id, name=None, state=None, session_state=None):
+
+        self.id = machine_id
+        self.name = name
+        self.state = state
+        self.session_state = session_state
+        self.updated = time.time()
+
+
+class MachineInfo(object):
+    """
+    Catalogue entry of one machine.
+    """
+
+    __slots__ = ("id", "name", "ostype", "nics", "chipset")
+
+    def __init__(self, machine_id, name, ostype, nics, chipset):
+
+        self.id = machine_id
+        self.name = name
+        self.ostype = ostype
+        self.nics = nics
+        self.chipset = chipset
+
+
+def read_machine_info(vboxmanager, machine, chipset_names=None):
+    """
+    Reads the catalogue entry of a machine from VirtualBox.
+
+    :param vboxmanager: VirtualBoxManager instance
+    :param machine: IMachine instance
+    :param chipset_names: {value: name} dictionary of the chipset types
+
+    :returns: MachineInfo instance
+    """
+
+    chipset = machine.chipsetType
+    nics = vboxmanager.vbox.systemProperties.getMaxNetworkAdapters(chipset)
+    if chipset_names:
+        chipset = chipset_names.get(chipset, chipset)
+    return MachineInfo(machine.id, machine.name, machine.OSTypeId, nics, str(chipset))
+
+
+def enum_names(vboxmanager, enum):
+    """
+    Returns the names of the values of a VirtualBox enumeration.
+
+    :param vboxmanager: VirtualBoxManager instance
+    :param enum: enumeration name
+
+    :returns: {value: name} dictionary, empty if the
+    vboxapi version cannot enumerate the constants
+    """
+
+    try:
+        values = vboxmanager.constants.all_values(enum)
+    except Exception:
+        return {}
+    # skip the FirstOnline/LastOnline like range aliases
+    return dict((value, name) for name, value in values.items()
+                if not name.startswith(('First', 'Last')))
+
+
+class MachineStateCache(object):
+    """
+    Thread-safe machine states indexed by machine ID and name.
+
+    The cache is only trusted while it is attached to a running event
+    source, readers must go to VirtualBox when it is not live.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_name = {}
+        self._source = None
+        self._live = False
+        self._state_names = {}
+        self._session_state_names = {}
+        # catalogue of the registered machines, None until loaded
+        self._catalogue = None
+        self._stale = set()
+
+    @property
+    def live(self):
+
+        return self._live
+
+    def attach(self, source):
+        """
+        Starts an event source and seeds the cache with its snapshot.
+
+        :param source: event source
+        """
+
+        self._source = source
+        self._state_names, self._session_state_names = source.state_names()
+        source.start(self._on_event)
+        try:
+            machines = source.snapshot()
+        except Exception:
+            self.detach()
+            raise
+        # events received while seeding are newer than the snapshot
+        with self._lock:
+            for machine_id, name, state, session_state in machines:
+                entry = self._entries.get(machine_id)
+                if entry is None:
+                    entry = self._entries[machine_id] = MachineEntry(machine_id, None, state, session_state)
+                self._set_name(entry, name)
+            self._live = True
+        log.info("machine state cache attached, {} machines known".format(len(self._entries)))
+
+    def detach(self):
+        """
+        Stops the event source and forgets the cached states.
+        """
+
+        source = self._source
+        self._source = None
+        self._invalidate_all()
+        if source is not None:
+            source.stop()
+
+    def _invalidate_all(self):
+
+        with self._lock:
+            self._live = False
+            self._entries.clear()
+            self._by_name.clear()
+            self._catalogue = None
+            self._stale.clear()
+
+    def _set_name(self, entry, name):
+
+        if name is None or entry.name == name:
+            return
+        if entry.name is not None and self._by_name.get(entry.name) is entry:
+            del self._by_name[entry.name]
+        entry.name = name
+        self._by_name[name] = entry
+
+    def _on_event(self, kind, machine_id, value):
+
+        if kind == SOURCE_STOPPED:
+            if self._live:
+                log.warning("machine state events stopped, reading states from VirtualBox")
+            self._invalidate_all()
+            return
+        with self._lock:
+            if kind == MACHINE_REGISTERED:
+                self._on_registered(machine_id, value)
+                return
+            if kind == MACHINE_DATA_CHANGED:
+                # the name, OS type or chipset may have changed
+                if self._catalogue is not None:
+                    self._stale.add(machine_id)
+                return
+            entry = self._entries.get(machine_id)
+            if entry is None:
+                entry = self._entries[machine_id] = MachineEntry(machine_id)
+            if kind == MACHINE_STATE_CHANGED:
+                entry.state = value
+            elif kind == SESSION_STATE_CHANGED:
+                entry.session_state = value
+            entry.updated = time.time()
+
+    def _on_registered(self, machine_id, registered):
+
+        if registered:
+            if self._catalogue is not None:
+                self._stale.add(machine_id)
+            return
+        entry = self._entries.pop(machine_id, None)
+        if entry is not None and entry.name is not None and self._by_name.get(entry.name) is entry:
+            del self._by_name[entry.name]
+        if self._catalogue is not None:
+            self._catalogue.pop(machine_id, None)
+        self._stale.discard(machine_id)
+
+    def machines(self):
+        """
+        Returns the catalogue of the registered machines, only the
+        machines registered or changed since the last call are read
+        from VirtualBox.
+
+        :returns: list of (MachineInfo, MachineEntry) tuples sorted
+        by machine name, None if the cache is not live
+        """
+
+        if not self._live:
+            return None
+        with self._lock:
+            source = self._source
+            catalogue = self._catalogue
+            stale = list(self._stale)
+            self._stale.clear()
+        try:
+            if catalogue is None:
+                catalogue = dict((info.id, info) for info in source.describe())
+            elif stale:
+                catalogue = dict(catalogue)
+                for info in source.describe(stale):
+                    catalogue[info.id] = info
+        except Exception:
+            with self._lock:
+                self._stale.update(stale)
+            raise
+        with self._lock:
+            if not self._live:
+                return None
+            self._catalogue = catalogue
+            machines = []
+            for info in catalogue.values():
+                entry = self._entries.get(info.id)
+                if entry is None:
+                    entry = self._entries[info.id] = MachineEntry(info.id)
+                self._set_name(entry, info.name)
+                machines.append((info, entry))
+        machines.sort(key=lambda machine: machine[0].name)
+        return machines
+
+    def update(self, machine_id, name=None, state=None, session_state=None):
+        """
+        Records what has been read from VirtualBox, does nothing
+        if the cache is not live.
+
+        :param machine_id: machine ID
+        :param name: machine name
+        :param state: machine state
+        :param session_state: session state
+        """
+
+        with self._lock:
+            if not self._live:
+                return
+            entry = self._entries.get(machine_id)
+            if entry is None:
+                entry = self._entries[machine_id] = MachineEntry(machine_id)
+            self._set_name(entry, name)
+            if state is not None:
+                entry.state = state
+            if session_state is not None:
+                entry.session_state = session_state
+            entry.updated = time.time()
+
+    def invalidate(self, machine_id):
+        """
+        Forgets the state of a machine, for instance after changing
+        it, until it is read again or an event is received.
+
+        :param machine_id: machine ID
+        """
+
+        with self._lock:
+            entry = self._entries.get(machine_id)
+            if entry is not None:
+                entry.state = None
+
+    def state(self, machine_id):
+        """
+        Returns the cached state of a machine.
+
+        :param machine_id: machine ID
+
+        :returns: machine state or None if unknown
+        """
+
+        if not self._live:
+            return None
+        entry = self._entries.get(machine_id)
+        if entry is None:
+            return None
+        return entry.state
+
+    def describe(self, entry):
+        """
+        Returns the state names of an entry.
+
+        :param entry: MachineEntry instance
+
+        :returns: (state, session state) tuple of names
+        """
+
+        def describe(names, value):
+            if value is None:
+                return "unknown"
+            return names.get(value, str(value))
+
+        return (describe(self._state_names, entry.state),
+                describe(self._session_state_names, entry.session_state))
+
+    def find(self, name):
+        """
+        Returns the cached entry of a machine.
+
+        :param name: machine name
+
+        :returns: MachineEntry instance or None if unknown
+        """
+
+        if not self._live:
+            return None
+        return self._by_name.get(name)
+
+    def lookup(self, name, read=None):
+        """
+        Returns the entry of a machine, read from VirtualBox when the
+        cache does not know it, for instance when it has been registered
+        since the cache was seeded, or does not know its state.
+
+        :param name: machine name
+        :param read: function returning the (machine ID, state, session
+        state) of a machine name read from VirtualBox, None to only look
+        in the cache
+
+        :returns: MachineEntry instance or None if unknown
+        """
+
+        entry = self.find(name)
+        if read is None or (entry is not None and entry.state is not None):
+            return entry
+        try:
+            machine_id, state, session_state = read(name)
+        except Exception as e:
+            log.debug("cannot read the state of {}: {}".format(name, e))
+            return entry
+        self.update(machine_id, name, state, session_state)
+        return MachineEntry(machine_id, name, state, session_state)
+
+
+class VirtualBoxEventSource(object):
+    """
+    Passive VirtualBox event listener polled by a daemon thread.
+
+    :param vboxmanager: VirtualBoxManager instance
+    :param poll_timeout: milliseconds to wait for an event on each poll
+    """
+
+    def __init__(self, vboxmanager, poll_timeout=500):
+
+        self._vboxmanager = vboxmanager
+        self._poll_timeout = poll_timeout
+        self._callback = None
+        self._thread = None
+        self._alive = False
+        self._ready = threading.Event()
+        self._error = None
+        self._chipset_names = None
+
+    @property
+    def running(self):
+
+        return self._alive
+
+    def start(self, callback):
+        """
+        Registers the listener and starts delivering events.
+
+        :param callback: called with (kind, machine ID, value)
+        """
+
+        self._callback = callback
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, name="vbox-events")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        # events must not be missed between the snapshot and the listener registration
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        """
+        Stops delivering events.
+        """
+
+        self._alive = False
+        if self._thread is not None:
+            self._thread.join(self._poll_timeout / 1000.0 + 1)
+            self._thread = None
+
+    def state_names(self):
+        """
+        Returns the names of the machine and session states.
+
+        :returns: tuple of {value: name} dictionaries
+        """
+
+        return (enum_names(self._vboxmanager, 'MachineState'),
+                enum_names(self._vboxmanager, 'SessionState'))
+
+    def snapshot(self):
+        """
+        Reads the state of every registered machine.
+
+        :returns: list of (machine ID, name, state, session state) tuples
+        """
+
+        machines = []
+        for machine in self._vboxmanager.getArray(self._vboxmanager.vbox, 'machines'):
+            try:
+                machines.append((machine.id, machine.name, machine.state, machine.sessionState))
+            except Exception as e:
+                # inaccessible machines have no state
+                log.debug("cannot read the state of a machine: {}".format(e))
+        return machines
+
+    def describe(self, machine_ids=None):
+        """
+        Reads the catalogue entries of machines.
+
+        :param machine_ids: IDs of the machines to read, all
+        the registered machines if None
+
+        :returns: list of MachineInfo instances
+        """
+
+        vbox = self._vboxmanager.vbox
+        if machine_ids is None:
+            machines = self._vboxmanager.getArray(vbox, 'machines')
+        else:
+            machines = []
+            for machine_id in machine_ids:
+                try:
+                    machines.append(vbox.findMachine(machine_id))
+                except Exception:
+                    # unregistered since
+                    pass
+        if self._chipset_names is None:
+            self._chipset_names = enum_names(self._vboxmanager, 'ChipsetType')
+        infos = []
+        for machine in machines:
+            try:
+                infos.append(read_machine_info(self._vboxmanager, machine, self._chipset_names))
+            except Exception as e:
+                # inaccessible machines have no settings
+                log.debug("cannot read the settings of a machine: {}".format(e))
+        return infos
+
+    def _run(self):
+
+        manager = self._vboxmanager
+        constants = manager.constants
+        try:
+            manager.initPerThread()
+            try:
+                vbox = manager.getVirtualBox()
+            except Exception:
+                vbox = manager.vbox
+            event_source = vbox.eventSource
+            listener = event_source.createListener()
+            event_source.registerListener(listener,
+                                          [constants.VBoxEventType_OnMachineStateChanged,
+                                           constants.VBoxEventType_OnSessionStateChanged,
+                                           constants.VBoxEventType_OnMachineRegistered,
+                                           constants.VBoxEventType_OnMachineDataChanged],
+                                          False)
+        except Exception as e:
+            self._alive = False
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        try:
+            while self._alive:
+                event = event_source.getEvent(listener, self._poll_timeout)
+                if event is None:
+                    continue
+                try:
+                    if event.type == constants.VBoxEventType_OnMachineStateChanged:
+                        event = manager.queryInterface(event, 'IMachineStateChangedEvent')
+                        self._callback(MACHINE_STATE_CHANGED, event.machineId, event.state)
+                    elif event.type == constants.VBoxEventType_OnSessionStateChanged:
+                        event = manager.queryInterface(event, 'ISessionStateChangedEvent')
+                        self._callback(SESSION_STATE_CHANGED, event.machineId, event.state)
+                    elif event.type == constants.VBoxEventType_OnMachineRegistered:
+                        event = manager.queryInterface(event, 'IMachineRegisteredEvent')
+                        self._callback(MACHINE_REGISTERED, event.machineId, event.registered)
+                    elif event.type == constants.VBoxEventType_OnMachineDataChanged:
+                        event = manager.queryInterface(event, 'IMachineDataChangedEvent')
+                        self._callback(MACHINE_DATA_CHANGED, event.machineId, None)
+                finally:
+                    event_source.eventProcessed(listener, event)
+        except Exception as e:
+            log.error("VirtualBox event listener error: {}".format(e))
+        finally:
+            self._alive = False
+            try:
+                event_source.unregisterListener(listener)
+            except Exception:
+                pass
+            self._callback(SOURCE_STOPPED, None, None)
+            try:
+                manager.deinitPerThread()
+            except Exception:
+                pass
+
+
+class FakeEventSource(object):
+    """
+    Event source driven by hand, to use the cache without VirtualBox.
+
+    :param machines: list of (machine ID, name, state, session state)
+    tuples returned as the snapshot
+    :param infos: list of MachineInfo instances describing the machines
+    """
+
+    def __init__(self, machines=(), infos=()):
+
+        self.machines = list(machines)
+        self.infos = list(infos)
+        self.describe_calls = 0
+        self._callback = None
+
+    @property
+    def running(self):
+
+        return self._callback is not None
+
+    def start(self, callback):
+
+        self._callback = callback
+
+    def stop(self):
+
+        callback = self._callback
+        self._callback = None
+        if callback is not None:
+            callback(SOURCE_STOPPED, None, None)
+
+    def state_names(self):
+
+        return {}, {}
+
+    def snapshot(self):
+
+        return list(self.machines)
+
+    def describe(self, machine_ids=None):
+
+        self.describe_calls += 1
+        if machine_ids is None:
+            return list(self.infos)
+        return [info for info in self.infos if info.id in machine_ids]
+
+    def emit(self, kind, machine_id, value):
+        """
+        Delivers an event as VirtualBox would.
+
+        :param kind: event kind
+        :param machine_id: machine ID
+        :param value: new state
+        """
+
+        if self._callback is not None:
+            self._callback(kind, machine_id, value)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Readiness notification using the best mechanism available on the host
+(epoll, poll or select) and a wakeup channel to interrupt a blocked poll.
+"""
+
+import errno
+import select
+import socket
+
+READ = 1
+WRITE = 2
+
+
+class Poller(object):
+    """
+    Watches file descriptors for readiness.
+
+    Events are reported as (fd, mask) tuples where mask is
+    a combination of READ and WRITE. Errors and hang-ups are
+    reported as READ so the owner notices them on its next recv().
+    """
+
+    def __init__(self):
+
+        self._fds = {}
+        if hasattr(select, "epoll"):
+            self._impl = "epoll"
+            self._epoll = select.epoll()
+        elif hasattr(select, "poll"):
+            self._impl = "poll"
+            self._poll = select.poll()
+        else:
+            self._impl = "select"
+
+    @property
+    def implementation(self):
+
+        return self._impl
+
+    def _native_mask(self, mask):
+
+        if self._impl == "epoll":
+            native = 0
+            if mask & READ:
+                native |= select.EPOLLIN
+            if mask & WRITE:
+                native |= select.EPOLLOUT
+            return native
+        native = 0
+        if mask & READ:
+            native |= select.POLLIN
+        if mask & WRITE:
+            native |= select.POLLOUT
+        return native
+
+    def register(self, fd, mask):
+        """
+        Starts watching a file descriptor.
+
+        :param fd: file descriptor
+        :param mask: READ and/or WRITE
+        """
+
+        self._fds[fd] = mask
+        if self._impl == "epoll":
+            self._epoll.register(fd, self._native_mask(mask))
+        elif self._impl == "poll":
+            self._poll.register(fd, self._native_mask(mask))
+
+    def modify(self, fd, mask):
+        """
+        Changes the events watched on a file descriptor.
+
+        :param fd: file descriptor
+        :param mask: READ and/or WRITE
+        """
+
+        if self._fds.get(fd) == mask:
+            return
+        self._fds[fd] = mask
+        if self._impl == "epoll":
+            self._epoll.modify(fd, self._native_mask(mask))
+        elif self._impl == "poll":
+            self._poll.modify(fd, self._native_mask(mask))
+
+    def unregister(self, fd):
+        """
+        Stops watching a file descriptor.
+
+        :param fd: file descriptor
+        """
+
+        if fd not in self._fds:
+            return
+        del self._fds[fd]
+        try:
+            if self._impl == "epoll":
+                self._epoll.unregister(fd)
+            elif self._impl == "poll":
+                self._poll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # the descriptor may already be closed
+            pass
+
+    def poll(self, timeout=None):
+        """
+        Waits for events.
+
+        :param timeout: timeout in seconds (None waits forever)
+
+        :returns: list of (fd, mask) tuples
+        """
+
+        try:
+            if self._impl == "epoll":
+                if timeout is None:
+                    timeout = -1
+                events = self._epoll.poll(timeout)
+                return [(fd, self._from_native(event, select.EPOLLIN, select.EPOLLOUT,
+                                               select.EPOLLERR | select.EPOLLHUP)) for fd, event in events]
+            if self._impl == "poll":
+                if timeout is not None:
+                    timeout *= 1000
+                events = self._poll.poll(timeout)
+                return [(fd, self._from_native(event, select.POLLIN, select.POLLOUT,
+                                               select.POLLERR | select.POLLHUP | select.POLLNVAL)) for fd, event in events]
+            rlist = [fd for fd, mask in self._fds.items() if mask & READ]
+            wlist = [fd for fd, mask in self._fds.items() if mask & WRITE]
+            rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
+            events = dict((fd, READ) for fd in rlist)
+            for fd in wlist:
+                events[fd] = events.get(fd, 0) | WRITE
+            return events.items()
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    @staticmethod
+    def _from_native(event, readable, writable, error):
+
+        mask = 0
+        if event & (readable | error):
+            mask |= READ
+        if event & writable:
+            mask |= WRITE
+        return mask
+
+    def close(self):
+
+        if self._impl == "epoll":
+            self._epoll.close()
+        self._fds.clear()
+
+
+class Waker(object):
+    """
+    Self-pipe used to wake up a thread blocked in Poller.poll().
+    """
+
+    def __init__(self):
+
+        if hasattr(socket, "socketpair"):
+            self._reader, self._writer = socket.socketpair()
+        else:
+            # Windows has no socketpair(), connect two sockets over the loopback
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            self._writer = socket.create_connection(listener.getsockname())
+            self._reader, _ = listener.accept()
+            listener.close()
+        self._reader.setblocking(0)
+        self._writer.setblocking(0)
+
+    def fileno(self):
+
+        return self._reader.fileno()
+
+    def wake(self):
+        """
+        Wakes up the poller, can be called from any thread.
+        """
+
+        try:
+            self._writer.send(b"x")
+        except socket.error:
+            # the pipe is full, a wakeup is already pending
+            pass
+
+    def drain(self):
+        """
+        Consumes pending wakeups.
+        """
+
+        try:
+            while self._reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+
+        self._reader.close()
+        self._writer.close()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Retry policies for the VirtualBox API calls failing on busy hosts.
+
+A policy retries a call with an exponential backoff starting at a few
+milliseconds, randomized by a jitter, until the call succeeds, the error
+is not worth retrying, the attempts are exhausted or a deadline is
+reached. Deadlines are either per operation (the policy deadline) or per
+command: a command handler sets a deadline with the deadline() context
+manager and all the retries made by the command stop at this deadline.
+"""
+
+import contextlib
+import random
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+# COM/XPCOM result codes of transient errors
+TRANSIENT_ERRORS = frozenset([
+    0x80070005,  # E_ACCESSDENIED, "The object is not ready"
+    0x80BB0002,  # VBOX_E_INVALID_VM_STATE
+    0x80BB0007,  # VBOX_E_INVALID_OBJECT_STATE
+    0x80BB000B,  # VBOX_E_INVALID_SESSION_STATE
+    0x80BB000C,  # VBOX_E_OBJECT_IN_USE
+    0x80010001,  # RPC_E_CALL_REJECTED
+    0x8001010A,  # RPC_E_SERVERCALL_RETRYLATER
+    ])
+
+# COM/XPCOM result codes of errors a retry cannot fix
+PERMANENT_ERRORS = frozenset([
+    0x80070057,  # E_INVALIDARG
+    0x80BB0001,  # VBOX_E_OBJECT_NOT_FOUND
+    0x80BB0009,  # VBOX_E_NOT_SUPPORTED
+    0x80BB000A,  # VBOX_E_XML_ERROR
+    ])
+
+TRANSIENT_MESSAGES = (
+    "not ready",
+    "is already locked",
+    "busy",
+    )
+
+_local = threading.local()
+_policies = []
+_policies_lock = threading.Lock()
+
+
+def error_code(exception):
+    """
+    Returns the COM/XPCOM result code of an exception.
+
+    :param exception: exception raised by the VirtualBox API
+
+    :returns: unsigned 32-bit result code or None
+    """
+
+    for attribute in ("hresult", "errno"):
+        code = getattr(exception, attribute, None)
+        if isinstance(code, (int, long)):
+            return code & 0xFFFFFFFF
+    args = getattr(exception, "args", ())
+    if args and isinstance(args[0], (int, long)):
+        return args[0] & 0xFFFFFFFF
+    return None
+
+
+def is_retryable(exception):
+    """
+    Classifies an exception raised by the VirtualBox API.
+
+    :param exception: exception
+
+    :returns: False if retrying cannot help, True otherwise
+    """
+
+    code = error_code(exception)
+    if code in TRANSIENT_ERRORS:
+        return True
+    if code in PERMANENT_ERRORS:
+        return False
+    message = str(exception).lower()
+    for transient_message in TRANSIENT_MESSAGES:
+        if transient_message in message:
+            return True
+    # unknown errors used to be retried, keep doing so
+    return True
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Sets a deadline for all the retries made by the current thread,
+    nested deadlines cannot extend the enclosing one.
+
+    :param seconds: seconds from now
+    """
+
+    previous = getattr(_local, "deadline", None)
+    end = time.time() + seconds
+    if previous is not None:
+        end = min(end, previous)
+    _local.deadline = end
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+class RetryError(Exception):
+    """
+    Raised when a call has failed for good.
+
+    :param description: what the call does
+    :param attempts: number of attempts
+    :param last_exception: exception raised by the last attempt
+    :param reason: "attempts", "deadline" or "not retryable"
+    """
+
+    def __init__(self, description, attempts, last_exception, reason):
+
+        Exception.__init__(self, "Could not {} after {} attempts ({}): {}".format(description, attempts, reason, last_exception))
+        self.attempts = attempts
+        self.last_exception = last_exception
+        self.reason = reason
+
+
+class RetryMetrics(object):
+    """
+    Counters of a retry policy.
+    """
+
+    counters = ("calls", "attempts", "retries", "failures", "deadline_exceeded", "not_retryable")
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        with self._lock:
+            self.values = dict.fromkeys(self.counters, 0)
+            self.wait_time = 0.0
+
+    def record(self, attempts, wait_time, reason=None):
+
+        with self._lock:
+            self.values["calls"] += 1
+            self.values["attempts"] += attempts
+            self.values["retries"] += attempts - 1
+            self.wait_time += wait_time
+            if reason is not None:
+                self.values["failures"] += 1
+                if reason == "deadline":
+                    self.values["deadline_exceeded"] += 1
+                elif reason == "not retryable":
+                    self.values["not_retryable"] += 1
+
+    def snapshot(self):
+        """
+        Returns the counters.
+
+        :returns: list of (name, value) tuples
+        """
+
+        with self._lock:
+            snapshot = [(name, self.values[name]) for name in self.counters]
+            snapshot.append(("wait_time", "%.3f" % self.wait_time))
+            return snapshot
+
+
+class RetryPolicy(object):
+    """
+    Retries failing calls with an exponential backoff.
+
+    :param name: policy name, used in the metrics
+    :param attempts: maximum number of attempts
+    :param initial_delay: seconds to wait before the first retry
+    :param max_delay: maximum seconds to wait between two attempts
+    :param multiplier: delay growth factor
+    :param jitter: fraction of the delay randomly removed, from 0 to 1
+    :param deadline: maximum seconds spent in one call, None for no limit
+    :param retryable: function classifying the exceptions
+    """
+
+    def __init__(self, name, attempts=10, initial_delay=0.005, max_delay=1.0, multiplier=2.0,
+                 jitter=0.5, deadline=None, retryable=is_retryable):
+
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retryable = retryable
+        self.metrics = RetryMetrics()
+        self._random = random.Random()
+        self._sleep = time.sleep
+        with _policies_lock:
+            _policies.append(self)
+
+    def delays(self):
+        """
+        Yields the successive delays between attempts.
+        """
+
+        delay = self.initial_delay
+        while True:
+            yield delay * (1.0 - self.jitter * self._random.random())
+            delay = min(delay * self.multiplier, self.max_delay)
+
+    def run(self, description, func, *args):
+        """
+        Calls a function until it succeeds.
+
+        :param description: what the call does, for the logs and errors
+        :param func: function to call
+        :param args: function arguments
+
+        :returns: what the function returns
+        """
+
+        start = time.time()
+        end = getattr(_local, "deadline", None)
+        if self.deadline is not None:
+            end = min(end, start + self.deadline) if end is not None else start + self.deadline
+        wait_time = 0.0
+        delays = self.delays()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(*args)
+            except Exception as e:
+                reason = None
+                if not self.retryable(e):
+                    reason = "not retryable"
+                elif attempt >= self.attempts:
+                    reason = "attempts"
+                else:
+                    delay = next(delays)
+                    if end is not None and time.time() + delay > end:
+                        reason = "deadline"
+                if reason is not None:
+                    self.metrics.record(attempt, wait_time, reason)
+                    raise RetryError(description, attempt, e, reason)
+                log.warn("cannot {}, retrying {}: {}".format(description, attempt, e))
+                self._sleep(delay)
+                wait_time += delay
+                continue
+            self.metrics.record(attempt, wait_time)
+            return result
+
+
+def metrics():
+    """
+    Returns the metrics of all the retry policies.
+
+    :returns: list of (name, value) tuples
+    """
+
+    with _policies_lock:
+        policies = list(_policies)
+    snapshot = []
+    for policy in policies:
+        for name, value in policy.metrics.snapshot():
+            snapshot.append(("retry.{}.{}".format(policy.name, name), value))
+    return snapshot
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scrollback of the serial consoles.
+
+The last bytes printed by a VM are kept in a ring buffer allocated once,
+the output is copied into it without creating new strings. It is
+replayed to the Telnet clients when they connect and can be read with
+the console_tail command.
+
+The console_wait command waits for a line of output matching a regular
+expression. The output is searched as it is appended, one search per
+waiter for each chunk of output, and only the unfinished line is
+searched again when more output completes it. A waiter can also skip
+the output written before a given point, the console_send command
+only looks at the output following what it sent.
+"""
+
+import re
+import threading
+
+# longest unfinished line searched by the waiters
+MAX_LINE = 4096
+
+# control characters removed from the console output sent in replies
+CONTROL_CHARACTERS = "".join(chr(c) for c in range(32) if chr(c) != "\t") + chr(127)
+
+
+def printable(line):
+    """
+    Removes the control characters of a line of console output,
+    including the carriage returns and the escape sequence introducers.
+
+    :param line: string
+
+    :returns: string
+    """
+
+    return line.translate(None, CONTROL_CHARACTERS)
+
+
+class _Waiter(object):
+
+    def __init__(self, regex, since=None):
+
+        self.regex = regex
+        self.since = since
+        self.line = None
+        self.event = threading.Event()
+
+
+class Scrollback(object):
+    """
+    Fixed-size ring buffer of console output.
+
+    :param size: number of bytes kept, 0 keeps nothing
+    """
+
+    def __init__(self, size):
+
+        self._size = max(0, size)
+        self._buffer = bytearray(self._size)
+        self._lock = threading.Lock()
+        self._end = 0       # where the next byte is written
+        self._length = 0    # number of bytes kept
+        self._written = 0   # number of bytes appended so far
+        self._waiters = []
+        self._line = ""     # unfinished line, only kept while waited on
+
+    @property
+    def size(self):
+
+        return self._size
+
+    @property
+    def written(self):
+
+        return self._written
+
+    def append(self, data):
+        """
+        Adds console output.
+
+        :param data: string
+        """
+
+        with self._lock:
+            self._written += len(data)
+            if self._waiters:
+                self._match(data)
+            if not self._size:
+                return
+            view = memoryview(data)
+            if len(view) > self._size:
+                view = view[len(view) - self._size:]
+            count = len(view)
+            first = min(count, self._size - self._end)
+            self._buffer[self._end:self._end + first] = view[:first]
+            if first < count:
+                self._buffer[:count - first] = view[first:]
+            self._end = (self._end + count) % self._size
+            self._length = min(self._size, self._length + count)
+
+    def _match(self, data):
+        """
+        Searches the new lines of output for the waiters.
+        """
+
+        text = self._line + data
+        offset = self._written - len(text)
+        for waiter in list(self._waiters):
+            line = self._search(waiter, text, offset)
+            if line is not None:
+                waiter.line = line
+                self._waiters.remove(waiter)
+                waiter.event.set()
+        self._line = text[text.rfind("\n") + 1:][-MAX_LINE:]
+
+    def _search(self, waiter, text, offset):
+        """
+        Searches output for a waiter.
+
+        :param waiter: _Waiter instance
+        :param text: output
+        :param offset: number of bytes written before the output
+
+        :returns: matching line or None
+        """
+
+        position = 0
+        if waiter.since is not None:
+            position = max(0, waiter.since - offset)
+        match = waiter.regex.search(text, position)
+        if not match:
+            return None
+        start = text.rfind("\n", 0, match.start()) + 1
+        end = text.find("\n", match.end())
+        return text[start:end] if end >= 0 else text[start:]
+
+    def tail(self, count=None):
+        """
+        Returns the last console output.
+
+        :param count: maximum number of bytes, all the kept ones by default
+
+        :returns: string
+        """
+
+        with self._lock:
+            return self._tail(count)
+
+    def _tail(self, count):
+
+        if count is None or count > self._length:
+            count = self._length
+        if count <= 0:
+            return ""
+        start = (self._end - count) % self._size
+        if start < self._end:
+            return str(self._buffer[start:self._end])
+        return str(self._buffer[start:]) + str(self._buffer[:self._end])
+
+    def wait(self, pattern, timeout=None, since=None):
+        """
+        Waits for a line of output matching a regular expression, the
+        output is searched from the start of the current line.
+        ^ and $ match at the start and end of each line.
+
+        :param pattern: regular expression
+        :param timeout: timeout in seconds (None waits forever)
+        :param since: number of bytes written (see written) before the
+        output searched, the output still kept after it is searched too
+
+        :returns: matching line or None on timeout
+        """
+
+        waiter = _Waiter(re.compile(pattern, re.MULTILINE), since)
+        with self._lock:
+            if not self._waiters:
+                # the unfinished line is only tracked while there are waiters
+                self._line = self._tail(MAX_LINE).rpartition("\n")[2]
+            if since is None:
+                text = self._line
+            else:
+                # with the start of the line the output begins in
+                text = self._tail(self._written - since + MAX_LINE)
+            line = self._search(waiter, text, self._written - len(text))
+            if line is not None:
+                return line
+            self._waiters.append(waiter)
+        try:
+            waiter.event.wait(timeout)
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return waiter.line
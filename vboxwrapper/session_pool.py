@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pool of VirtualBox session objects shared by the controllers.
+
+Creating a session object is a round trip to VirtualBox which fails on
+heavily loaded hosts. The pool keeps unlocked sessions ready to be used,
+checks they are still healthy before handing them out and recycles the
+sessions released by the controllers.
+"""
+
+import collections
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SessionPool(object):
+    """
+    Pool of idle session objects.
+
+    :param factory: function creating a session object
+    :param validate: function returning True if a session can be used
+    :param size: number of idle sessions to keep ready
+    :param prefill: create the idle sessions in a background thread
+    """
+
+    def __init__(self, factory, validate, size=4, prefill=True):
+
+        self._factory = factory
+        self._validate = validate
+        self._size = max(0, size)
+        self._prefill = prefill and self._size > 0
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._refill = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._metrics = dict.fromkeys(("hits", "misses", "created", "recycled", "discarded", "errors"), 0)
+        self._wait_time = 0.0
+
+    @property
+    def size(self):
+
+        return self._size
+
+    def start(self):
+        """
+        Starts creating the idle sessions in the background.
+        """
+
+        if not self._prefill or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="session-pool")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._refill.set()
+
+    def close(self):
+        """
+        Stops the background thread and forgets the idle sessions.
+        """
+
+        self._closed = True
+        self._refill.set()
+        with self._lock:
+            self._idle.clear()
+
+    def _count(self, metric, value=1):
+
+        with self._lock:
+            self._metrics[metric] += value
+
+    def _is_healthy(self, session):
+
+        try:
+            return self._validate(session)
+        except Exception as e:
+            log.debug("discarding session: {}".format(e))
+            return False
+
+    def acquire(self):
+        """
+        Returns a session, an idle one if there is a healthy one.
+
+        :returns: session object
+        """
+
+        begin = time.time()
+        try:
+            while True:
+                with self._lock:
+                    session = self._idle.popleft() if self._idle else None
+                if session is None:
+                    break
+                if self._is_healthy(session):
+                    self._count("hits")
+                    return session
+                self._count("discarded")
+            self._count("misses")
+            return self._create()
+        finally:
+            with self._lock:
+                self._wait_time += time.time() - begin
+            if self._prefill:
+                self._refill.set()
+
+    def release(self, session):
+        """
+        Gives a session back to the pool, it is kept if it is
+        healthy and the pool is not full.
+
+        :param session: session object
+        """
+
+        if session is None or self._closed:
+            return
+        if not self._is_healthy(session):
+            self._count("discarded")
+            return
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(session)
+                self._metrics["recycled"] += 1
+                return
+        self._count("discarded")
+
+    def _create(self):
+
+        try:
+            session = self._factory()
+        except Exception:
+            self._count("errors")
+            raise
+        self._count("created")
+        return session
+
+    def _run(self):
+
+        while not self._closed:
+            self._refill.wait()
+            self._refill.clear()
+            while not self._closed:
+                with self._lock:
+                    if len(self._idle) >= self._size:
+                        break
+                try:
+                    session = self._create()
+                except Exception as e:
+                    log.warning("cannot create a session: {}".format(e))
+                    # try again on the next acquire
+                    break
+                with self._lock:
+                    self._idle.append(session)
+
+    def metrics(self):
+        """
+        Returns the pool counters.
+
+        :returns: list of (name, value) tuples
+        """
+
+        with self._lock:
+            snapshot = [("session_pool.{}".format(name), self._metrics[name])
+                        for name in ("hits", "misses", "created", "recycled", "discarded", "errors")]
+            snapshot.append(("session_pool.idle", len(self._idle)))
+            snapshot.append(("session_pool.wait_time", "%.3f" % self._wait_time))
+        return snapshot
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent record of the settings applied to the VirtualBox machines.
+
+For each machine, the settings written by the wrapper are stored with
+the signature (modification time and size) of the machine settings file
+right after they have been saved. The record is only trusted while the
+settings file still has this signature, i.e. nobody else changed it.
+"""
+
+import json
+import os
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def file_signature(path):
+    """
+    Returns the signature of a file.
+
+    :param path: file path
+
+    :returns: [modification time, size] or None if the file cannot be read
+    """
+
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+class SettingsCache(object):
+    """
+    Settings applied to the machines, saved in a JSON file.
+
+    :param path: JSON file path, nothing is saved if None
+    """
+
+    def __init__(self, path=None):
+
+        self._path = path
+        self._lock = threading.Lock()
+        self._machines = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._machines = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                log.warning("cannot read the settings cache {}: {}".format(path, e))
+
+    def load(self, machine_id, signature):
+        """
+        Returns the settings applied to a machine.
+
+        :param machine_id: machine ID
+        :param signature: current signature of the machine settings file
+
+        :returns: dictionary of settings, empty if they are unknown
+        or if the settings file has changed since they were recorded
+        """
+
+        if signature is None:
+            return {}
+        with self._lock:
+            record = self._machines.get(machine_id)
+            if record is None or record["signature"] != signature:
+                return {}
+            return dict(record["applied"])
+
+    def store(self, machine_id, signature, applied):
+        """
+        Records the settings applied to a machine.
+
+        :param machine_id: machine ID
+        :param signature: signature of the machine settings file once saved
+        :param applied: dictionary of settings
+        """
+
+        with self._lock:
+            if signature is None:
+                self._machines.pop(machine_id, None)
+            else:
+                self._machines[machine_id] = {"signature": signature, "applied": dict(applied)}
+            self._save()
+
+    def forget(self, machine_id):
+        """
+        Forgets the settings applied to a machine.
+
+        :param machine_id: machine ID
+        """
+
+        with self._lock:
+            if self._machines.pop(machine_id, None) is not None:
+                self._save()
+
+    def _save(self):
+
+        if not self._path:
+            return
+        temporary_path = self._path + ".tmp"
+        try:
+            directory = os.path.dirname(self._path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temporary_path, "w") as f:
+                json.dump(self._machines, f)
+            if os.name == "nt" and os.path.exists(self._path):
+                # rename does not replace files on Windows
+                os.remove(self._path)
+            os.rename(temporary_path, self._path)
+        except (IOError, OSError) as e:
+            log.warning("cannot save the settings cache {}: {}".format(self._path, e))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parallel shutdown of the VMs.
+
+Stopping the VMs one after the other waits up to 3 seconds for each of
+them to power off. Here each step runs for all the VMs at once: the
+consoles are stopped first, then every VM is asked to power off and
+is waited for, then the adapters are reset by a few VMs at a time since
+this step saves the machine settings. All the steps share one deadline
+and the VMs which have not been stopped in time, or whose stop failed,
+are reported.
+"""
+
+import functools
+import threading
+import time
+
+from worker_pool import WorkerPool
+import retry
+
+import logging
+log = logging.getLogger(__name__)
+
+CONSOLE = "console"
+POWER_DOWN = "power_down"
+WAIT = "wait"
+RESET_ADAPTERS = "reset_adapters"
+
+
+def _run_all(pool, func, names, end):
+    """
+    Calls a function for each name on a worker pool.
+
+    :param pool: WorkerPool instance
+    :param func: function called with a name
+    :param names: names
+    :param end: deadline (time.time() value)
+
+    :returns: set of the names whose call has not returned by the deadline
+    """
+
+    pending = set(names)
+    condition = threading.Condition()
+
+    def done(name):
+        with condition:
+            pending.discard(name)
+            condition.notify_all()
+
+    for name in names:
+        pool.submit(func, (name,), functools.partial(done, name))
+    with condition:
+        while pending:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            condition.wait(remaining)
+        return set(pending)
+
+
+def shutdown(controllers, timeout=30.0, workers=32, batch_size=4):
+    """
+    Stops VMs in parallel.
+
+    :param controllers: dictionary of VirtualBoxController instances by instance name
+    :param timeout: seconds allowed for the whole shutdown
+    :param workers: number of VMs handled at once
+    :param batch_size: number of VMs whose adapters are reset at once
+
+    :returns: tuple of two dictionaries by instance name: the step each VM
+    missing the deadline was in and the step each VM failed to stop at
+    """
+
+    end = time.time() + timeout
+    phases = {}
+    late = {}
+    failed = {}
+    powered_down = set()
+    reset_slots = threading.Semaphore(max(1, batch_size))
+
+    def step(func):
+        def run(name):
+            try:
+                with retry.deadline(max(0.0, end - time.time())):
+                    func(controllers[name], name)
+            except Exception as e:
+                log.warning("could not stop VM for {}: {}".format(name, e))
+                failed[name] = phases[name]
+        return run
+
+    def power_down(controller, name):
+        if controller.power_down():
+            powered_down.add(name)
+
+    def reset(controller, name):
+        # a VM does not wait for the others to be down to reset its adapters
+        controller.wait_powered_down(min(3.0, max(0.0, end - time.time())))
+        phases[name] = RESET_ADAPTERS
+        with reset_slots:
+            controller.reset_adapters()
+
+    def run_step(phase, func, names):
+        for name in names:
+            phases[name] = phase
+        for name in _run_all(pool, step(func), names, end):
+            late[name] = phases[name]
+        return [name for name in names if name not in late and name not in failed]
+
+    pool = WorkerPool(workers, "shutdown")
+    try:
+        names = run_step(CONSOLE, lambda controller, name: controller.stop_console(), sorted(controllers))
+        names = run_step(POWER_DOWN, power_down, names)
+        run_step(WAIT, reset, [name for name in names if name in powered_down])
+    finally:
+        # the late steps keep running in the background
+        pool.shutdown()
+    for name, phase in sorted(late.items()):
+        log.warning("{} has not been stopped in time ({})".format(name, phase))
+    return late, failed
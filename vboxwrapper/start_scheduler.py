@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Admission control for the VM starts.
+
+Starting a whole topology sends many start commands at once, launching
+all the VMs together makes VirtualBox fail with "object is not ready"
+errors and the retries make the total start time longer. The scheduler
+queues the starts in arrival order and runs a limited number of them
+concurrently. The limit grows by one after each successful start and is
+halved after a failure, it is further capped by the free memory and the
+load average of the host.
+"""
+
+import collections
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+
+
+class HostProbe(object):
+    """
+    Samples the free memory and the load of the host.
+
+    :param interval: seconds during which a sample is reused
+    """
+
+    def __init__(self, interval=0.5):
+
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._sampled = 0.0
+        self._sample = (None, None)
+        try:
+            self._cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._cpus = 1
+
+    def _free_memory(self):
+
+        if sys.platform.startswith("linux"):
+            values = {}
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    name, value = line.split(":", 1)
+                    values[name] = int(value.split()[0])
+            if "MemAvailable" in values:
+                return values["MemAvailable"] // 1024
+            return (values["MemFree"] + values.get("Buffers", 0) + values.get("Cached", 0)) // 1024
+        if sys.platform.startswith("win"):
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong),
+                            ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong),
+                            ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong),
+                            ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong),
+                            ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys // (1024 * 1024)
+        return None
+
+    def _load(self):
+
+        if not hasattr(os, "getloadavg"):
+            return None
+        return os.getloadavg()[0] / self._cpus
+
+    def sample(self):
+        """
+        Returns the free memory and the load of the host.
+
+        :returns: (free memory in MB, 1 minute load average per CPU),
+        None for the values that cannot be measured on this platform
+        """
+
+        with self._lock:
+            now = time.time()
+            if now - self._sampled >= self._interval:
+                try:
+                    free_memory = self._free_memory()
+                except Exception as e:
+                    log.debug("cannot read the free memory: {}".format(e))
+                    free_memory = None
+                try:
+                    load = self._load()
+                except OSError:
+                    load = None
+                self._sample = (free_memory, load)
+                self._sampled = now
+            return self._sample
+
+
+class StartScheduler(object):
+    """
+    Runs the starts in arrival order with an adaptive concurrency limit.
+
+    :param max_concurrency: maximum number of concurrent starts
+    :param memory_reserve: free memory in MB needed by each concurrent start
+    :param max_load: load average per CPU above which starts run one at a time
+    :param probe: HostProbe instance
+    """
+
+    # seconds a start is expected to last before any has been measured
+    default_duration = 5.0
+
+    def __init__(self, max_concurrency=4, memory_reserve=256, max_load=2.0, probe=None):
+
+        self._max_concurrency = max(1, max_concurrency)
+        self._memory_reserve = memory_reserve
+        self._max_load = max_load
+        self._probe = probe or HostProbe()
+        self._condition = threading.Condition()
+        self._limit = self._max_concurrency
+        self._queue = collections.deque()
+        self._running = collections.OrderedDict()
+        self._durations = collections.deque(maxlen=16)
+        self._metrics = dict.fromkeys(("starts", "failures", "throttled"), 0)
+        self._wait_time = 0.0
+
+    def configure(self, max_concurrency=None, memory_reserve=None, max_load=None):
+        """
+        Changes the scheduler settings.
+        """
+
+        with self._condition:
+            if max_concurrency is not None:
+                self._max_concurrency = max(1, max_concurrency)
+                self._limit = min(self._limit, self._max_concurrency)
+            if memory_reserve is not None:
+                self._memory_reserve = memory_reserve
+            if max_load is not None:
+                self._max_load = max_load
+            self._condition.notify_all()
+
+    def _allowed(self):
+        """
+        Returns how many starts can run concurrently right now.
+        """
+
+        allowed = self._limit
+        free_memory, load = self._probe.sample()
+        if free_memory is not None and self._memory_reserve:
+            allowed = min(allowed, free_memory // self._memory_reserve)
+        if load is not None and load > self._max_load:
+            allowed = min(allowed, 1)
+        # one start at a time is always possible
+        return max(1, allowed)
+
+    def run(self, name, func):
+        """
+        Waits for its turn then runs a start.
+
+        :param name: instance name
+        :param func: function starting the instance, returning True on success
+
+        :returns: what the function returns
+        """
+
+        begin = time.time()
+        throttled = False
+        with self._condition:
+            self._queue.append(name)
+            try:
+                while True:
+                    if self._queue[0] == name:
+                        allowed = self._allowed()
+                        if len(self._running) < allowed:
+                            break
+                        if allowed < self._limit and not throttled:
+                            # held back by the host rather than by failures
+                            throttled = True
+                            self._metrics["throttled"] += 1
+                    # the host is sampled again on timeout
+                    self._condition.wait(0.5)
+            finally:
+                self._queue.remove(name)
+                self._condition.notify_all()
+            started = time.time()
+            self._running[name] = started
+            self._wait_time += started - begin
+
+        success = False
+        try:
+            success = func()
+            return success
+        finally:
+            with self._condition:
+                del self._running[name]
+                self._metrics["starts"] += 1
+                if success:
+                    self._durations.append(time.time() - started)
+                    self._limit = min(self._limit + 1, self._max_concurrency)
+                else:
+                    self._metrics["failures"] += 1
+                    self._limit = max(1, self._limit // 2)
+                    log.info("start of {} failed, running at most {} starts at once".format(name, self._limit))
+                self._condition.notify_all()
+
+    def _duration(self):
+
+        if not self._durations:
+            return self.default_duration
+        return sum(self._durations) / len(self._durations)
+
+    def queue(self):
+        """
+        Returns the running and queued starts with their expected end.
+
+        :returns: list of (name, state, position, ETA in seconds) tuples,
+        the position is 0 for the running starts
+        """
+
+        with self._condition:
+            now = time.time()
+            duration = self._duration()
+            concurrency = max(1, min(self._limit, self._allowed()))
+            entries = []
+            remaining = []
+            for name, started in self._running.items():
+                eta = max(0.0, duration - (now - started))
+                remaining.append(eta)
+                entries.append((name, RUNNING, 0, eta))
+            # the queued starts are admitted in waves as slots are freed
+            remaining.sort()
+            slots = (remaining + [0.0] * concurrency)[:concurrency]
+            for position, name in enumerate(self._queue):
+                slots[0] += duration
+                entries.append((name, QUEUED, position + 1, slots[0]))
+                slots.sort()
+            return entries
+
+    def status(self, name):
+        """
+        Returns the state of the start of an instance.
+
+        :param name: instance name
+
+        :returns: (name, state, position, ETA in seconds) tuple or None
+        """
+
+        for entry in self.queue():
+            if entry[0] == name:
+                return entry
+        return None
+
+    def metrics(self):
+        """
+        Returns the scheduler counters.
+
+        :returns: list of (name, value) tuples
+        """
+
+        with self._condition:
+            snapshot = [("start_scheduler.{}".format(name), self._metrics[name])
+                        for name in ("starts", "failures", "throttled")]
+            snapshot.append(("start_scheduler.limit", self._limit))
+            snapshot.append(("start_scheduler.running", len(self._running)))
+            snapshot.append(("start_scheduler.queued", len(self._queue)))
+            snapshot.append(("start_scheduler.average_duration", "%.3f" % self._duration()))
+            snapshot.append(("start_scheduler.wait_time", "%.3f" % self._wait_time))
+        return snapshot
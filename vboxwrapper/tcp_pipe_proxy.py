@@ -18,6 +18,8 @@
 # Parts of this code have been taken from Pyserial project (http://pyserial.sourceforge.net/) under Python license
 
 import sys
+import collections
+import errno
 import string
 import time
 import threading
@@ -28,12 +30,145 @@ if sys.platform.startswith("win"):
     import win32pipe
     import win32file
 
+# what happens to a client which does not read its console output fast enough
+DROP_OLDEST = "drop_oldest"  # the oldest output is discarded
+DISCONNECT = "disconnect"    # the client is disconnected
+
+OUTPUT_BUFFER_SIZE = 65536
+OUTPUT_POLICY = DROP_OLDEST
+
+# bytes read at once from the serial pipes and from the raw clients
+PIPE_READ_SIZE = 65536
+CLIENT_READ_SIZE = 65536
+
+
+class OutputBufferFull(Exception):
+    """
+    Raised when the output buffer of a client with the DISCONNECT policy is full.
+    """
+
+    pass
+
+
+def set_output_buffer(size, policy):
+    """
+    Sets how much output is kept for the clients not reading it fast enough.
+
+    :param size: maximum number of bytes waiting to be sent to a client
+    :param policy: DROP_OLDEST or DISCONNECT
+    """
+
+    global OUTPUT_BUFFER_SIZE, OUTPUT_POLICY
+    if policy not in (DROP_OLDEST, DISCONNECT):
+        raise ValueError("unknown output policy {}".format(policy))
+    OUTPUT_BUFFER_SIZE = size
+    OUTPUT_POLICY = policy
+
+
+def create_server(host, port):
+    """
+    Creates the socket server Telnet clients connect to.
+
+    :param host: IP address to listen on
+    :param port: TCP port
+
+    :returns: listening socket
+    """
+
+    if host.__contains__(':'):
+        # IPv6 address support
+        server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, int(port)))
+    server.listen(5)
+    return server
+
+
+def accept_client(server, raw=False):
+    """
+    Accepts a Telnet client, or a raw TCP client.
+
+    :param server: listening socket
+    :param raw: True for a raw TCP client
+
+    :returns: TelnetClient or RawClient instance
+    """
+
+    sock, addr = server.accept()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # a slow client must not block the output of the others
+    sock.setblocking(0)
+    if raw:
+        return RawClient(sock, addr, OUTPUT_BUFFER_SIZE, OUTPUT_POLICY)
+    return TelnetClient(sock, addr, OUTPUT_BUFFER_SIZE, OUTPUT_POLICY)
+
+
+def from_client(data):
+    """
+    Prepares data received from a Telnet client for the serial pipe.
+    """
+
+    # For some reason, windows likes to send "cr/lf" when you send a "cr".
+    # Strip that so we don't get a double prompt.
+    return string.replace(data, chr(13) + chr(10), chr(13))
+
+
+def banner(name):
+    """
+    Returns the message sent to new Telnet clients.
+    """
+
+    return "%s console is now available ... Press RETURN to get started.\r\n" % name
+
+
+def scrollback_replay(client, tail):
+    """
+    Returns the scrollback tail sent to a new client, escaped for a
+    Telnet client. It is cut to the room left in the output buffer of
+    the client so that replaying it never disconnects the client nor
+    drops its banner.
+
+    :param client: TelnetClient or RawClient instance
+    :param tail: scrollback tail
+
+    :returns: string
+    """
+
+    room = max(0, client.output_buffer_size - client.pending())
+    tail = tail[len(tail) - room:] if len(tail) > room else tail
+    if not client.telnet:
+        return tail
+    replay = escape(tail)
+    # the tail is cut again rather than the escaped data so a doubled IAC is never split
+    while len(replay) > room:
+        tail = tail[len(replay) - room:]
+        replay = escape(tail)
+    return replay
+
+
+def pipe_notice(name, connected):
+    """
+    Returns the message sent to the Telnet clients when the serial pipe
+    is closed or connected again.
+    """
+
+    if connected:
+        return "\r\n%s console is available again.\r\n" % name
+    return "\r\n%s console is not available, waiting for the VM ...\r\n" % name
+
 
 class PipeProxy(threading.Thread):
 
-    def __init__(self, name, pipe, host, port):
+    def __init__(self, name, pipe, host, port, scrollback=None, transcript=None, raw=False):
         self.devname = name
         self.pipe = pipe
+        # raw TCP clients instead of Telnet clients
+        self.raw = raw
+        self.scrollback = scrollback
+        self.transcript = transcript
         self.host = host
         self.port = port
         self.server = None
@@ -49,14 +184,7 @@ class PipeProxy(threading.Thread):
             self.use_thread = True
 
         try:
-            if self.host.__contains__(':'):
-                # IPv6 address support
-                self.server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            else:
-                self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.server.bind((self.host, int(self.port)))
-                self.server.listen(5)
+            self.server = create_server(self.host, self.port)
         except socket.error as msg:
             self.error("unable to create the socket server %s" % msg)
             return
@@ -81,9 +209,12 @@ class PipeProxy(threading.Thread):
             if not self.use_thread:
                 recv_list.append(self.pipe.fileno())
 
+            send_list = []
             for client in self.clients.values():
                 if client.active:
                     recv_list.append(client.fileno)
+                    if client.pending():
+                        send_list.append(client.fileno)
                 else:
                     self.debug("lost client %s" % client.addrport())
                     try:
@@ -93,7 +224,7 @@ class PipeProxy(threading.Thread):
                     del self.clients[client.fileno]
 
             try:
-                rlist, slist, elist = select.select(recv_list, [], [], self.timeout)
+                rlist, slist, elist = select.select(recv_list, send_list, [], self.timeout)
             except select.error as err:
                 self.error("fatal select error %d:%s" % (err[0], err[1]))
                 return False
@@ -102,21 +233,39 @@ class PipeProxy(threading.Thread):
                 self.debug('Exiting ...')
                 return True
 
+            for sock_fileno in slist:
+                client = self.clients[sock_fileno]
+                self._write_lock.acquire()
+                try:
+                    client.flush()
+                except Exception as msg:
+                    self.debug(msg)
+                    client.deactivate()
+                finally:
+                    self._write_lock.release()
+
             for sock_fileno in rlist:
                 if sock_fileno == self.server.fileno():
 
                     try:
-                        sock, addr = self.server.accept()
-                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                        self.debug("new client %s:%s" % (addr[0], addr[1]))
+                        new_client = accept_client(self.server, self.raw)
+                        self.debug("new client %s" % new_client.addrport())
                     except socket.error as err:
                         self.error("accept error %d:%s" % (err[0], err[1]))
                         continue
 
-                    new_client = TelnetClient(sock, addr)
-                    self.clients[new_client.fileno] = new_client
-                    sock.send("%s console is now available ... Press RETURN to get started.\r\n" % self.devname)
+                    self._write_lock.acquire()
+                    try:
+                        self.clients[new_client.fileno] = new_client
+                        if new_client.telnet:
+                            new_client.write(banner(self.devname))
+                        if self.scrollback is not None:
+                            new_client.write(scrollback_replay(new_client, self.scrollback.tail()))
+                    except Exception as msg:
+                        self.debug(msg)
+                        new_client.deactivate()
+                    finally:
+                        self._write_lock.release()
 
                     if self.use_thread and not self.reader_thread:
                         self.reader_thread = threading.Thread(target=self.reader)
@@ -126,29 +275,70 @@ class PipeProxy(threading.Thread):
 
                 elif not self.use_thread and sock_fileno == self.pipe.fileno():
 
-                    data = self.read_from_pipe()
+                    try:
+                        data = self.read_from_pipe()
+                    except socket.error:
+                        data = ""
                     if not data:
                         self.debug("pipe has been closed!")
                         return False
-                    for client in self.clients.values():
-                        try:
-                            client.send(data)
-                        except:
-                            self.debug(msg)
-                            client.deactivate()
+                    self.send_to_clients(data)
                 elif sock_fileno in self.clients:
                     try:
-                        data = self.clients[sock_fileno].socket_recv()
-
-                        # For some reason, windows likes to send "cr/lf" when you send a "cr".
-                        # Strip that so we don't get a double prompt.
-                        data = string.replace(data, chr(13) + chr(10), chr(13))
-
-                        self.write_to_pipe(data)
+                        # replies to the Telnet negotiation are queued with the output
+                        client = self.clients[sock_fileno]
+                        self._write_lock.acquire()
+                        try:
+                            data = client.socket_recv()
+                        finally:
+                            self._write_lock.release()
+                        self.write_to_pipe(from_client(data) if client.telnet else data)
                     except Exception as msg:
                         self.debug(msg)
                         self.clients[sock_fileno].deactivate()
 
+    def send_to_clients(self, data):
+        """
+        Records pipe output in the scrollback and the transcript and
+        queues it for all the clients, escaped only once for the
+        Telnet clients.
+        """
+
+        escaped = None
+        self._write_lock.acquire()
+        try:
+            if self.scrollback is not None:
+                self.scrollback.append(data)
+            if self.transcript is not None:
+                self.transcript.append(data)
+            for client in self.clients.values():
+                try:
+                    if client.telnet:
+                        if escaped is None:
+                            escaped = escape(data)
+                        dropped = client.write(escaped)
+                    else:
+                        dropped = client.write(data)
+                    if dropped:
+                        self.debug("dropped %d bytes of output for slow client %s" % (dropped, client.addrport()))
+                except Exception as msg:
+                    self.debug(msg)
+                    client.deactivate()
+        finally:
+            self._write_lock.release()
+
+    def send_to_pipe(self, data):
+        """
+        Sends bytes to the pipe, can be called from any thread.
+
+        :returns: False if the pipe is closed
+        """
+
+        if self.pipe is None or not self.alive:
+            return False
+        self.write_to_pipe(data)
+        return True
+
     def write_to_pipe(self, data):
 
         if sys.platform.startswith('win'):
@@ -165,7 +355,7 @@ class PipeProxy(threading.Thread):
                 return output
             return ""
         else:
-            return self.pipe.recv(1024)
+            return self.pipe.recv(PIPE_READ_SIZE)
 
     def reader(self):
         """loop forever and copy pipe->socket"""
@@ -177,12 +367,8 @@ class PipeProxy(threading.Thread):
                 if not data and not sys.platform.startswith('win'):
                     self.debug("pipe has been closed!")
                     break
-                self._write_lock.acquire()
-                try:
-                    for client in self.clients.values():
-                        client.send(data)
-                finally:
-                    self._write_lock.release()
+                if data:
+                    self.send_to_clients(data)
                 if sys.platform.startswith('win'):
                     # sleep every 10 ms
                     time.sleep(0.01)
@@ -230,12 +416,24 @@ EL  = to_bytes([248])  # Erase Line
 GA  = to_bytes([249])  # Go Ahead
 SB =  to_bytes([250])  # Subnegotiation Begin
 
+
+def escape(data):
+    """
+    Escapes the IAC characters of data sent to Telnet clients.
+    """
+
+    return data.replace(IAC, IAC_DOUBLED)
+
 # selected telnet options
 ECHO = to_bytes([1])   # echo
 SGA = to_bytes([3])    # suppress go ahead
 LINEMODE = to_bytes([34]) # line mode
 TERMTYPE = to_bytes([24]) # terminal type
 
+# terminal type subnegotiation commands
+TERMTYPE_IS = to_bytes([0])
+TERMTYPE_SEND = to_bytes([1])
+
 # Telnet filter states
 M_NORMAL = 0
 M_IAC_SEEN = 1
@@ -314,22 +512,162 @@ class TelnetOption(object):
                 raise ValueError('option in illegal state %r' % self)
 
 
-class TelnetClient(object):
+class RawClient(object):
 
     """
-    Represents a client connection via Telnet.
+    Represents a raw TCP client connection, for the automation clients.
 
-    First argument is the socket discovered by the Telnet Server.
-    Second argument is the tuple (ip address, port number).
+    The bytes are copied between the socket and the serial pipe as they
+    are, without any Telnet negotiation or escaping. The input is
+    received into a buffer allocated once per client.
     """
 
-    def __init__(self, sock, addr_tup):
+    telnet = False
+    terminal_type = None            # as sent by a Telnet client, if it does
+
+    def __init__(self, sock, addr_tup, output_buffer_size=OUTPUT_BUFFER_SIZE, output_policy=OUTPUT_POLICY):
         self.active = True          # Turns False when the connection is lost
         self.sock = sock            # The connection's socket
         self.fileno = sock.fileno() # The socket's file descriptor
         self.address = addr_tup[0]  # The client's remote TCP/IP address
         self.port = addr_tup[1]     # The client's remote port
 
+        # output not sent yet, in escaped chunks for the Telnet clients
+        self.output_buffer_size = output_buffer_size
+        self.output_policy = output_policy
+        self.dropped = 0            # bytes of output discarded so far
+        self._output = collections.deque()
+        self._output_size = 0
+        self._output_started = False
+        self._input = None          # input buffer, only allocated by the raw clients
+
+    def write(self, data):
+        """
+        Queues data, already escaped for a Telnet client, and sends as
+        much of the queue as possible without blocking.
+
+        :param data: string
+
+        :returns: number of bytes of older output dropped to make room
+        """
+
+        dropped = 0
+        if self._output_size + len(data) > self.output_buffer_size:
+            if self.output_policy == DISCONNECT:
+                self.active = False
+                raise OutputBufferFull("output buffer of %s is full" % self.addrport())
+            # whole chunks are dropped so escape sequences are never cut,
+            # the first one is kept once part of it has been sent
+            first = 1 if self._output_started else 0
+            while len(self._output) > first and self._output_size + len(data) > self.output_buffer_size:
+                chunk = self._output[first]
+                del self._output[first]
+                self._output_size -= len(chunk)
+                dropped += len(chunk)
+            self.dropped += dropped
+        self._output.append(data)
+        self._output_size += len(data)
+        self.flush()
+        return dropped
+
+    def flush(self):
+        """
+        Sends as much of the queued output as possible without blocking.
+
+        :returns: True if all the output has been sent
+        """
+
+        while self._output:
+            chunk = self._output[0]
+            try:
+                sent = self.sock.send(chunk)
+            except socket.error as ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return False
+                self.active = False
+                raise Exception("socket.send() error '%d:%s' from %s" % (ex[0], ex[1], self.addrport()))
+            self._output_size -= sent
+            if sent < len(chunk):
+                self._output[0] = chunk[sent:]
+                self._output_started = True
+                return False
+            self._output.popleft()
+            self._output_started = False
+        return True
+
+    def pending(self):
+        """
+        Returns the number of bytes waiting to be sent.
+        """
+        return self._output_size
+
+    def deactivate(self):
+        """
+        Set the client to disconnect on the next server poll.
+        """
+        self.active = False
+
+    def addrport(self):
+        """
+        Return the DE's IP address and port number as a string.
+        """
+        return "%s:%s" % (self.address, self.port)
+
+    def _recv(self):
+        """
+        Receives the available input into the input buffer.
+
+        :returns: number of bytes received
+        """
+
+        if self._input is None:
+            self._input = bytearray(CLIENT_READ_SIZE)
+        try:
+            size = self.sock.recv_into(self._input)
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise Exception("socket.recv() error '%d:%s' from %s" % (ex[0], ex[1], self.addrport()))
+
+        ## Did they close the connection?
+        if size == 0:
+            raise Exception("connection closed by %s" % self.addrport())
+        return size
+
+    def socket_recv(self):
+        """
+        Called by the server when recv data is ready.
+        """
+        size = self._recv()
+        return str(self._input[:size])
+
+    def forward(self, write):
+        """
+        Copies the available input to the serial pipe, straight from
+        the input buffer.
+
+        :param write: function writing input to the serial pipe, the
+        buffer it is given is only valid during the call
+        """
+        size = self._recv()
+        if size:
+            write(memoryview(self._input)[:size])
+
+
+class TelnetClient(RawClient):
+
+    """
+    Represents a client connection via Telnet.
+
+    First argument is the socket discovered by the Telnet Server.
+    Second argument is the tuple (ip address, port number).
+    """
+
+    telnet = True
+
+    def __init__(self, sock, addr_tup, output_buffer_size=OUTPUT_BUFFER_SIZE, output_policy=OUTPUT_POLICY):
+        RawClient.__init__(self, sock, addr_tup, output_buffer_size, output_policy)
+
         # filter state machine
         self.mode = M_NORMAL
         self.suboption = None
@@ -341,7 +679,7 @@ class TelnetClient(object):
             TelnetOption(self, 'we-SGA', SGA, WILL, WONT, DO, DONT, REQUESTED),
             TelnetOption(self, 'they-SGA', SGA, DO, DONT, WILL, WONT, INACTIVE),
             TelnetOption(self, 'LINEMODE', LINEMODE, DONT, DONT, WILL, WONT, REQUESTED),
-            TelnetOption(self, 'TERMTYPE', TERMTYPE, DO, DONT, WILL, WONT, REQUESTED),
+            TelnetOption(self, 'TERMTYPE', TERMTYPE, DO, DONT, WILL, WONT, REQUESTED, self._requestTerminalType),
             ]
 
         for option in self._telnet_options:
@@ -350,43 +688,50 @@ class TelnetClient(object):
 
     def telnetSendOption(self, action, option):
         """Send DO, DONT, WILL, WONT."""
-        self.sock.sendall(to_bytes([IAC, action, option]))
+        self.write(to_bytes([IAC, action, option]))
 
     def escape(self, data):
-        """ All outgoing data has to be properly escaped, so that no IAC character 
+        """ All outgoing data has to be properly escaped, so that no IAC character
         in the data stream messes up the Telnet state machine in the server.
         """
-        for byte in data:
-            if byte == IAC:
-                yield IAC
-                yield IAC
-            else:
-                yield byte
+        return escape(data)
+
+    def _data(self, chunk, output):
+        """Store data in the sub option buffer or pass it to our consumer
+        depending on state."""
+        if self.suboption is not None:
+            self.suboption.extend(chunk)
+        else:
+            output.append(chunk)
 
     def filter(self, data):
-        """ handle a bunch of incoming bytes. this is a generator. it will yield
-        all characters not of interest for Telnet
+        """ handle a bunch of incoming bytes and return all characters not of
+        interest for Telnet. The runs of plain data between IAC characters
+        are copied as slices, only the command bytes go through the state
+        machine.
         """
-        for byte in data:
+        output = []
+        position = 0
+        size = len(data)
+        while position < size:
             if self.mode == M_NORMAL:
                 # interpret as command or as data
-                if byte == IAC:
+                index = data.find(IAC, position)
+                if index < 0:
+                    index = size
+                if index > position:
+                    self._data(data[position:index], output)
+                if index < size:
                     self.mode = M_IAC_SEEN
-                else:
-                    # store data in sub option buffer or pass it to our
-                    # consumer depending on state
-                    if self.suboption is not None:
-                        self.suboption.append(byte)
-                    else:
-                        yield byte
-            elif self.mode == M_IAC_SEEN:
+                position = index + 1
+                continue
+            byte = data[position]
+            position += 1
+            if self.mode == M_IAC_SEEN:
                 if byte == IAC:
                     # interpret as command doubled -> insert character
                     # itself
-                    if self.suboption is not None:
-                        self.suboption.append(byte)
-                    else:
-                        yield byte
+                    self._data(byte, output)
                     self.mode = M_NORMAL
                 elif byte == SB:
                     # sub option start
@@ -394,7 +739,8 @@ class TelnetClient(object):
                     self.mode = M_NORMAL
                 elif byte == SE:
                     # sub option end -> process it now
-                    #self._telnetProcessSubnegotiation(bytes(self.suboption))
+                    if self.suboption is not None:
+                        self._telnetProcessSubnegotiation(bytes(self.suboption))
                     self.suboption = None
                     self.mode = M_NORMAL
                 elif byte in (DO, DONT, WILL, WONT):
@@ -407,6 +753,16 @@ class TelnetClient(object):
             elif self.mode == M_NEGOTIATE: # DO, DONT, WILL, WONT was received, option now following
                 self._telnetNegotiateOption(self.telnet_command, byte)
                 self.mode = M_NORMAL
+        return b"".join(output)
+
+    def _requestTerminalType(self):
+        """Ask the client for its terminal type once it agreed to send it."""
+        self.write(to_bytes([IAC, SB, TERMTYPE, TERMTYPE_SEND, IAC, SE]))
+
+    def _telnetProcessSubnegotiation(self, suboption):
+        """Process a complete subnegotiation, only the terminal type is used."""
+        if suboption[:2] == TERMTYPE + TERMTYPE_IS:
+            self.terminal_type = suboption[2:]
 
     def _telnetNegotiateOption(self, command, option):
         """Process incoming DO, DONT, WILL, WONT."""
@@ -430,23 +786,7 @@ class TelnetClient(object):
         Send data to the distant end.
         """
 
-        try:
-            self.sock.sendall(to_bytes(self.escape(data)))
-        except socket.error as ex:
-            self.active = False
-            raise Exception("socket.sendall() error '%d:%s' from %s" % (ex[0], ex[1], self.addrport()))
-
-    def deactivate(self):
-        """
-        Set the client to disconnect on the next server poll.
-        """
-        self.active = False
-
-    def addrport(self):
-        """
-        Return the DE's IP address and port number as a string.
-        """
-        return "%s:%s" % (self.address, self.port)
+        return self.write(self.escape(data))
 
     def socket_recv(self):
         """
@@ -455,6 +795,8 @@ class TelnetClient(object):
         try:
             data = self.sock.recv(4096)
         except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return ""
             raise Exception("socket.recv() error '%d:%s' from %s" % (ex[0], ex[1], self.addrport()))
 
         ## Did they close the connection?
@@ -462,7 +804,18 @@ class TelnetClient(object):
         if size == 0:
             raise Exception("connection closed by %s" % self.addrport())
 
-        return to_bytes(self.filter(data))
+        return self.filter(data)
+
+    def forward(self, write):
+        """
+        Copies the available input to the serial pipe, once the Telnet
+        commands have been filtered out.
+
+        :param write: function writing input to the serial pipe
+        """
+        data = self.socket_recv()
+        if data:
+            write(from_client(data))
 
 if __name__ == '__main__':
 
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tokenizer for the control protocol requests.
+
+Requests are space separated tokens, a token can be quoted with double
+quotes and a double quote is written twice inside a quoted token. The
+tokens are exactly the ones csv.reader(delimiter=' ') produces for the
+request, without building a file object and a reader for each request.
+"""
+
+import csv
+import cStringIO
+
+def _csv_tokenize(request):
+    """
+    Tokenizes a request with the csv module.
+    """
+
+    try:
+        return csv.reader(cStringIO.StringIO(request), delimiter=' ').next()
+    except StopIteration:
+        return []
+
+
+def tokenize(request):
+    """
+    Splits a request line into tokens.
+
+    :param request: request without its line delimiter
+
+    :returns: list of tokens
+    """
+
+    if '\r' in request or '\0' in request:
+        # the csv module splits records or raises errors on these,
+        # leave them to it to get the very same behavior
+        return _csv_tokenize(request)
+    if '"' not in request:
+        if not request:
+            return []
+        return request.split(' ')
+
+    # the parts at odd indexes are the quoted texts
+    parts = request.split('"')
+    if not len(parts) % 2:
+        # unterminated quoted token
+        return _csv_tokenize(request)
+    tokens = parts[0].split(' ')
+    if tokens.pop():
+        # quote inside an unquoted token
+        return _csv_tokenize(request)
+    last = len(parts) - 1
+    field = ''
+    index = 1
+    while True:
+        field += parts[index]
+        after = parts[index + 1]
+        more = index + 1 < last
+        if not after:
+            if more:
+                # doubled quote inside a quoted token
+                field += '"'
+                index += 2
+                continue
+            tokens.append(field)
+            return tokens
+        if after[0] != ' ':
+            # text right after a closing quote
+            return _csv_tokenize(request)
+        tokens.append(field)
+        words = after[1:].split(' ')
+        if more:
+            if words.pop():
+                # quote inside an unquoted token
+                return _csv_tokenize(request)
+            tokens.extend(words)
+            field = ''
+            index += 2
+            continue
+        tokens.extend(words)
+        return tokens
+
+
+def quote(token):
+    """
+    Quotes a token so that tokenize() reads it back unchanged.
+
+    :param token: token
+
+    :returns: token, quoted if needed
+    """
+
+    if token and ' ' not in token and '"' not in token:
+        return token
+    return '"%s"' % token.replace('"', '""')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Declarative topologies.
+
+A topology is a JSON object describing the wanted instances:
+
+    {"vms": {"R1": {"image": "Router", "console": 3001, "nics": 2,
+                    "links": {"0": {"sport": 10000, "daddr": "127.0.0.1", "dport": 10001}},
+                    "captures": {"0": "/tmp/R1_0.pcap"}}}}
+
+diff() compares it with the registered instances and returns the
+changes to make, the attributes missing from a description are left
+unchanged while the links and captures of a described instance are
+exactly the ones described.
+"""
+
+import json
+
+ATTRIBUTES = ("image", "console", "nics", "netcard", "headless_mode", "enable_console", "console_mode", "nic_start_index")
+
+
+class TopologyError(Exception):
+    """
+    Raised for invalid topology descriptions.
+    """
+
+    pass
+
+
+def _string(value):
+    """
+    Converts a JSON value to a byte string.
+
+    :param value: JSON value
+
+    :returns: string
+    """
+
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def normalize(value):
+    """
+    Converts an attribute value the way setattr requests do.
+
+    :param value: attribute value
+
+    :returns: boolean or string
+    """
+
+    if isinstance(value, bool):
+        return value
+    value = _string(value)
+    if value == "True":
+        return True
+    if value == "False":
+        return False
+    return value
+
+
+def _adapter_ids(name, what, entries):
+
+    if not isinstance(entries, dict):
+        raise TopologyError("{} of '{}' must be an object".format(what, name))
+    for vnic in entries:
+        if not vnic.isdigit():
+            raise TopologyError("invalid adapter '{}' in the {} of '{}'".format(vnic, what, name))
+    return sorted(entries.items(), key=lambda entry: int(entry[0]))
+
+
+def parse(payload):
+    """
+    Parses a JSON topology.
+
+    :param payload: JSON text
+
+    :returns: dictionary of instance descriptions by name, each with
+    "attributes" (dictionary), "links" (dictionary of (sport, daddr, dport)
+    by adapter ID) and "captures" (dictionary of file paths by adapter ID)
+    """
+
+    try:
+        topology = json.loads(payload)
+    except ValueError as e:
+        raise TopologyError("invalid JSON: {}".format(e))
+    if not isinstance(topology, dict) or not isinstance(topology.get("vms"), dict):
+        raise TopologyError("the topology must be an object with a \"vms\" object")
+
+    vms = {}
+    for name, description in topology["vms"].items():
+        name = _string(name)
+        if not isinstance(description, dict):
+            raise TopologyError("the description of '{}' must be an object".format(name))
+        unknown = set(description) - set(ATTRIBUTES) - set(["links", "captures"])
+        if unknown:
+            raise TopologyError("unknown attributes for '{}': {}".format(name, ", ".join(sorted(unknown))))
+        links = {}
+        for vnic, link in _adapter_ids(name, "links", description.get("links", {})):
+            try:
+                links[int(vnic)] = tuple(_string(link[key]) for key in ("sport", "daddr", "dport"))
+            except (TypeError, KeyError):
+                raise TopologyError("link {} of '{}' needs sport, daddr and dport".format(vnic, name))
+        captures = {}
+        for vnic, path in _adapter_ids(name, "captures", description.get("captures", {})):
+            captures[int(vnic)] = _string(path)
+        vms[name] = {"attributes": dict((attribute, normalize(description[attribute]))
+                                        for attribute in ATTRIBUTES if attribute in description),
+                     "links": links,
+                     "captures": captures}
+    return vms
+
+
+def diff(vms, instances, prune=False, resolve=None):
+    """
+    Computes the changes turning the instances into a topology.
+
+    :param vms: parsed topology
+    :param instances: dictionary of the registered instances by name
+    :param prune: delete the instances missing from the topology
+    :param resolve: function resolving a host name, used to compare
+    the link destinations with the resolved ones of the instances
+
+    :returns: list of changes in the order they must be made:
+    ("delete", name), ("create", name), ("setattr", name, attribute, value),
+    ("delete_capture", name, vnic), ("create_capture", name, vnic, path),
+    ("delete_udp", name, vnic), ("create_udp", name, vnic, sport, daddr, dport)
+    """
+
+    resolve = resolve or (lambda host: host)
+    removals = []
+    setup = []
+    link_deletions = []
+    link_creations = []
+    deleted_links = set()
+    if prune:
+        removals = [("delete", name) for name in sorted(instances) if name not in vms]
+
+    for name in sorted(vms):
+        description = vms[name]
+        instance = instances.get(name)
+        deleted_links.clear()
+        if instance is None:
+            setup.append(("create", name))
+        for attribute in ATTRIBUTES:
+            if attribute not in description["attributes"]:
+                continue
+            value = description["attributes"][attribute]
+            if instance is None or normalize(getattr(instance, attribute)) != value:
+                setup.append(("setattr", name, attribute, value))
+
+        captures = instance.capture if instance is not None else {}
+        for vnic in sorted(captures):
+            if vnic not in description["captures"]:
+                setup.append(("delete_capture", name, vnic))
+        for vnic, path in sorted(description["captures"].items()):
+            if captures.get(vnic) != path:
+                setup.append(("create_capture", name, vnic, path))
+
+        links = instance.udp if instance is not None else {}
+        for vnic in sorted(links):
+            current = links[vnic]
+            link = description["links"].get(vnic)
+            if link is None or (_string(current.lport), current.rhost, _string(current.rport)) != \
+                    (link[0], resolve(link[1]), link[2]):
+                link_deletions.append(("delete_udp", name, vnic))
+                deleted_links.add(vnic)
+        for vnic, link in sorted(description["links"].items()):
+            if vnic not in links or vnic in deleted_links:
+                link_creations.append(("create_udp", name, vnic) + link)
+
+    # links are deleted first so their ports can be reused by other instances
+    return removals + setup + link_deletions + link_creations
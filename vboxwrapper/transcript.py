@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Console transcripts.
+
+The whole serial output of a VM is appended to segment files in a
+directory of its own, a new segment is started once the current one is
+larger than the segment size. Each segment is named after the offset of
+its first byte in the transcript and has a sidecar index of
+"<timestamp> <offset>" lines, written for the first output of a segment
+and then at most once per index interval. Reading a time range only
+loads the indexes of the segments covering it and seeks to the offsets.
+
+The consoles only queue their output, a single thread writes the
+transcripts of all the VMs. When the disks cannot keep up the queued
+output is bounded and the excess is dropped rather than blocking the
+consoles.
+"""
+
+import bisect
+import collections
+import os
+import re
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+class Transcript(object):
+    """
+    Transcript of the console output of a VM.
+
+    :param transcripts: Transcripts instance
+    :param name: instance name
+    :param directory: directory of the segment files
+    """
+
+    def __init__(self, transcripts, name, directory):
+
+        self.name = name
+        self._transcripts = transcripts
+        self._directory = directory
+        self._segments = []     # [offset of the first byte, time of the first byte] of each segment
+        self._offset = 0        # offset of the next byte
+        self._segment = None
+        self._index = None
+        self._indexed = 0.0
+        self._load()
+
+    def _path(self, offset, suffix):
+
+        return os.path.join(self._directory, "%016d%s" % (offset, suffix))
+
+    def _load(self):
+        """
+        Finds the segments written by a previous run.
+        """
+
+        if not os.path.isdir(self._directory):
+            return
+        for filename in sorted(os.listdir(self._directory)):
+            base, suffix = os.path.splitext(filename)
+            if suffix != SEGMENT_SUFFIX or not base.isdigit():
+                continue
+            offset = int(base)
+            if not os.path.exists(self._path(offset, INDEX_SUFFIX)):
+                continue
+            with open(self._path(offset, INDEX_SUFFIX), "rb") as f:
+                first = f.readline().split()
+            if len(first) != 2:
+                continue
+            self._segments.append([offset, float(first[0])])
+            self._offset = offset + os.path.getsize(self._path(offset, SEGMENT_SUFFIX))
+
+    def append(self, data):
+        """
+        Queues console output, never blocks.
+
+        :param data: string
+        """
+
+        self._transcripts.queue(self, data)
+
+    def close(self):
+        """
+        Closes the segment files once the queued output is written.
+        """
+
+        self._transcripts.queue(self, None)
+
+    def _write(self, timestamp, data):
+        """
+        Writes console output, only from the writer thread.
+        """
+
+        if data is None:
+            self._close()
+            return
+        if self._segment is None or self._segment.tell() >= self._transcripts.segment_size:
+            self._rotate(timestamp)
+        if timestamp - self._indexed >= self._transcripts.index_interval:
+            self._index.write("%.6f %d\n" % (timestamp, self._offset))
+            self._indexed = timestamp
+        self._segment.write(data)
+        self._offset += len(data)
+
+    def _rotate(self, timestamp):
+
+        self._close()
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._segment = open(self._path(self._offset, SEGMENT_SUFFIX), "ab", 65536)
+        self._index = open(self._path(self._offset, INDEX_SUFFIX), "ab")
+        self._segments.append([self._offset, timestamp])
+        # the first output of a segment is always indexed
+        self._indexed = 0.0
+
+    def _flush(self):
+
+        if self._segment is not None:
+            self._segment.flush()
+            self._index.flush()
+
+    def _close(self):
+
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def _entries(self, first, last):
+        """
+        Loads the index entries of a range of segments.
+        """
+
+        entries = []
+        for offset, started in self._segments[first:last + 1]:
+            with open(self._path(offset, INDEX_SUFFIX), "rb") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        entries.append((float(fields[0]), int(fields[1])))
+        return entries
+
+    def read(self, start, end=None, limit=None):
+        """
+        Reads the output of a time range. The output is indexed once per
+        index interval, the output written up to an interval before the
+        start of the range may be returned too.
+
+        :param start: start of the range (time.time() value)
+        :param end: end of the range, the last output by default
+        :param limit: maximum number of bytes
+
+        :returns: (output, offset of the first byte, offset after the last byte)
+        """
+
+        with self._transcripts.io_lock:
+            self._flush()
+            if not self._segments:
+                return "", 0, 0
+            starts = [started for offset, started in self._segments]
+            first = max(0, bisect.bisect_right(starts, start) - 1)
+            last = len(starts) - 1 if end is None else max(first, bisect.bisect_right(starts, end) - 1)
+            entries = self._entries(first, last)
+            if not entries:
+                return "", self._offset, self._offset
+            times = [timestamp for timestamp, offset in entries]
+            position = max(0, bisect.bisect_right(times, start) - 1)
+            begin = entries[position][1]
+            stop = self._offset
+            if end is not None:
+                position = bisect.bisect_right(times, end)
+                if position < len(entries):
+                    stop = entries[position][1]
+                elif last + 1 < len(self._segments):
+                    stop = self._segments[last + 1][0]
+            if limit is not None:
+                stop = min(stop, begin + limit)
+            return self._read(begin, stop), begin, stop
+
+    def _read(self, begin, stop):
+        """
+        Reads the bytes between two offsets, seeking in the segments.
+        """
+
+        chunks = []
+        offsets = [offset for offset, started in self._segments] + [self._offset]
+        segment = max(0, bisect.bisect_right(offsets, begin) - 1)
+        while begin < stop and segment < len(self._segments):
+            offset = offsets[segment]
+            with open(self._path(offset, SEGMENT_SUFFIX), "rb") as f:
+                f.seek(begin - offset)
+                chunk = f.read(min(stop, offsets[segment + 1]) - begin)
+            chunks.append(chunk)
+            begin += len(chunk)
+            segment += 1
+        return "".join(chunks)
+
+
+class Transcripts(object):
+    """
+    Writes the console transcripts of the VMs with one thread.
+
+    :param directory: directory of the transcripts, one subdirectory per VM
+    :param segment_size: size in bytes from which a new segment is started
+    :param index_interval: seconds between two index entries
+    :param max_pending: maximum number of bytes queued for writing
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, index_interval=1.0, max_pending=8 * 1024 * 1024):
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.io_lock = threading.Lock()
+        self._max_pending = max_pending
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._pending = 0
+        self._thread = None
+        self._running = False
+        self._opened = set()
+        self._metrics = dict.fromkeys(("written_bytes", "dropped_bytes", "errors"), 0)
+
+    def open(self, name):
+        """
+        Opens the transcript of a VM, appending to the previous one.
+
+        :param name: instance name
+
+        :returns: Transcript instance
+        """
+
+        # instance names may contain characters not allowed in file names
+        transcript = Transcript(self, name, os.path.join(self.directory, re.sub(r"[^\w.-]", "_", name)))
+        with self.io_lock:
+            self._opened.add(transcript)
+        return transcript
+
+    def queue(self, transcript, data):
+        """
+        Queues output for the writer thread, drops it if too much is queued.
+        """
+
+        size = len(data) if data is not None else 0
+        with self._condition:
+            if self._pending + size > self._max_pending:
+                self._metrics["dropped_bytes"] += size
+                return
+            self._queue.append((transcript, time.time(), data))
+            self._pending += size
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._run, name="transcripts")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                entries = list(self._queue)
+                self._queue.clear()
+            written = set()
+            with self.io_lock:
+                for transcript, timestamp, data in entries:
+                    try:
+                        transcript._write(timestamp, data)
+                    except (IOError, OSError) as e:
+                        log.error("cannot write the transcript of {}: {}".format(transcript.name, e))
+                        self._metrics["errors"] += 1
+                        continue
+                    if data is None:
+                        self._opened.discard(transcript)
+                    else:
+                        written.add(transcript)
+                        self._metrics["written_bytes"] += len(data)
+                # the files are flushed whenever the queue is empty
+                for transcript in written:
+                    try:
+                        transcript._flush()
+                    except (IOError, OSError) as e:
+                        log.error("cannot write the transcript of {}: {}".format(transcript.name, e))
+                        self._metrics["errors"] += 1
+            with self._condition:
+                self._pending -= sum(len(data) for transcript, timestamp, data in entries if data is not None)
+
+    def close(self):
+        """
+        Writes the queued output and stops the writer thread.
+        """
+
+        with self._condition:
+            thread = self._thread
+            self._running = False
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            self._thread = None
+        with self.io_lock:
+            for transcript in self._opened:
+                transcript._close()
+            self._opened.clear()
+
+    def metrics(self):
+        """
+        Returns the transcript counters.
+
+        :returns: list of (name, value) tuples
+        """
+
+        with self._condition:
+            snapshot = [("transcripts.{}".format(name), self._metrics[name])
+                        for name in ("written_bytes", "dropped_bytes", "errors")]
+            snapshot.append(("transcripts.pending_bytes", self._pending))
+        return snapshot
@@ -28,18 +28,38 @@ This is the server part, it can be started manually or automatically by GNS3.
 
 from __future__ import print_function
 
-import csv
-import cStringIO
 import os
 import select
 import socket
 import sys
+import re
 import threading
+import time
+import collections
+import fnmatch
+import functools
 import SocketServer
 
 from optparse import OptionParser
 from virtualbox_controller import VirtualBoxController
 from virtualbox_error import VirtualBoxError
+from event_server import EventServer
+from tokenizer import tokenize, quote
+from instance_registry import InstanceRegistry
+from jobs import JobManager
+from settings_cache import SettingsCache
+from session_pool import SessionPool
+from start_scheduler import StartScheduler
+from shutdown import shutdown
+from console_hub import ConsoleHub
+from scrollback import Scrollback, printable
+from transcript import Transcripts
+from tcp_pipe_proxy import set_output_buffer, DROP_OLDEST, DISCONNECT
+from machine_state import MachineStateCache, MachineEntry, VirtualBoxEventSource, read_machine_info, enum_names
+import jobs
+import retry
+import topology
+from worker_pool import WorkerPool, KeyedExecutor
 from adapters.ethernet_adapter import EthernetAdapter
 from nios.nio_udp import NIO_UDP
 
@@ -67,12 +87,26 @@ __version__ = '0.9.1'
 
 PORT = 11525
 IP = ""
-VBOX_INSTANCES = {}
+VBOX_INSTANCES = InstanceRegistry()
+JOBS = JobManager()
+MACHINE_STATES = MachineStateCache()
+SETTINGS_CACHE = SettingsCache()
+SESSION_POOL = None
+START_SCHEDULER = StartScheduler()
+# Windows named pipes cannot be polled, each console gets its own thread there
+CONSOLE_HUB = None if sys.platform.startswith('win') else ConsoleHub()
 FORCE_IPV6 = False
 VBOX_STREAM = 0
 VBOXVER = 0.0
 VBOXVER_REQUIRED = 4.1
 VBOX_MANAGER = 0
+# seconds a command may spend retrying VirtualBox API calls
+RETRY_DEADLINE = 30.0
+SHUTDOWN_TIMEOUT = 30.0
+# bytes of console output kept for each VM
+SCROLLBACK_SIZE = 65536
+# console transcripts, disabled unless a directory is given
+TRANSCRIPTS = None
 
 try:
     from vboxapi import VirtualBoxManager
@@ -117,26 +151,38 @@ class VBOXInstance:
         self.netcard = 'Automatic'
         self.headless_mode = False
         self.enable_console = True
+        # telnet or raw, raw consoles copy the bytes as they are for the automation clients
+        self.console_mode = 'telnet'
         self.process = None
         self.pipeThread = None
         self.pipe = None
         self._vboxcontroller = None
         self._ethernet_adapters = []
+        # kept across restarts so the output of a VM can be read after it stopped
+        self.scrollback = Scrollback(SCROLLBACK_SIZE)
+        self.transcript = TRANSCRIPTS.open(name) if TRANSCRIPTS is not None else None
         self.valid_attr_names = ['image',
                                  'console',
                                  'nics',
                                  'netcard',
                                  'headless_mode',
                                  'enable_console',
+                                 'console_mode',
                                  'nic_start_index']
 
+    @property
+    def controller(self):
+
+        return self._vboxcontroller
+
     def _start_vbox_service(self, vmname):
 
         global VBOX_STREAM, VBOX_MANAGER, IP
 
         # Initialize the controller
         vbox_manager = VBOX_MANAGER
-        self._vboxcontroller = VirtualBoxController(vmname, vbox_manager, IP)
+        self._vboxcontroller = VirtualBoxController(vmname, vbox_manager, IP, MACHINE_STATES, SETTINGS_CACHE, SESSION_POOL,
+                                                    CONSOLE_HUB, self.scrollback, self.transcript)
 
         # Initialize win32 COM
         if sys.platform == 'win32':
@@ -162,6 +208,7 @@ class VBOXInstance:
         self._vboxcontroller.adapter_type = self.netcard
         self._vboxcontroller.headless = self.headless_mode
         self._vboxcontroller.enable_console = self.enable_console
+        self._vboxcontroller.console_mode = self.console_mode
         self._ethernet_adapters = []
         for adapter_id in range(0, int(self.nic_start_index) + int(self.nics)):
             if adapter_id < int(self.nic_start_index):
@@ -253,6 +300,70 @@ class VBOXInstance:
             return False
         return True
 
+    def stats(self):
+        """
+        Returns statistics about the last start of this instance.
+
+        :returns: list of (name, value) tuples
+        """
+
+        if not self._vboxcontroller:
+            return []
+        timings = self._vboxcontroller.start_timings
+        stats = [("%s_time" % phase, "%.3f" % seconds) for phase, seconds in timings]
+        if timings:
+            stats.append(("start_time", "%.3f" % sum(seconds for phase, seconds in timings)))
+            stats.extend(self._vboxcontroller.start_counters)
+        return stats
+
+    def console_tail(self, count=None):
+        """
+        Returns the last console output of this instance.
+
+        :param count: maximum number of bytes
+
+        :returns: string
+        """
+
+        return self.scrollback.tail(count)
+
+    def console_wait(self, pattern, timeout, since=None):
+        """
+        Waits for a line of console output matching a regular expression.
+
+        :param pattern: regular expression
+        :param timeout: timeout in seconds
+        :param since: number of bytes of output written before the
+        output searched, from the start of the current line by default
+
+        :returns: matching line or None on timeout
+        """
+
+        return self.scrollback.wait(pattern, timeout, since)
+
+    def console_send(self, data):
+        """
+        Sends bytes to the serial console of this instance.
+
+        :param data: string
+
+        :returns: number of bytes of console output written before them
+        """
+
+        if not self._vboxcontroller:
+            raise VirtualBoxError("{} is not started".format(self.name))
+        written = self.scrollback.written
+        self._vboxcontroller.send_to_console(data)
+        return written
+
+    def close_transcript(self):
+        """
+        Closes the console transcript of this instance, its files are kept.
+        """
+
+        if self.transcript is not None:
+            self.transcript.close()
+
     def create_udp(self, i_vnic, sport, daddr, dport):
         """
         Creates an UDP tunnel.
@@ -283,21 +394,93 @@ class VBOXInstance:
             return False
         return True
 
-class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
+    def apply_links(self, changes, save=True):
+        """
+        Creates and deletes UDP tunnels at once.
+
+        :param changes: list of ("create", i_vnic, sport, daddr, dport)
+        and ("delete", i_vnic) tuples
+        :param save: False to keep the changes out of the VM settings file
+        """
+
+        log.debug("{}: apply_links".format(self.name))
+        try:
+            if not self._vboxcontroller:
+                return True
+            changes = [(change[0], int(change[1])) + tuple(change[2:]) for change in changes]
+            self._vboxcontroller.apply_udp_changes(changes, save)
+        except VirtualBoxError as e:
+            log.error(e)
+            return False
+        return True
+
+def locks_instance(method):
+    """
+    Decorates a command handler to run it with the lock of the
+    instance named by its first parameter held.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, data):
+        with VBOX_INSTANCES.lock(data[0]):
+            return method(self, data)
+    return wrapper
+
+
+class RequestContext(threading.local):
+    """
+    Per thread request state: the tag of the request being run
+    and the buffer collecting the replies of a batch.
+    """
+
+    tag = None
+    buffer = None
+
+
+class DispatchTableType(type):
+    """
+    Builds the dispatch table of a request handler class when the class
+    is created. The table maps (module, command) to the name of the
+    do_<module>_<command> method and to its (min, max) number of parameters,
+    the bounds are None when the command is missing from the modules.
+    """
+
+    def __init__(cls, name, bases, attrs):
+
+        type.__init__(cls, name, bases, attrs)
+        modules = getattr(cls, 'modules', {})
+        table = {}
+        for attr in dir(cls):
+            if not attr.startswith('do_'):
+                continue
+            for module in modules:
+                prefix = 'do_%s_' % module
+                if attr.startswith(prefix):
+                    command = attr[len(prefix):]
+                    table[(module, command)] = (attr, modules[module].get(command))
+        cls.dispatch_table = table
+
+
+class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler, object):
     """
     Handles requests.
     """
 
+    __metaclass__ = DispatchTableType
+
     modules = {
         'vboxwrapper': {
             'version': (0, 0),
             'reset': (0, 0),
             'close': (0, 0),
             'stop': (0, 0),
+            'batch': (1, 1),
+            'stats': (0, 0),
             },
         'vbox' : {
             'version': (0, 0),
             'vm_list': (0, 0),
+            'vm_query': (0, 3),
             'find_vm': (1, 1),
             'rename': (2, 2),
             'create': (2, 2),
@@ -313,7 +496,27 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
             'suspend': (1, 1),
             'resume': (1, 1),
             'clean': (1, 1),
-            }
+            'start_async': (1, 1),
+            'stop_async': (1, 1),
+            'suspend_async': (1, 1),
+            'status': (1, 1),
+            'status_all': (0, 0),
+            'stats': (1, 1),
+            'start_queue': (0, 1),
+            'console_tail': (1, 2),
+            'console_wait': (3, 3),
+            'console_transcript': (2, 3),
+            'console_send': (3, 4),
+            'apply_links': (1, 2),
+            'apply_topology': (1, 2),
+            },
+        'job': {
+            'status': (1, 1),
+            'wait': (1, 2),
+            'cancel': (1, 1),
+            'list': (0, 0),
+            'notify': (1, 1),
+            },
         }
 
     vbox_classes = {
@@ -337,9 +540,67 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
     HSC_ERR_STOP        = 210  #  unable to stop object
     HSC_ERR_FILE        = 211  #  file error
     HSC_ERR_BAD_OBJ     = 212  #  bad object
+    HSC_ERR_TIMEOUT     = 213  #  timeout
+
+    # maximum number of bytes of a console_transcript reply
+    transcript_reply_limit = 1024 * 1024
+
+    # instance operations: error code, error message, success message
+    operations = {
+        'start': (HSC_ERR_START, "unable to start instance '%s'", "VBox '%s' started"),
+        'stop': (HSC_ERR_STOP, "unable to stop instance '%s'", "VBox '%s' stopped"),
+        'reset': (HSC_ERR_STOP, "unable to reset instance '%s'", "VBox '%s' rebooted"),
+        'suspend': (HSC_ERR_STOP, "unable to suspend instance '%s'", "VBox '%s' suspended"),
+        'resume': (HSC_ERR_STOP, "unable to resume instance '%s'", "VBox '%s' resumed"),
+        }
+
+    # vbox commands whose first parameter is an instance name
+    instance_commands = frozenset([
+        'status',
+        'stats',
+        'rename',
+        'delete',
+        'setattr',
+        'create_udp',
+        'delete_udp',
+        'create_capture',
+        'delete_capture',
+        'start',
+        'stop',
+        'reset',
+        'suspend',
+        'resume',
+        ])
+
+    # commands waiting for other tasks, they never run in the worker
+    # pool where they could hold the workers the awaited tasks need
+    waiting_commands = frozenset([
+        ('job', 'wait'),
+        ('vbox', 'console_wait'),
+        ('vbox', 'console_send'),
+        ])
 
     close_connection = 0
 
+    def setup(self):
+        """
+        Prepares a client connection.
+        """
+
+        SocketServer.StreamRequestHandler.setup(self)
+        self._init_request_state()
+
+    def _init_request_state(self):
+        """
+        Initializes the per connection request state.
+        """
+
+        self._write_lock = threading.Lock()
+        self._context = RequestContext()
+        self._batch = None
+        self._links = None
+        self._notify_jobs = False
+
     def handle(self):
         """
         Handles a client connection.
@@ -356,19 +617,6 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
             self.request.close()
             return
 
-    def __get_tokens(self, request):
-        """
-        Tokenize a request.
-        """
-
-        input_ = cStringIO.StringIO(request)
-        tokens = []
-        try:
-            tokens = csv.reader(input_, delimiter=' ').next()
-        except StopIteration:
-            pass
-        return tokens
-
     def finish(self):
         """
         Handles a client disconnection.
@@ -388,10 +636,48 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         #if request == "":
         #    return
 
+        self.process_request(request)
+
+    def process_request(self, request):
+        """
+        Parses and executes one request line.
+        """
+
         request = request.rstrip()      # Strip package delimiter.
 
         # Parse request.
-        tokens = self.__get_tokens(request)
+        tokens = tokenize(request)
+
+        if self._batch is not None and tokens != ['vboxwrapper', 'batch', 'end']:
+            # collect the batched requests until the end of the batch
+            self._batch.append(request)
+            return
+
+        if self._links is not None and tokens[:3] != ['vbox', 'apply_links', 'end']:
+            # collect the link changes until they are applied
+            self._links[1].append(tokens)
+            return
+
+        # Requests may be tagged with a first "@<tag>" token, tagged requests
+        # run asynchronously and their replies are prefixed with the tag.
+        # Requests, batched ones included, are always processed without
+        # a tag in the context, the untagged ones are dispatched without
+        # touching it.
+        if not tokens or not tokens[0].startswith('@'):
+            self.__dispatch(tokens)
+            return
+        context = self._context
+        context.tag = tokens[0][1:]
+        try:
+            self.__dispatch(tokens[1:])
+        finally:
+            context.tag = None
+
+    def __dispatch(self, tokens):
+        """
+        Checks a tokenized request and calls its command handler.
+        """
+
         if len(tokens) < 2:
             try:
                 self.send_reply(self.HSC_ERR_PARSING, 1, "At least a module and a command must be specified")
@@ -402,35 +688,207 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         module, command = tokens[:2]
         data = tokens[2:]
 
-        if not module in self.modules.keys():
-            self.send_reply(self.HSC_ERR_UNK_MODULE, 1,
-                            "Unknown module '%s'" % module)
-            return
-
-        # Prepare to call the do_<command> function.
-        mname = 'do_%s_%s' % (module, command)
-
-        if not hasattr(self, mname):
-            self.send_reply(self.HSC_ERR_UNK_CMD, 1,
-                            "Unknown command '%s'" % command)
+        entry = self.dispatch_table.get((module, command))
+        if entry is None:
+            if module not in self.modules:
+                self.send_reply(self.HSC_ERR_UNK_MODULE, 1,
+                                "Unknown module '%s'" % module)
+            else:
+                self.send_reply(self.HSC_ERR_UNK_CMD, 1,
+                                "Unknown command '%s'" % command)
             return
 
-        try:
-            if len(data) < self.modules[module][command][0] or len(data) > self.modules[module][command][1]:
-                self.send_reply(self.HSC_ERR_BAD_PARAM, 1,
-                                "Bad number of parameters (%d with min/max=%d/%d)" % (len(data),
-                                                                                      self.modules[module][command][0],
-                                                                                      self.modules[module][command][1]))
-                return
-        except Exception as e:
+        mname, bounds = entry
+        if bounds is None:
             # This can happen, if you add send command, but forget to define it in class modules
             self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Unknown Exception")
-            log.error("exception in handle_one_request(): {}".format(e))
+            log.error("exception in handle_one_request(): no parameter bounds for {} {}".format(module, command))
+            return
+
+        if len(data) < bounds[0] or len(data) > bounds[1]:
+            self.send_reply(self.HSC_ERR_BAD_PARAM, 1,
+                            "Bad number of parameters (%d with min/max=%d/%d)" % (len(data), bounds[0], bounds[1]))
             return
 
         # Call the function.
         method = getattr(self, mname)
-        method(data)
+        self.run_command(module, command, method, data)
+
+    def command_key(self, module, command, data):
+        """
+        Returns the name of the instance a command applies to,
+        commands with the same key are run in order.
+        """
+
+        if module == 'vbox' and data:
+            if command == 'create' and len(data) > 1:
+                return data[1]
+            if command in self.instance_commands:
+                return data[0]
+        # other commands only keep their order on this connection
+        return self
+
+    def in_batch(self):
+        """
+        Returns either the current thread is running a batch.
+        """
+
+        return self._context.buffer is not None
+
+    def run_command(self, module, command, method, data):
+        """
+        Runs a command handler.
+
+        Tagged commands are queued behind the pending commands for the same
+        instance and the next request is read without waiting for them.
+        """
+
+        context = self._context
+        if context.tag is not None and context.buffer is None:
+            if (module, command) in self.waiting_commands:
+                self._run_waiting(method, data)
+                return
+            key = self.command_key(module, command, data)
+            self.server.executor.submit(key, self._run_in_context, ((context.tag, None), method, data))
+        elif self.server.executor.idle():
+            method(data)
+        else:
+            self._run_ordered(module, command, method, data)
+
+    def _run_ordered(self, module, command, method, data):
+        """
+        Runs a command handler once the tagged commands
+        pending for the same instance are done.
+        """
+
+        executor = self.server.executor
+        key = self.command_key(module, command, data)
+        if executor.pending(key) and (module, command) in self.waiting_commands:
+            # only the pending commands are waited for in the pool
+            done = threading.Event()
+            executor.submit(key, done.set)
+            done.wait()
+            method(data)
+        elif executor.pending(key):
+            done = threading.Event()
+            context = (self._context.tag, self._context.buffer)
+            executor.submit(key, self._run_in_context, (context, method, data), done.set)
+            done.wait()
+        else:
+            method(data)
+
+    def _run_waiting(self, method, data):
+        """
+        Runs a tagged command waiting for other tasks in a thread of
+        its own, the next request is read without waiting for it.
+        """
+
+        thread = threading.Thread(target=self._run_in_context, args=((self._context.tag, None), method, data),
+                                  name="waiting-command")
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run_in_context(self, context, method, data):
+        """
+        Runs a command handler in a worker thread with the
+        reply tag and buffer of the requesting thread.
+        """
+
+        self._context.tag, self._context.buffer = context
+        try:
+            method(data)
+        finally:
+            self._context.tag = self._context.buffer = None
+
+    def _run_batch(self, requests):
+        """
+        Runs batched requests and sends all their replies at once.
+        """
+
+        self._context.buffer = []
+        try:
+            for request in requests:
+                self.process_request(request)
+            self.send_reply(self.HSC_INFO_OK, 1, "batch of %d commands done" % len(requests))
+        finally:
+            replies = "".join(self._context.buffer)
+            self._context.buffer = None
+        self._write(replies)
+
+    def run_batch(self, requests):
+        """
+        Runs batched requests.
+        """
+
+        self._run_batch(requests)
+
+    def _write(self, data):
+        """
+        Writes data to the client, replies written by
+        different threads are not interleaved.
+        """
+
+        with self._write_lock:
+            self.wfile.write(data)
+
+    def send_notification(self, tag, code, msg):
+        """
+        Pushes a tagged reply that does not answer any request.
+        """
+
+        context = self._context
+        previous = context.tag, context.buffer
+        context.tag, context.buffer = tag, None
+        try:
+            self.send_reply(code, 1, msg)
+        except socket.error as e:
+            log.warning("could not send notification to {}: {}".format(self.client_address, e))
+        finally:
+            context.tag, context.buffer = previous
+
+    def run_operation(self, name, operation):
+        """
+        Runs an operation on an instance.
+
+        :returns: (status code, message) tuple
+        """
+
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
+            return self.HSC_ERR_UNK_OBJ, "unable to find VBox '%s'" % name
+        error_code, error_msg, done_msg = self.operations[operation]
+
+        def run():
+            with retry.deadline(RETRY_DEADLINE):
+                return getattr(instance, operation)()
+
+        with VBOX_INSTANCES.lock(name):
+            if operation == 'start':
+                # waits for its turn, the retry deadline starts once admitted
+                success = START_SCHEDULER.run(name, run)
+            else:
+                success = run()
+        if not success:
+            return error_code, error_msg % name
+        return self.HSC_INFO_OK, done_msg % name
+
+    def send_replies(self, replies):
+        """
+        Sends several replies with a single write.
+
+        :param replies: list of (code, done, msg) tuples
+        """
+
+        tag = self._context.tag
+        prefix = "@%s " % tag if tag is not None else ""
+        data = "".join(["%s%3d%s%s\r\n" % (prefix, code, '-' if done else ' ', msg)
+                        for code, done, msg in replies])
+        context = self._context
+        if context.buffer is not None:
+            context.buffer.append(data)
+        else:
+            with self._write_lock:
+                self.wfile.write(data)
 
     def send_reply(self, code, done, msg):
         """
@@ -441,7 +899,14 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         if not done:
             sep = ' '
         reply = "%3d%s%s\r\n" % (code, sep, msg)
-        self.wfile.write(reply)
+        context = self._context
+        if context.tag is not None:
+            reply = "@%s %s" % (context.tag, reply)
+        if context.buffer is not None:
+            context.buffer.append(reply)
+        else:
+            with self._write_lock:
+                self.wfile.write(reply)
 
     def do_vboxwrapper_version(self, data):
         """
@@ -450,13 +915,33 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
 
         self.send_reply(self.HSC_INFO_OK, 1, __version__)
 
+    def do_vboxwrapper_stats(self, data):
+        """
+        Handles the vboxwrapper stats command.
+        """
+
+        stats = retry.metrics()
+        if SESSION_POOL is not None:
+            stats.extend(SESSION_POOL.metrics())
+        stats.extend(START_SCHEDULER.metrics())
+        if CONSOLE_HUB is not None:
+            stats.extend(CONSOLE_HUB.metrics())
+        if TRANSCRIPTS is not None:
+            stats.extend(TRANSCRIPTS.metrics())
+        replies = [(self.HSC_INFO_MSG, 0, "%s %s" % stat) for stat in stats]
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
+
     def do_vboxwrapper_reset(self, data):
         """
         Handles the vboxwrapper reset command.
         """
 
-        cleanup()
-        self.send_reply(self.HSC_INFO_OK, 1, "OK")
+        late, failed = cleanup(final=False)
+        replies = [(self.HSC_INFO_MSG, 0, "%s has not been stopped in time (%s)" % entry) for entry in sorted(late.items())]
+        replies.extend((self.HSC_INFO_MSG, 0, "%s could not be stopped (%s)" % entry) for entry in sorted(failed.items()))
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
 
     def do_vboxwrapper_close(self, data):
         """
@@ -475,6 +960,32 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         self.close_connection = 1
         self.server.stop()
 
+    def do_vboxwrapper_batch(self, data):
+        """
+        Handles the vboxwrapper batch command.
+
+        The requests received between "vboxwrapper batch begin" and
+        "vboxwrapper batch end" are run in order when the batch ends,
+        their replies are followed by a final reply and sent in one write.
+        "vboxwrapper batch begin" itself has no reply.
+        """
+
+        action, = data
+        if action == 'begin':
+            if self.in_batch():
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Nested batches are not supported")
+                return
+            self._batch = []
+        elif action == 'end':
+            if self._batch is None:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "No batch in progress")
+                return
+            requests = self._batch
+            self._batch = None
+            self.run_batch(requests)
+        else:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Unknown batch action '%s'" % action)
+
     def do_vbox_version(self, data):
         """
         Handles the vbox version command.
@@ -502,14 +1013,78 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         Handles the vbox vm_list command.
         """
 
-        if VBOX_MANAGER:
-            try:
+        replies = []
+        try:
+            machines = MACHINE_STATES.machines()
+            if machines is not None:
+                for info, entry in machines:
+                    replies.append((self.HSC_INFO_MSG, 0, info.name))
+            elif VBOX_MANAGER:
                 machines = VBOX_MANAGER.getArray(VBOX_MANAGER.vbox, 'machines')
                 for ni in range(len(machines)):
-                    self.send_reply(self.HSC_INFO_MSG, 0, machines[ni].name)
-            except Exception:
-                pass
-        self.send_reply(self.HSC_INFO_OK, 1, "OK")
+                    replies.append((self.HSC_INFO_MSG, 0, machines[ni].name))
+        except Exception:
+            pass
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
+
+    def __query_machines(self):
+        """
+        Returns the catalogue of the registered machines,
+        from the machine state cache when it is live.
+
+        :returns: list of (MachineInfo, MachineEntry) tuples
+        """
+
+        machines = MACHINE_STATES.machines()
+        if machines is not None:
+            return machines
+        machines = []
+        if VBOX_MANAGER:
+            # no event listener, ask VirtualBox
+            chipset_names = enum_names(VBOX_MANAGER, 'ChipsetType')
+            for machine in VBOX_MANAGER.getArray(VBOX_MANAGER.vbox, 'machines'):
+                try:
+                    info = read_machine_info(VBOX_MANAGER, machine, chipset_names)
+                    entry = MachineEntry(info.id, info.name, machine.state, machine.sessionState)
+                except Exception:
+                    continue
+                machines.append((info, entry))
+            machines.sort(key=lambda machine: machine[0].name)
+        return machines
+
+    def do_vbox_vm_query(self, data):
+        """
+        Handles the vbox vm_query command.
+
+        vm_query [<pattern> [<offset> [<limit>]]] lists the machines whose
+        name matches a glob pattern with their state, OS type, maximum
+        number of network adapters and chipset. A limit of 0 means no limit.
+        """
+
+        pattern = data[0] if data else '*'
+        try:
+            offset = int(data[1]) if len(data) > 1 else 0
+            limit = int(data[2]) if len(data) > 2 else 0
+            if offset < 0 or limit < 0:
+                raise ValueError
+        except ValueError:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "offset and limit must be positive integers")
+            return
+        try:
+            machines = self.__query_machines()
+        except Exception as e:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1, "unable to list the VMs: %s" % e)
+            return
+
+        matched = [machine for machine in machines if fnmatch.fnmatchcase(machine[0].name, pattern)]
+        end = offset + limit if limit else len(matched)
+        replies = []
+        for info, entry in matched[offset:end]:
+            state = MACHINE_STATES.describe(entry)[0]
+            replies.append((self.HSC_INFO_MSG, 0, "%s %s %s %d %s" % (quote(info.name), state, info.ostype, info.nics, info.chipset)))
+        replies.append((self.HSC_INFO_OK, 1, "%d of %d VMs" % (len(replies), len(matched))))
+        self.send_replies(replies)
 
     def do_vbox_find_vm(self, data):
         """
@@ -534,11 +1109,9 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
         except KeyError:
             log.error("No device type %s" % dev_type)
             return 1
-        if name in VBOX_INSTANCES.keys():
+        if not VBOX_INSTANCES.add(name, devclass(name)):
             log.error("Unable to create VBox instance {}, it already exists".format(name))
             return 1
-
-        VBOX_INSTANCES[name] = devclass(name)
         return 0
 
     def do_vbox_create(self, data):
@@ -560,28 +1133,31 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
 
         old_name, new_name = data
 
-        if old_name in VBOX_INSTANCES:
-            vbox_instance = VBOX_INSTANCES[old_name]
-            vbox_instance.rename(new_name)
-            VBOX_INSTANCES[new_name] = VBOX_INSTANCES[old_name]
-            del VBOX_INSTANCES[old_name]
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '{}' renamed to '{}'".format(old_name, new_name))
-        else:
-            self.send_reply(self.HSC_ERR_CREATE, 1,
-                            "Unable to rename VBox instance from '{}'".format(old_name))
+        # both names are locked, always in the same order
+        first, second = sorted((old_name, new_name))
+        with VBOX_INSTANCES.lock(first), VBOX_INSTANCES.lock(second):
+            if VBOX_INSTANCES.rename(old_name, new_name):
+                VBOX_INSTANCES[new_name].rename(new_name)
+                self.send_reply(self.HSC_INFO_OK, 1, "VBox '{}' renamed to '{}'".format(old_name, new_name))
+            else:
+                self.send_reply(self.HSC_ERR_CREATE, 1,
+                                "Unable to rename VBox instance from '{}'".format(old_name))
 
     def __vbox_delete(self, name):
         """
         Deletes a vbox instance.
         """
 
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             return 1
-        if VBOX_INSTANCES[name].process and not VBOX_INSTANCES[name].stop():
+        if instance.process and not instance.stop():
             return 1
-        del VBOX_INSTANCES[name]
+        VBOX_INSTANCES.remove(name)
+        instance.close_transcript()
         return 0
 
+    @locks_instance
     def do_vbox_delete(self, data):
         """
         Handles the vbox delete command.
@@ -594,6 +1170,7 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
             self.send_reply(self.HSC_ERR_DELETE, 1,
                             "unable to delete VBox instance '%s'" % name)
 
+    @locks_instance
     def do_vbox_setattr(self, data):
         """
         Handles the setattr command.
@@ -604,158 +1181,842 @@ class VBoxWrapperRequestHandler(SocketServer.StreamRequestHandler):
             value = True
         elif value == 'False':
             value = False
+        code, msg = self.__set_attribute(name, attr, value)
+        self.send_reply(code, 1, msg)
+
+    def __set_attribute(self, name, attr, value):
+        """
+        Sets an instance attribute.
+
+        :returns: (status code, message) tuple
+        """
+
         try:
             instance = VBOX_INSTANCES[name]
         except KeyError:
-            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
-                             "unable to find VBox '%s'" % name)
-            return
+            return self.HSC_ERR_UNK_OBJ, "unable to find VBox '%s'" % name
         if not attr in instance.valid_attr_names:
-            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
-                            "Cannot set attribute '%s' for '%s" % (attr, name))
-            return
+            return self.HSC_ERR_UNK_OBJ, "Cannot set attribute '%s' for '%s" % (attr, name)
+        if attr == 'console':
+            owner = VBOX_INSTANCES.set_console(name, value)
+            if owner is not None:
+                return self.HSC_ERR_BINDING, "console port %s is already used by '%s'" % (value, owner)
+        elif attr == 'console_mode' and value not in ('telnet', 'raw'):
+            return self.HSC_ERR_INV_PARAM, "console_mode must be telnet or raw"
+        elif attr == 'image':
+            others = VBOX_INSTANCES.set_image(name, value)
+            if others:
+                log.warning("VirtualBox VM {} is also used by {}".format(value, ", ".join(others)))
         print("!! {}.{} = {}".format(name, attr, value))
-        setattr(VBOX_INSTANCES[name], attr, value)
-        self.send_reply(self.HSC_INFO_OK, 1, "%s set for '%s'" % (attr, name))
+        setattr(instance, attr, value)
+        return self.HSC_INFO_OK, "%s set for '%s'" % (attr, name)
+
+    def do_vbox_apply_topology(self, data):
+        """
+        Handles the apply_topology command.
+
+        The topology is a JSON object (see the topology module), only
+        the differences with the registered instances are applied. With
+        "prune", the instances missing from the topology are deleted.
+        Each change made is replied as an informative message, the
+        changes which failed with their error, before the final reply.
+        """
 
+        if len(data) > 1 and data[1] != 'prune':
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Unknown apply_topology option '%s'" % data[1])
+            return
+        try:
+            vms = topology.parse(data[0])
+        except topology.TopologyError as e:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Invalid topology: %s" % e)
+            return
+
+        def resolve(host):
+            udp_connection = UDPConnection(None, host, None)
+            udp_connection.resolve_names()
+            return udp_connection.rhost
+
+        changes = topology.diff(vms, dict(VBOX_INSTANCES.items()), len(data) > 1, resolve)
+        replies = []
+        made = 0
+        links = collections.OrderedDict()
+        # the commands for these instances must not wait for their locks in the event loop
+        with self.server.executor.hold(set(change[1] for change in changes)):
+            # the console ports changed are freed first so that they can be
+            # swapped between instances, like the ports of the links
+            consoles = {}
+            for change in changes:
+                if change[0] == 'setattr' and change[2] == 'console' and change[1] in VBOX_INSTANCES:
+                    with VBOX_INSTANCES.lock(change[1]):
+                        consoles[change[1]] = VBOX_INSTANCES.remove_console(change[1])
+            for change in changes:
+                kind, name = change[:2]
+                description = " ".join([quote(str(token)) for token in change])
+                if kind == 'delete_udp':
+                    # free the port for the links created by other instances,
+                    # it is indexed again if the deletion fails
+                    with VBOX_INSTANCES.lock(name):
+                        VBOX_INSTANCES.remove_udp(name, change[2])
+                    links.setdefault(name, []).append(('delete', str(change[2])))
+                    continue
+                if kind == 'create_udp':
+                    links.setdefault(name, []).append(('create', str(change[2])) + change[3:])
+                    continue
+                with VBOX_INSTANCES.lock(name):
+                    code, msg = self.__apply_topology_change(change)
+                    if code != self.HSC_INFO_OK and kind == 'setattr' and change[2] == 'console':
+                        msg = self.__restore_console(name, consoles.get(name), msg)
+                if code == self.HSC_INFO_OK:
+                    made += 1
+                    replies.append((self.HSC_INFO_MSG, 0, description))
+                else:
+                    replies.append((code, 0, msg))
+
+            for name, instance_changes in links.items():
+                with VBOX_INSTANCES.lock(name), retry.deadline(RETRY_DEADLINE):
+                    applied = self.__apply_instance_links(name, instance_changes, True, replies)
+                made += len(applied)
+                for change in applied:
+                    tokens = ("%s_udp" % change[0], name) + change[1:]
+                    replies.append((self.HSC_INFO_MSG, 0, " ".join([quote(token) for token in tokens])))
+        replies.append((self.HSC_INFO_OK, 1, "%d of %d changes made" % (made, len(changes))))
+        self.send_replies(replies)
+
+    def __restore_console(self, name, port, msg):
+        """
+        Indexes again the console port freed for a console change which failed.
+
+        :returns: error message of the change
+        """
+
+        if port is None or name not in VBOX_INSTANCES:
+            return msg
+        owner = VBOX_INSTANCES.set_console(name, port)
+        if owner is not None:
+            msg += ", its console port %s is now used by '%s'" % (port, owner)
+        return msg
+
+    def __apply_topology_change(self, change):
+        """
+        Makes a change computed by topology.diff(), except for the links.
+
+        :returns: (status code, message) tuple
+        """
+
+        kind, name = change[:2]
+        if kind == 'delete':
+            if self.__vbox_delete(name) != 0:
+                return self.HSC_ERR_DELETE, "unable to delete VBox instance '%s'" % name
+        elif kind == 'create':
+            if self.__vbox_create('vbox', name) != 0:
+                return self.HSC_ERR_CREATE, "Unable to create VBox instance '%s'" % name
+        elif kind == 'setattr':
+            return self.__set_attribute(name, change[2], change[3])
+        else:
+            instance = VBOX_INSTANCES.get(name)
+            if instance is None:
+                return self.HSC_ERR_UNK_OBJ, "unable to find VBox '%s'" % name
+            if kind == 'create_capture':
+                instance.capture[change[2]] = change[3]
+            else:
+                instance.capture.pop(change[2], None)
+        return self.HSC_INFO_OK, "OK"
+
+    @locks_instance
     def do_vbox_create_udp(self, data):
         """
         Handles the create udp command.
         """
 
         name, vnic, sport, daddr, dport = data
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
-        VBOX_INSTANCES[name].create_udp(vnic, sport, daddr, dport)
+        owner = VBOX_INSTANCES.add_udp(name, int(vnic), sport)
+        if owner is not None:
+            self.send_reply(self.HSC_ERR_BINDING, 1,
+                            "UDP port %s is already used by '%s'" % (sport, owner))
+            return
+        with retry.deadline(RETRY_DEADLINE):
+            instance.create_udp(vnic, sport, daddr, dport)
         udp_connection = UDPConnection(sport, daddr, dport)
         udp_connection.resolve_names()
-        VBOX_INSTANCES[name].udp[int(vnic)] = udp_connection
+        instance.udp[int(vnic)] = udp_connection
         self.send_reply(self.HSC_INFO_OK, 1, "OK")
 
+    @locks_instance
     def do_vbox_delete_udp(self, data):
         """
         Handles the delete udp command.
         """
 
         name, vnic = data
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
-        VBOX_INSTANCES[name].delete_udp(vnic)
-        if VBOX_INSTANCES[name].udp.has_key(int(vnic)):
-            del VBOX_INSTANCES[name].udp[int(vnic)]
+        with retry.deadline(RETRY_DEADLINE):
+            instance.delete_udp(vnic)
+        VBOX_INSTANCES.remove_udp(name, int(vnic))
+        if int(vnic) in instance.udp:
+            del instance.udp[int(vnic)]
         self.send_reply(self.HSC_INFO_OK, 1, "OK")
 
+    def do_vbox_apply_links(self, data):
+        """
+        Handles the apply_links command.
+
+        The create_udp and delete_udp requests received between
+        "vbox apply_links begin [save|runtime]" and "vbox apply_links end"
+        are applied with a single save of the settings per VM, or without
+        saving them in runtime mode. "vbox apply_links begin" itself has
+        no reply, only the link changes which failed are replied before
+        the final reply.
+        """
+
+        action = data[0]
+        if action == 'begin':
+            mode = data[1] if len(data) > 1 else 'save'
+            if mode not in ('save', 'runtime'):
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Link changes mode must be save or runtime")
+                return
+            if self._links is not None:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Nested link changes are not supported")
+                return
+            self._links = (mode, [])
+        elif action == 'end':
+            if self._links is None:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "No link changes in progress")
+                return
+            mode, requests = self._links
+            self._links = None
+            self.__apply_links(requests, mode == 'save')
+        else:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "Unknown apply_links action '%s'" % action)
+
+    def __apply_links(self, requests, save):
+        """
+        Applies the collected link changes, grouped by instance.
+        """
+
+        replies = []
+        changes = collections.OrderedDict()
+        for tokens in requests:
+            if tokens and tokens[0].startswith('@'):
+                # link changes are replied all at once
+                tokens = tokens[1:]
+            command = tuple(tokens[:2])
+            if command == ('vbox', 'create_udp') and len(tokens) == 7:
+                name, vnic, sport, daddr, dport = tokens[2:]
+                change = ('create', vnic, sport, daddr, dport)
+            elif command == ('vbox', 'delete_udp') and len(tokens) == 4:
+                name, vnic = tokens[2:]
+                change = ('delete', vnic)
+            else:
+                replies.append((self.HSC_ERR_INV_PARAM, 0, "not a link change: '%s'" % " ".join(tokens)))
+                continue
+            if not vnic.isdigit():
+                replies.append((self.HSC_ERR_INV_PARAM, 0, "invalid adapter '%s' for VBox '%s'" % (vnic, name)))
+                continue
+            if name not in VBOX_INSTANCES:
+                replies.append((self.HSC_ERR_UNK_OBJ, 0, "unable to find VBox '%s'" % name))
+                continue
+            changes.setdefault(name, []).append(change)
+
+        applied = 0
+        # the commands for these instances must not wait for their locks in the event loop
+        with self.server.executor.hold(changes):
+            for name, instance_changes in changes.items():
+                with VBOX_INSTANCES.lock(name), retry.deadline(RETRY_DEADLINE):
+                    applied += len(self.__apply_instance_links(name, instance_changes, save, replies))
+        replies.append((self.HSC_INFO_OK, 1, "%d of %d link changes applied to %d VMs" % (applied, len(requests), len(changes))))
+        self.send_replies(replies)
+
+    def __apply_instance_links(self, name, changes, save, replies):
+        """
+        Applies the link changes of an instance.
+
+        :returns: list of the changes applied
+        """
+
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
+            replies.append((self.HSC_ERR_UNK_OBJ, 0, "unable to find VBox '%s'" % name))
+            return []
+        accepted = []
+        for change in changes:
+            if change[0] == 'create':
+                owner = VBOX_INSTANCES.add_udp(name, int(change[1]), change[2])
+                if owner is not None:
+                    replies.append((self.HSC_ERR_BINDING, 0, "UDP port %s is already used by '%s'" % (change[2], owner)))
+                    continue
+            accepted.append(change)
+        if not instance.apply_links(accepted, save):
+            # the index goes back to the tunnels still there
+            for vnic in set(int(change[1]) for change in accepted):
+                if vnic not in instance.udp:
+                    VBOX_INSTANCES.remove_udp(name, vnic)
+                else:
+                    owner = VBOX_INSTANCES.add_udp(name, vnic, instance.udp[vnic].lport)
+                    if owner is not None:
+                        replies.append((self.HSC_ERR_BINDING, 0, "UDP port %s of VBox '%s' is now also used by '%s'" % (
+                            instance.udp[vnic].lport, name, owner)))
+            replies.append((self.HSC_ERR_BINDING, 0, "unable to apply the link changes of VBox '%s'" % name))
+            return []
+        for change in accepted:
+            vnic = int(change[1])
+            if change[0] == 'create':
+                udp_connection = UDPConnection(*change[2:])
+                udp_connection.resolve_names()
+                instance.udp[vnic] = udp_connection
+            else:
+                VBOX_INSTANCES.remove_udp(name, vnic)
+                instance.udp.pop(vnic, None)
+        return accepted
+
+    @locks_instance
     def do_vbox_create_capture(self, data):
         """
         Handles the create capture command.
         """
 
         name, vnic, path = data
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
 
-        VBOX_INSTANCES[name].capture[int(vnic)] = path
+        instance.capture[int(vnic)] = path
         self.send_reply(self.HSC_INFO_OK, 1, "OK")
 
+    @locks_instance
     def do_vbox_delete_capture(self, data):
         """
         Handles the delete capture command.
         """
 
         name, vnic = data
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
-        if VBOX_INSTANCES[name].capture.has_key(int(vnic)):
-            del VBOX_INSTANCES[name].capture[int(vnic)]
+        if int(vnic) in instance.capture:
+            del instance.capture[int(vnic)]
         self.send_reply(self.HSC_INFO_OK, 1, "OK")
 
+    @locks_instance
     def do_vbox_start(self, data):
         """
         Handles the start command.
         """
 
         name, = data
-        if not name in VBOX_INSTANCES.keys():
-            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
-                            "unable to find VBox '%s'" % name)
-            return
-        if not VBOX_INSTANCES[name].start():
-            self.send_reply(self.HSC_ERR_START, 1,
-                            "unable to start instance '%s'" % name)
-        else:
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '%s' started" % name)
+        code, msg = self.run_operation(name, 'start')
+        self.send_reply(code, 1, msg)
 
+    @locks_instance
     def do_vbox_stop(self, data):
         """
         Handles the stop command.
         """
 
         name, = data
-        if not name in VBOX_INSTANCES.keys():
-            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
-                            "unable to find VBox '%s'" % name)
-            return
-        if not VBOX_INSTANCES[name].stop():
-            self.send_reply(self.HSC_ERR_STOP, 1,
-                            "unable to stop instance '%s'" % name)
-        else:
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '%s' stopped" % name)
+        code, msg = self.run_operation(name, 'stop')
+        self.send_reply(code, 1, msg)
 
+    @locks_instance
     def do_vbox_reset(self, data):
         """
         Handles the reset command.
         """
 
         name, = data
-        if not name in VBOX_INSTANCES.keys():
-            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
-                            "unable to find VBox '%s'" % name)
-            return
-        if not VBOX_INSTANCES[name].reset():
-            self.send_reply(self.HSC_ERR_STOP, 1,
-                            "unable to reset instance '%s'" % name)
-        else:
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '%s' rebooted" % name)
+        code, msg = self.run_operation(name, 'reset')
+        self.send_reply(code, 1, msg)
 
+    @locks_instance
     def do_vbox_suspend(self, data):
         """
         Handles the suspend command.
         """
 
         name, = data
-        if not name in VBOX_INSTANCES.keys():
+        code, msg = self.run_operation(name, 'suspend')
+        self.send_reply(code, 1, msg)
+
+    @locks_instance
+    def do_vbox_resume(self, data):
+        """
+        Handles the resume command.
+        """
+
+        name, = data
+        code, msg = self.run_operation(name, 'resume')
+        self.send_reply(code, 1, msg)
+
+    def __machine_status(self, instance):
+        """
+        Returns the machine and session state names of an instance.
+        """
+
+        def read(name):
+            machine = VBOX_MANAGER.vbox.findMachine(name)
+            return machine.id, machine.state, machine.sessionState
+
+        entry = None
+        if instance.image:
+            # without VirtualBox, only the cache is looked at
+            entry = MACHINE_STATES.lookup(instance.image, read if VBOX_MANAGER else None)
+        if entry is None:
+            return "unknown", "unknown"
+        return MACHINE_STATES.describe(entry)
+
+    def do_vbox_status(self, data):
+        """
+        Handles the status command.
+        """
+
+        name, = data
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
-        if not VBOX_INSTANCES[name].suspend():
-            self.send_reply(self.HSC_ERR_STOP, 1,
-                            "unable to suspend instance '%s'" % name)
-        else:
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '%s' suspended" % name)
+        self.send_reply(self.HSC_INFO_OK, 1, "%s %s %s" % ((name,) + self.__machine_status(instance)))
 
-    def do_vbox_resume(self, data):
+    def do_vbox_status_all(self, data):
         """
-        Handles the resume command.
+        Handles the status_all command.
+        """
+
+        replies = [(self.HSC_INFO_MSG, 0, "%s %s %s" % ((name,) + self.__machine_status(instance)))
+                   for name, instance in sorted(VBOX_INSTANCES.items())]
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
+
+    def do_vbox_stats(self, data):
+        """
+        Handles the stats command.
         """
 
         name, = data
-        if not name in VBOX_INSTANCES.keys():
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
+                            "unable to find VBox '%s'" % name)
+            return
+        replies = [(self.HSC_INFO_MSG, 0, "%s %s" % stat) for stat in instance.stats()]
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
+
+    def do_vbox_start_queue(self, data):
+        """
+        Handles the start_queue command, lists the starts
+        running or waiting for their turn with their ETA.
+        """
+
+        if data:
+            name, = data
+            entry = START_SCHEDULER.status(name)
+            if entry is None:
+                self.send_reply(self.HSC_ERR_UNK_OBJ, 1, "no start of '%s' in progress" % name)
+            else:
+                self.send_reply(self.HSC_INFO_OK, 1, "%s %s %d %.1f" % entry)
+            return
+        entries = START_SCHEDULER.queue()
+        replies = [(self.HSC_INFO_MSG, 0, "%s %s %d %.1f" % entry) for entry in entries]
+        running = len([entry for entry in entries if entry[2] == 0])
+        replies.append((self.HSC_INFO_OK, 1, "%d running, %d queued" % (running, len(entries) - running)))
+        self.send_replies(replies)
+
+    def do_vbox_console_tail(self, data):
+        """
+        Handles the console_tail command, replies with the last
+        console output of an instance, one line per reply.
+        """
+
+        name = data[0]
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
+                            "unable to find VBox '%s'" % name)
+            return
+        count = None
+        if len(data) > 1:
+            try:
+                count = int(data[1])
+            except ValueError:
+                count = -1
+            if count < 0:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid byte count '%s'" % data[1])
+                return
+        output = instance.console_tail(count)
+        replies = self.__console_replies(output)
+        replies.append((self.HSC_INFO_OK, 1, "%d bytes" % len(output)))
+        self.send_replies(replies)
+
+    def __console_replies(self, output):
+        """
+        Returns console output as a list of informative replies, one per line.
+        """
+
+        lines = output.split("\n")
+        # the last line is kept when unfinished, it is often a prompt
+        if not lines[-1]:
+            lines.pop()
+        return [(self.HSC_INFO_MSG, 0, printable(line)) for line in lines]
+
+    def do_vbox_console_transcript(self, data):
+        """
+        Handles the console_transcript command, replies with the
+        console output of an instance during a time range, one line
+        per reply. The times are UNIX timestamps, negative ones are
+        seconds before now.
+        """
+
+        name = data[0]
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
+                            "unable to find VBox '%s'" % name)
+            return
+        if instance.transcript is None:
+            self.send_reply(self.HSC_ERR_BAD_OBJ, 1, "console transcripts are disabled")
+            return
+        now = time.time()
+        times = []
+        for value in data[1:]:
+            try:
+                value = float(value)
+            except ValueError:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid time '%s'" % value)
+                return
+            times.append(now + value if value < 0 else value)
+        start = times[0]
+        end = times[1] if len(times) > 1 else None
+        output, begin, stop = instance.transcript.read(start, end, self.transcript_reply_limit)
+        replies = self.__console_replies(output)
+        truncated = ", truncated" if len(output) >= self.transcript_reply_limit else ""
+        replies.append((self.HSC_INFO_OK, 1, "%d bytes from offset %d%s" % (len(output), begin, truncated)))
+        self.send_replies(replies)
+
+    def do_vbox_console_wait(self, data):
+        """
+        Handles the console_wait command, replies with the first
+        line of console output matching a regular expression.
+        """
+
+        name, pattern, timeout = data
+        instance = VBOX_INSTANCES.get(name)
+        if instance is None:
             self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
                             "unable to find VBox '%s'" % name)
             return
-        if not VBOX_INSTANCES[name].resume():
-            self.send_reply(self.HSC_ERR_STOP, 1,
-                            "unable to resume instance '%s'" % name)
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = -1
+        if timeout < 0:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid timeout '%s'" % data[2])
+            return
+        try:
+            line = instance.console_wait(pattern, timeout)
+        except re.error as e:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid pattern '%s': %s" % (pattern, e))
+            return
+        if line is None:
+            self.send_reply(self.HSC_ERR_TIMEOUT, 1, "no output matching '%s' from '%s' within %s seconds" % (pattern, name, data[2]))
+            return
+        self.send_reply(self.HSC_INFO_OK, 1, printable(line))
+
+    def do_vbox_console_send(self, data):
+        """
+        Handles the console_send command, sends the same bytes to the
+        consoles of several instances and collects the output of each
+        one until a line matches a regular expression, or during the
+        timeout without a pattern.
+
+        console_send <names> <data> <timeout> [<pattern>], the names are
+        a comma separated list of instance names or glob patterns and
+        the data may contain escape sequences (\\r, \\n, \\xHH). Each
+        instance is replied as "<name> <status> <bytes> bytes", the status
+        being matched, timeout or done, followed by its output after what
+        was sent, one "<name> <line>" reply per line, or as
+        "<name> failed <error>" when the data could not be sent.
+        """
+
+        selector, payload, timeout = data[:3]
+        pattern = data[3] if len(data) > 3 else None
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            timeout = -1
+        if timeout < 0:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid timeout '%s'" % data[2])
+            return
+        try:
+            payload = payload.decode("string_escape")
+        except ValueError as e:
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid data '%s': %s" % (data[1], e))
+            return
+        if pattern is not None:
+            try:
+                re.compile(pattern, re.MULTILINE)
+            except re.error as e:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid pattern '%s': %s" % (pattern, e))
+                return
+        names = self.__select_instances(selector)
+        if not names:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1, "no VBox matching '%s'" % selector)
+            return
+
+        # the data is sent to all the consoles before waiting for any of them
+        sent = []
+        failed = []
+        for name in names:
+            instance = VBOX_INSTANCES.get(name)
+            if instance is None:
+                continue
+            try:
+                sent.append((name, instance, instance.console_send(payload)))
+            except VirtualBoxError as e:
+                failed.append((name, str(e)))
+        deadline = time.time() + timeout
+        if pattern is None and sent:
+            time.sleep(timeout)
+
+        replies = []
+        counts = dict.fromkeys(("matched", "timeout", "done"), 0)
+        for name, instance, written in sent:
+            status = "done"
+            if pattern is not None:
+                line = instance.console_wait(pattern, max(0.0, deadline - time.time()), written)
+                status = "matched" if line is not None else "timeout"
+            counts[status] += 1
+            count = instance.scrollback.written - written
+            output = instance.console_tail(count)
+            truncated = ", truncated" if len(output) < count else ""
+            replies.append((self.HSC_INFO_MSG, 0, "%s %s %d bytes%s" % (quote(name), status, count, truncated)))
+            replies.extend((code, done, "%s %s" % (quote(name), line)) for code, done, line in self.__console_replies(output))
+        for name, error in failed:
+            replies.append((self.HSC_INFO_MSG, 0, "%s failed %s" % (quote(name), error)))
+        replies.append((self.HSC_INFO_OK, 1, "%d VMs, %d matched, %d timed out, %d done, %d failed" % (
+            len(sent) + len(failed), counts["matched"], counts["timeout"], counts["done"], len(failed))))
+        self.send_replies(replies)
+
+    def __select_instances(self, selector):
+        """
+        Returns the names of the instances matching a comma separated
+        list of names and glob patterns, in the order of the list.
+        """
+
+        names = sorted(VBOX_INSTANCES.names())
+        selected = []
+        for pattern in selector.split(","):
+            for name in names:
+                if fnmatch.fnmatchcase(name, pattern) and name not in selected:
+                    selected.append(name)
+        return selected
+
+    def __submit_job(self, name, operation):
+        """
+        Queues an operation on an instance as a job
+        and replies with the job ID.
+        """
+
+        if name not in VBOX_INSTANCES:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1,
+                            "unable to find VBox '%s'" % name)
+            return
+
+        def run():
+            code, msg = self.run_operation(name, operation)
+            return code == self.HSC_INFO_OK, msg
+
+        def notify(job):
+            if job.state == jobs.CANCELLED:
+                return
+            code = self.HSC_INFO_OK
+            if job.state != jobs.DONE:
+                code = self.operations[operation][0]
+            self.send_notification("job-%s" % job.id, code, job.message)
+
+        job = JOBS.create("%s %s" % (operation, name), run, notify if self._notify_jobs else None)
+        # queued behind the pending commands of the instance to keep their order
+        self.server.executor.submit(name, job.run)
+        self.send_reply(self.HSC_INFO_OK, 1, job.id)
+
+    def do_vbox_start_async(self, data):
+        """
+        Handles the start_async command.
+        """
+
+        name, = data
+        self.__submit_job(name, 'start')
+
+    def do_vbox_stop_async(self, data):
+        """
+        Handles the stop_async command.
+        """
+
+        name, = data
+        self.__submit_job(name, 'stop')
+
+    def do_vbox_suspend_async(self, data):
+        """
+        Handles the suspend_async command.
+        """
+
+        name, = data
+        self.__submit_job(name, 'suspend')
+
+    def __get_job(self, job_id):
+        """
+        Returns a job or replies an error.
+        """
+
+        job = JOBS.get(job_id)
+        if job is None:
+            self.send_reply(self.HSC_ERR_UNK_OBJ, 1, "unknown job '%s'" % job_id)
+        return job
+
+    def do_job_status(self, data):
+        """
+        Handles the job status command.
+        """
+
+        job_id, = data
+        job = self.__get_job(job_id)
+        if job:
+            self.send_reply(self.HSC_INFO_OK, 1, job.status())
+
+    def do_job_wait(self, data):
+        """
+        Handles the job wait command, replies with
+        the job status once it is finished or on timeout.
+        """
+
+        job_id = data[0]
+        timeout = None
+        if len(data) > 1:
+            try:
+                timeout = float(data[1])
+            except ValueError:
+                self.send_reply(self.HSC_ERR_INV_PARAM, 1, "invalid timeout '%s'" % data[1])
+                return
+        job = self.__get_job(job_id)
+        if job:
+            job.wait(timeout)
+            self.send_reply(self.HSC_INFO_OK, 1, job.status())
+
+    def do_job_cancel(self, data):
+        """
+        Handles the job cancel command.
+        """
+
+        job_id, = data
+        job = self.__get_job(job_id)
+        if not job:
+            return
+        if job.cancel():
+            self.send_reply(self.HSC_INFO_OK, 1, job.status())
         else:
-            self.send_reply(self.HSC_INFO_OK, 1, "VBox '%s' resumed" % name)
+            self.send_reply(self.HSC_ERR_STOP, 1, "unable to cancel job %s" % job.status())
+
+    def do_job_list(self, data):
+        """
+        Handles the job list command.
+        """
+
+        replies = [(self.HSC_INFO_MSG, 0, "%s %s" % (job.status(), job.description)) for job in JOBS.jobs()]
+        replies.append((self.HSC_INFO_OK, 1, "OK"))
+        self.send_replies(replies)
+
+    def do_job_notify(self, data):
+        """
+        Handles the job notify command.
+
+        With notifications on, the end of the jobs created by this
+        connection is pushed as a reply tagged with "@job-<id>".
+        """
+
+        mode, = data
+        if mode not in ('on', 'off'):
+            self.send_reply(self.HSC_ERR_INV_PARAM, 1, "notify must be on or off")
+            return
+        self._notify_jobs = mode == 'on'
+        self.send_reply(self.HSC_INFO_OK, 1, "job notifications %s" % mode)
+
+
+class VBoxWrapperEventHandler(VBoxWrapperRequestHandler):
+    """
+    Handles requests for the event-driven server.
+
+    Requests are fed by the event loop instead of being read from
+    a socket file, commands calling VirtualBox run in the worker pool.
+    """
+
+    slow_commands = frozenset([
+        ('vboxwrapper', 'reset'),
+        ('vbox', 'vm_list'),
+        ('vbox', 'vm_query'),
+        ('vbox', 'find_vm'),
+        ('vbox', 'delete'),
+        ('vbox', 'create_udp'),
+        ('vbox', 'delete_udp'),
+        ('vbox', 'apply_links'),
+        ('vbox', 'apply_topology'),
+        ('vbox', 'console_transcript'),
+        ('vbox', 'start'),
+        ('vbox', 'stop'),
+        ('vbox', 'reset'),
+        ('vbox', 'suspend'),
+        ('vbox', 'resume'),
+        ])
+
+    def __init__(self, request, client_address, server):
+
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.wfile = request
+        self._init_request_state()
+
+    def run_command(self, module, command, method, data):
+        """
+        Runs a command handler, in a worker thread if it is slow
+        or if commands are pending for the same instance.
+        """
+
+        if self.in_batch():
+            VBoxWrapperRequestHandler.run_command(self, module, command, method, data)
+            return
+
+        key = self.command_key(module, command, data)
+        tag = self._context.tag
+        if tag is not None and (module, command) in self.waiting_commands:
+            self._run_waiting(method, data)
+        elif tag is not None:
+            self.server.executor.submit(key, self._run_in_context, ((tag, None), method, data))
+        elif (module, command) in self.waiting_commands:
+            self.server.spawn(self.request, method, (data,))
+        elif (module, command) in self.slow_commands or self.server.executor.pending(key):
+            self.server.defer(self.request, key, method, (data,))
+        else:
+            method(data)
+
+    def run_batch(self, requests):
+        """
+        Runs batched requests in their own thread, the
+        connection is resumed once the batch is done.
+        """
+
+        self.server.spawn(self.request, self._run_batch, (requests,))
 
 
 class DaemonThreadingMixIn(SocketServer.ThreadingMixIn):
@@ -773,7 +2034,7 @@ class VBoxWrapperServer(DaemonThreadingMixIn, SocketServer.TCPServer):
 
     allow_reuse_address = True
 
-    def __init__(self, server_address, RequestHandlerClass):
+    def __init__(self, server_address, RequestHandlerClass, workers=8):
 
         global FORCE_IPV6
         if server_address[0].__contains__(':'):
@@ -788,6 +2049,7 @@ class VBoxWrapperServer(DaemonThreadingMixIn, SocketServer.TCPServer):
             sys.exit(1)
         self.stopping = threading.Event()
         self.pause = 0.1
+        self.executor = KeyedExecutor(WorkerPool(workers, name="vbox-worker"))
 
     def serve_forever(self):
         while not self.stopping.isSet():
@@ -799,17 +2061,67 @@ class VBoxWrapperServer(DaemonThreadingMixIn, SocketServer.TCPServer):
         self.stopping.set()
 
 
-def cleanup():
+class VBoxWrapperEventServer(EventServer):
+    """
+    Event-driven TCP server.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, workers=8):
+
+        global FORCE_IPV6
+        if server_address[0].__contains__(':'):
+            FORCE_IPV6 = True
+        if FORCE_IPV6:
+            # IPv6 address support
+            self.address_family = socket.AF_INET6
+        try:
+            EventServer.__init__(self, server_address, RequestHandlerClass, workers)
+        except socket.error as e:
+            log.critical("{}".format(e))
+            sys.exit(1)
+
+    def serve_forever(self):
+        EventServer.serve_forever(self)
+        cleanup()
+
+
+def cleanup(final=True):
     """
     Stops and deletes all VirtualBox instances.
+
+    :param final: True if the wrapper is exiting
+
+    :returns: tuple of two dictionaries by instance name: the step each VM
+    not stopped in time was in and the step each VM failed to stop at
     """
 
     print("Shutdown in progress...")
-    for name in VBOX_INSTANCES.keys():
-        if VBOX_INSTANCES[name].process:
-            VBOX_INSTANCES[name].stop()
-        del VBOX_INSTANCES[name]
+    controllers = {}
+    instances = []
+    for name in VBOX_INSTANCES.names():
+        with VBOX_INSTANCES.lock(name):
+            instance = VBOX_INSTANCES.remove(name)
+            if instance is not None:
+                instances.append(instance)
+                if instance.controller is not None:
+                    controllers[name] = instance.controller
+    late, failed = shutdown(controllers, SHUTDOWN_TIMEOUT)
+    for instance in instances:
+        instance.close_transcript()
+    if late:
+        print("VMs not stopped in time: %s" % ", ".join(sorted(late)))
+    if failed:
+        print("VMs which could not be stopped: %s" % ", ".join(sorted(failed)))
+    if final:
+        MACHINE_STATES.detach()
+        if SESSION_POOL is not None:
+            SESSION_POOL.close()
+        if CONSOLE_HUB is not None:
+            CONSOLE_HUB.stop()
+        if TRANSCRIPTS is not None:
+            TRANSCRIPTS.close()
     print("Shutdown completed.")
+    return late, failed
 
 
 def main():
@@ -830,12 +2142,26 @@ def main():
             print("pywin32 and pythoncom modules must be installed.", file=sys.stderr)
             sys.exit(1)
 
-    usage = "usage: %prog [--listen <ip_address>] [--port <port_number>] [--forceipv6 true]"
+    usage = "usage: %prog [--listen <ip_address>] [--port <port_number>] [--forceipv6 true] [--engine threaded|event]"
     parser = OptionParser(usage, version="%prog " + __version__)
     parser.add_option("-l", "--listen", dest="host", help="IP address or hostname to listen on (default is to listen on all interfaces)")
     parser.add_option("-p", "--port", type="int", dest="port", help="Port number (default is 11525)")
     parser.add_option("-6", "--forceipv6", dest="force_ipv6", help="Force IPv6 usage (default is false; i.e. IPv4)")
     parser.add_option("-n", "--no-vbox-checks", action="store_true", dest="no_vbox_checks", default=False, help="Do not check for vboxapi and VirtualBox version")
+    parser.add_option("-e", "--engine", type="choice", choices=["threaded", "event"], dest="engine", default="threaded", help="Control server engine: one thread per connection (threaded) or a single event loop (event), default is threaded")
+    parser.add_option("-s", "--settings-cache", dest="settings_cache", default=os.path.join(os.path.expanduser("~"), ".vboxwrapper", "settings_cache.json"), help="File recording the settings applied to the VMs, to only change what differs on the next start (default is ~/.vboxwrapper/settings_cache.json, empty to disable)")
+    parser.add_option("--session-pool-size", type="int", dest="session_pool_size", default=4, help="Number of idle VirtualBox sessions kept ready (default is 4)")
+    parser.add_option("--parallel-starts", type="int", dest="parallel_starts", default=4, help="Maximum number of VMs starting at the same time (default is 4)")
+    parser.add_option("--start-memory-reserve", type="int", dest="start_memory_reserve", default=256, help="Free memory in MB required by each VM starting at the same time (default is 256, 0 to ignore the free memory)")
+    parser.add_option("--shutdown-timeout", type="float", dest="shutdown_timeout", default=30.0, help="Seconds allowed to stop all the VMs on exit or reset (default is 30)")
+    parser.add_option("--console-mux-port", type="int", dest="console_mux_port", default=0, help="Port serving all the VM consoles, the clients select a VM by name or console port (default is 0, disabled)")
+    parser.add_option("--console-raw-mux-port", type="int", dest="console_raw_mux_port", default=0, help="Port serving all the VM consoles to raw TCP clients, the first line selects a VM by name or console port (default is 0, disabled)")
+    parser.add_option("--console-scrollback", type="int", dest="console_scrollback", default=65536, help="Bytes of console output kept for each VM, replayed to new Telnet clients (default is 65536, 0 to disable)")
+    parser.add_option("--transcripts", dest="transcripts", default="", help="Directory where the whole console output of the VMs is recorded (default is empty, no transcripts)")
+    parser.add_option("--transcript-segment-size", type="int", dest="transcript_segment_size", default=16, help="Size in MB of the console transcript files (default is 16)")
+    parser.add_option("--console-buffer-size", type="int", dest="console_buffer_size", default=65536, help="Bytes of console output kept for each Telnet client not reading it fast enough (default is 65536)")
+    parser.add_option("--slow-console-clients", type="choice", choices=[DROP_OLDEST, DISCONNECT], dest="slow_console_clients", default=DROP_OLDEST, help="What to do when the console output buffer of a Telnet client is full: drop the oldest output (drop_oldest) or disconnect the client (disconnect), default is drop_oldest")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=8, help="Number of worker threads running slow or tagged commands (default is 8)")
 
     # ignore an option automatically given by Py2App
     if sys.platform.startswith("darwin") and len(sys.argv) > 1 and sys.argv[1].startswith("-psn"):
@@ -846,7 +2172,19 @@ def main():
     except SystemExit:
         sys.exit(1)
 
-    global VBOX_MANAGER, VBOXVER, VBOXVER_REQUIRED, VBOX_STREAM
+    global VBOX_MANAGER, VBOXVER, VBOXVER_REQUIRED, VBOX_STREAM, SETTINGS_CACHE, SESSION_POOL, SHUTDOWN_TIMEOUT, SCROLLBACK_SIZE, \
+        TRANSCRIPTS
+
+    SHUTDOWN_TIMEOUT = options.shutdown_timeout
+    SCROLLBACK_SIZE = options.console_scrollback
+    if options.transcripts:
+        TRANSCRIPTS = Transcripts(options.transcripts, options.transcript_segment_size * 1024 * 1024)
+    set_output_buffer(options.console_buffer_size, options.slow_console_clients)
+
+    if options.settings_cache:
+        SETTINGS_CACHE = SettingsCache(options.settings_cache)
+
+    START_SCHEDULER.configure(max_concurrency=options.parallel_starts, memory_reserve=options.start_memory_reserve)
 
     if not options.no_vbox_checks and not VBOX_MANAGER:
         print("vboxapi module cannot be loaded, please check if VirtualBox is correctly installed.", file=sys.stderr)
@@ -867,6 +2205,18 @@ def main():
         if sys.platform.startswith("win32"):
             VBOX_STREAM = pythoncom.CoMarshalInterThreadInterfaceInStream(pythoncom.IID_IDispatch, VBOX_MANAGER.vbox)
 
+        SESSION_POOL = SessionPool(lambda: VBOX_MANAGER.mgr.getSessionObject(VBOX_MANAGER.vbox),
+                                   lambda session: session.state == VBOX_MANAGER.constants.SessionState_Unlocked,
+                                   options.session_pool_size,
+                                   # COM objects cannot be shared between threads without marshaling on Windows
+                                   prefill=not sys.platform.startswith("win"))
+        SESSION_POOL.start()
+
+        try:
+            MACHINE_STATES.attach(VirtualBoxEventSource(VBOX_MANAGER))
+        except Exception as e:
+            log.warning("cannot listen to VirtualBox events, machine states will not be cached: {}".format(e))
+
     if options.host and options.host != '0.0.0.0':
         host = options.host
         global IP
@@ -885,10 +2235,35 @@ def main():
         global FORCE_IPV6
         FORCE_IPV6 = options.force_ipv6
 
-    server = VBoxWrapperServer((host, port), VBoxWrapperRequestHandler)
+    if options.engine == "event":
+        server = VBoxWrapperEventServer((host, port), VBoxWrapperEventHandler, options.workers)
+    else:
+        server = VBoxWrapperServer((host, port), VBoxWrapperRequestHandler, options.workers)
 
     print("VBoxWrapper TCP control server started (port %d)." % port)
 
+    if options.console_mux_port:
+        if CONSOLE_HUB is None:
+            print("the multiplexed console port is not supported on this platform", file=sys.stderr)
+        else:
+            try:
+                CONSOLE_HUB.listen(host, options.console_mux_port)
+            except socket.error as e:
+                print("cannot listen on the multiplexed console port {}: {}".format(options.console_mux_port, e), file=sys.stderr)
+                sys.exit(1)
+            print("Multiplexed console port started (port %d)." % options.console_mux_port)
+
+    if options.console_raw_mux_port:
+        if CONSOLE_HUB is None:
+            print("the multiplexed console port is not supported on this platform", file=sys.stderr)
+        else:
+            try:
+                CONSOLE_HUB.listen(host, options.console_raw_mux_port, raw=True)
+            except socket.error as e:
+                print("cannot listen on the raw multiplexed console port {}: {}".format(options.console_raw_mux_port, e), file=sys.stderr)
+                sys.exit(1)
+            print("Raw multiplexed console port started (port %d)." % options.console_raw_mux_port)
+
     if FORCE_IPV6:
         LISTENING_MODE = "Listening in IPv6 mode"
     else:
@@ -21,6 +21,7 @@ Controls VirtualBox using the VBox API.
 
 import sys
 import os
+import contextlib
 import tempfile
 import re
 import time
@@ -33,6 +34,9 @@ if sys.platform.startswith('win'):
 
 from virtualbox_error import VirtualBoxError
 from tcp_pipe_proxy import PipeProxy
+from scrollback import Scrollback
+from settings_cache import file_signature
+from retry import RetryPolicy, RetryError
 
 import logging
 log = logging.getLogger(__name__)
@@ -40,30 +44,64 @@ log = logging.getLogger(__name__)
 
 class VirtualBoxController(object):
 
-    def __init__(self, vmname, vboxmanager, host):
+    # adapter types which can be selected, other values keep the current type
+    adapter_types = {
+        "PCnet-PCI II (Am79C970A)": "NetworkAdapterType_Am79C970A",
+        "PCNet-FAST III (Am79C973)": "NetworkAdapterType_Am79C973",
+        "Intel PRO/1000 MT Desktop (82540EM)": "NetworkAdapterType_I82540EM",
+        "Intel PRO/1000 T Server (82543GC)": "NetworkAdapterType_I82543GC",
+        "Intel PRO/1000 MT Server (82545EM)": "NetworkAdapterType_I82545EM",
+        "Paravirtualized Network (virtio-net)": "NetworkAdapterType_Virtio",
+        }
+
+    # retry policies of the VirtualBox API calls, shared by all the controllers
+    lock_retry = RetryPolicy("lock", attempts=12, deadline=5.0)
+    adapter_retry = RetryPolicy("adapter", attempts=12, deadline=5.0)
+    runtime_retry = RetryPolicy("runtime_change", attempts=10, deadline=4.0)
+    launch_retry = RetryPolicy("launch", attempts=8, initial_delay=0.05, max_delay=2.0, deadline=10.0)
+    session_retry = RetryPolicy("session", attempts=8, deadline=5.0)
+
+    def __init__(self, vmname, vboxmanager, host, machine_states=None, settings_cache=None, session_pool=None,
+                 console_hub=None, scrollback=None, transcript=None):
 
         self._host = host
         self._machine = None
+        self._machine_id = None
+        self._machine_states = machine_states
+        self._settings_cache = settings_cache
+        self._session_pool = session_pool
+        self._console_hub = console_hub
+        self._scrollback = scrollback if scrollback is not None else Scrollback(0)
+        self._transcript = transcript
+        self._settings_file = None
+        # settings known to be saved in the machine, as written by us
+        self._applied = {}
+        self._applied_signature = None
+        self._network_adapters = {}
+        self._writes = 0
+        self._writes_avoided = 0
         self._session = None
         self._vboxmanager = vboxmanager
         self._maximum_adapters = 0
-        self._serial_pipe_thread = None
+        self._serial_proxy = None
         self._serial_pipe = None
+        self._power_down_progress = None
+        self._start_timings = []
 
         self._vmname = vmname
         self._console = 0
         self._adapters = []
         self._headless = False
         self._enable_console = True
+        self._console_mode = "telnet"
         self._adapter_type = "Automatic"
 
-        try:
-            self._machine = self._vboxmanager.vbox.findMachine(self._vmname)
-        except Exception as e:
-            raise VirtualBoxError("VirtualBox error: {}".format(e))
+        self._find_machine()
 
-        # The maximum support network cards depends on the Chipset (PIIX3 or ICH9)
-        self._maximum_adapters = self._vboxmanager.vbox.systemProperties.getMaxNetworkAdapters(self._machine.chipsetType)
+    @property
+    def scrollback(self):
+
+        return self._scrollback
 
     @property
     def vmname(self):
@@ -74,13 +112,7 @@ class VirtualBoxController(object):
     def vmname(self, new_vmname):
 
         self._vmname = new_vmname
-        try:
-            self._machine = self._vboxmanager.vbox.findMachine(new_vmname)
-        except Exception as e:
-            raise VirtualBoxError("VirtualBox error: {}".format(e))
-
-        # The maximum support network cards depends on the Chipset (PIIX3 or ICH9)
-        self._maximum_adapters = self._vboxmanager.vbox.systemProperties.getMaxNetworkAdapters(self._machine.chipsetType)
+        self._find_machine()
 
     @property
     def console(self):
@@ -112,6 +144,16 @@ class VirtualBoxController(object):
 
         self._enable_console = enable_console
 
+    @property
+    def console_mode(self):
+
+        return self._console_mode
+
+    @console_mode.setter
+    def console_mode(self, console_mode):
+
+        self._console_mode = console_mode
+
     @property
     def adapters(self):
 
@@ -122,6 +164,28 @@ class VirtualBoxController(object):
 
         self._adapters = adapters
 
+    @property
+    def start_timings(self):
+        """
+        Returns the duration of the phases of the last start.
+
+        :returns: list of (phase, seconds) tuples
+        """
+
+        return list(self._start_timings)
+
+    @property
+    def start_counters(self):
+        """
+        Returns the number of settings written and of
+        writes avoided because the setting was unchanged
+        since the last start.
+
+        :returns: list of (counter, value) tuples
+        """
+
+        return [("writes", self._writes), ("writes_avoided", self._writes_avoided)]
+
     @property
     def adapter_type(self):
 
@@ -132,20 +196,67 @@ class VirtualBoxController(object):
 
         self._adapter_type = adapter_type
 
+    def _find_machine(self):
+
+        try:
+            self._machine = self._vboxmanager.vbox.findMachine(self._vmname)
+            self._machine_id = self._machine.id
+            self._settings_file = self._machine.settingsFilePath
+        except Exception as e:
+            raise VirtualBoxError("VirtualBox error: {}".format(e))
+        self._applied = {}
+        self._applied_signature = None
+
+        if self._machine_states is not None:
+            self._machine_states.update(self._machine_id, name=self._vmname)
+
+        # The maximum support network cards depends on the Chipset (PIIX3 or ICH9)
+        self._maximum_adapters = self._vboxmanager.vbox.systemProperties.getMaxNetworkAdapters(self._machine.chipsetType)
+
+    def _machine_state(self):
+        """
+        Returns the machine state, from the state cache when it knows it.
+        """
+
+        if self._machine_states is not None:
+            state = self._machine_states.state(self._machine_id)
+            if state is not None:
+                return state
+            state = self._machine.state
+            self._machine_states.update(self._machine_id, state=state)
+            return state
+        return self._machine.state
+
+    def _is_online(self):
+
+        state = self._machine_state()
+        return self._vboxmanager.constants.MachineState_FirstOnline <= state <= \
+            self._vboxmanager.constants.MachineState_LastOnline
+
+    def _state_changed(self):
+
+        # our own change may not have been notified by the event listener yet
+        if self._machine_states is not None:
+            self._machine_states.invalidate(self._machine_id)
+
     def start(self):
 
         if len(self._adapters) > self._maximum_adapters:
             raise VirtualBoxError("Number of adapters above the maximum supported of {}".format(self._maximum_adapters))
 
-        if self._machine.state == self._vboxmanager.constants.MachineState_Paused:
+        if self._machine_state() == self._vboxmanager.constants.MachineState_Paused:
             self.resume()
             return
 
-        self._get_session()
-        self._set_network_options()
-        self._set_console_options()
+        self._start_timings = []
+        self._writes = self._writes_avoided = 0
+        with self._phase("session"):
+            self._get_session()
+        self._configure()
 
-        progress = self._launch_vm_process()
+        with self._phase("launch"):
+            progress = self._launch_vm_process()
+        self._state_changed()
         log.info("VM is starting with {}% completed".format(progress.percent))
         if progress.percent != 100:
             # This will happen if you attempt to start VirtualBox with unloaded "vboxdrv" module.
@@ -160,34 +271,102 @@ class VirtualBoxController(object):
             pass
 
         if self._enable_console:
-            # starts the Telnet to pipe thread
-            pipe_name = self._get_pipe_name()
-            if sys.platform.startswith('win'):
-                try:
-                    self._serial_pipe = open(pipe_name, "a+b")
-                except OSError as e:
-                    raise VirtualBoxError("Could not open the pipe {}: {}".format(pipe_name, e))
-                self._serial_pipe_thread = PipeProxy(self._vmname, msvcrt.get_osfhandle(self._serial_pipe.fileno()), self._host, self._console)
-                #self._serial_pipe_thread.setDaemon(True)
-                self._serial_pipe_thread.start()
-            else:
+            with self._phase("console"):
+                self._start_pipe_proxy()
+        log.info("{} started in {:.3f}s ({})".format(self._vmname,
+                                                    sum(seconds for phase, seconds in self._start_timings),
+                                                    ", ".join("{} {:.3f}s".format(phase, seconds) for phase, seconds in self._start_timings)))
+
+    def _start_pipe_proxy(self):
+        """
+        Connects to the serial pipe and serves it to Telnet clients, or
+        to raw TCP clients, with the console hub or with a thread of its own.
+        """
+
+        raw = self._console_mode == "raw"
+        pipe_name = self._get_pipe_name()
+        if sys.platform.startswith('win'):
+            try:
+                self._serial_pipe = open(pipe_name, "a+b")
+            except OSError as e:
+                raise VirtualBoxError("Could not open the pipe {}: {}".format(pipe_name, e))
+            self._serial_proxy = PipeProxy(self._vmname, msvcrt.get_osfhandle(self._serial_pipe.fileno()), self._host, self._console,
+                                           self._scrollback, self._transcript, raw=raw)
+            #self._serial_proxy.setDaemon(True)
+            self._serial_proxy.start()
+        else:
+            try:
+                self._serial_pipe = self._connect_pipe()
+            except (OSError, socket.error) as e:
+                raise VirtualBoxError("Could not connect to the pipe {}: {}".format(pipe_name, e))
+            if self._console_hub is not None:
+                # the console reconnects when the VM process is restarted
                 try:
-                    self._serial_pipe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                    self._serial_pipe.connect(pipe_name)
-                except OSError as e:
-                    raise VirtualBoxError("Could not connect to the pipe {}: {}".format(pipe_name, e))
-                self._serial_pipe_thread = PipeProxy(self._vmname, self._serial_pipe, self._host, self._console)
-                #self._serial_pipe_thread.setDaemon(True)
-                self._serial_pipe_thread.start()
+                    self._serial_proxy = self._console_hub.add_console(self._vmname, self._serial_pipe, self._host, self._console,
+                                                                       self._scrollback, self._transcript, self._connect_pipe, raw)
+                except socket.error as e:
+                    raise VirtualBoxError("Could not serve the console on port {}: {}".format(self._console, e))
+                return
+            self._serial_proxy = PipeProxy(self._vmname, self._serial_pipe, self._host, self._console, self._scrollback,
+                                           self._transcript, raw=raw)
+            #self._serial_proxy.setDaemon(True)
+            self._serial_proxy.start()
+
+    def _connect_pipe(self):
+        """
+        Connects to the serial pipe UNIX socket of the VM.
+
+        :returns: connected socket
+        """
+
+        pipe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            pipe.connect(self._get_pipe_name())
+        except socket.error:
+            pipe.close()
+            raise
+        return pipe
 
     def stop(self):
 
-        if self._serial_pipe_thread:
-            self._serial_pipe_thread.stop()
-            self._serial_pipe_thread.join(1)
-            if self._serial_pipe_thread.isAlive():
-                log.warn("Serial pire thread is still alive!")
-            self._serial_pipe_thread = None
+        self.stop_console()
+        try:
+            if self.power_down():
+                self.wait_powered_down()
+                self.reset_adapters()
+        except VirtualBoxError as e:
+            # Do not crash "vboxwrapper", if stopping VM fails.
+            # But return True anyway, so VM state in GNS3 can become "stopped"
+            # This can happen, if user manually kills VBox VM.
+            log.warn("could not stop VM for {}: {}".format(self._vmname, e))
+
+    def send_to_console(self, data):
+        """
+        Sends bytes to the serial pipe, as if typed on the console.
+
+        :param data: string
+        """
+
+        if not self._serial_proxy:
+            raise VirtualBoxError("The console of {} is not started".format(self._vmname))
+        try:
+            sent = self._serial_proxy.send_to_pipe(data)
+        except (OSError, socket.error) as e:
+            raise VirtualBoxError("Could not write to the pipe of {}: {}".format(self._vmname, e))
+        if not sent:
+            raise VirtualBoxError("The console of {} is not connected to the VM".format(self._vmname))
+
+    def stop_console(self):
+        """
+        Stops the serial console proxy.
+        """
+
+        if self._serial_proxy:
+            self._serial_proxy.stop()
+            self._serial_proxy.join(1)
+            if self._serial_proxy.isAlive():
+                log.warn("Serial pipe proxy is still alive!")
+            self._serial_proxy = None
 
         if self._serial_pipe:
             if sys.platform.startswith('win'):
@@ -196,36 +375,74 @@ class VirtualBoxController(object):
                 self._serial_pipe.close()
             self._serial_pipe = None
 
-        if self._machine.state >= self._vboxmanager.constants.MachineState_FirstOnline and \
-                self._machine.state <= self._vboxmanager.constants.MachineState_LastOnline:
-            try:
-                if sys.platform.startswith('win') and "VBOX_INSTALL_PATH" in os.environ:
-                    # work around VirtualBox bug #9239
-                    vboxmanage_path = os.path.join(os.environ["VBOX_INSTALL_PATH"], "VBoxManage.exe")
-                    command = '"{}" controlvm "{}" poweroff'.format(vboxmanage_path, self._vmname)
-                    subprocess.call(command, timeout=3)
-                else:
-                    progress = self._session.console.powerDown()
-                    # wait for VM to actually go down
-                    progress.waitForCompletion(3000)
-                    log.info("VM is stopping with {}% completed".format(self.vmname, progress.percent))
-
-                self._lock_machine()
-
-                for adapter_id in range(0, len(self._adapters)):
-                    if self._adapters[adapter_id] is None:
-                        continue
-                    self._disable_adapter(adapter_id, disable=True)
-                serial_port = self._session.machine.getSerialPort(0)
-                serial_port.enabled = False
-                self._session.machine.saveSettings()
-                self._unlock_machine()
-            except Exception as e:
-                # Do not crash "vboxwrapper", if stopping VM fails.
-                # But return True anyway, so VM state in GNS3 can become "stopped"
-                # This can happen, if user manually kills VBox VM.
-                log.warn("could not stop VM for {}: {}".format(self._vmname, e))
-                return
+    def _stop_failed(self, error):
+
+        self._forget_applied()
+        self._network_adapters = {}
+        if isinstance(error, VirtualBoxError):
+            return error
+        return VirtualBoxError("VirtualBox error: {}".format(error))
+
+    def power_down(self):
+        """
+        Asks the VM to power off, without waiting for it.
+
+        :returns: True if the VM was running
+        """
+
+        self._power_down_progress = None
+        if not self._is_online():
+            return False
+        try:
+            if sys.platform.startswith('win') and "VBOX_INSTALL_PATH" in os.environ:
+                # work around VirtualBox bug #9239
+                vboxmanage_path = os.path.join(os.environ["VBOX_INSTALL_PATH"], "VBoxManage.exe")
+                command = '"{}" controlvm "{}" poweroff'.format(vboxmanage_path, self._vmname)
+                subprocess.call(command, timeout=3)
+            else:
+                self._power_down_progress = self._session.console.powerDown()
+        except Exception as e:
+            raise self._stop_failed(e)
+        return True
+
+    def wait_powered_down(self, timeout=3.0):
+        """
+        Waits for the VM to actually go down after power_down().
+
+        :param timeout: maximum seconds to wait
+        """
+
+        progress = self._power_down_progress
+        self._power_down_progress = None
+        try:
+            if progress is not None:
+                progress.waitForCompletion(int(timeout * 1000))
+                log.info("VM is stopping with {}% completed".format(self.vmname, progress.percent))
+        except Exception as e:
+            raise self._stop_failed(e)
+        self._state_changed()
+
+    def reset_adapters(self):
+        """
+        Disconnects the adapters and the serial port of a powered down VM.
+        """
+
+        try:
+            self._lock_machine()
+            self._load_applied()
+
+            for adapter_id in range(0, len(self._adapters)):
+                if self._adapters[adapter_id] is None:
+                    continue
+                self._disable_adapter(adapter_id, disable=True)
+            self._set_serial_port("enabled", False)
+            self._save_settings()
+            self._unlock_machine()
+            self._release_session()
+        except Exception as e:
+            raise self._stop_failed(e)
+        finally:
+            self._network_adapters = {}
 
     def suspend(self):
 
@@ -233,6 +450,7 @@ class VirtualBoxController(object):
             self._session.console.pause()
         except Exception as e:
             raise VirtualBoxError("VirtualBox error: {}".format(e))
+        self._state_changed()
 
     def reload(self):
 
@@ -247,58 +465,186 @@ class VirtualBoxController(object):
             self._session.console.resume()
         except Exception as e:
             raise VirtualBoxError("VirtualBox error: {}".format(e))
+        self._state_changed()
+
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        """
+        Records the duration of a start phase.
+        """
+
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self._start_timings.append((phase, time.time() - begin))
+
+    def _configure(self):
+        """
+        Applies the network and console options in a single
+        configuration transaction: one lock, one save and one unlock.
+        """
+
+        with self._phase("lock"):
+            self._lock_machine()
+        try:
+            self._load_applied()
+            with self._phase("network"):
+                self._set_network_options()
+            with self._phase("serial"):
+                self._set_console_options()
+            with self._phase("save"):
+                try:
+                    self._save_settings()
+                except Exception as e:
+                    raise VirtualBoxError("VirtualBox error: {}".format(e))
+        except Exception:
+            self._forget_applied()
+            # do not leave the machine locked
+            try:
+                self._session.unlockMachine()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._network_adapters = {}
+        with self._phase("unlock"):
+            self._unlock_machine()
+        log.debug("{} settings written, {} unchanged".format(self._writes, self._writes_avoided))
+
+    def _load_applied(self):
+        """
+        Checks the applied settings are still those of the machine,
+        nobody else must have changed the settings file since we saved it.
+        """
+
+        # adapters of a previous session must not be reused
+        self._network_adapters = {}
+        signature = file_signature(self._settings_file)
+        if signature is not None and signature == self._applied_signature:
+            return
+        self._applied = {}
+        if self._settings_cache is not None:
+            # recorded by a previous run of the wrapper
+            self._applied = self._settings_cache.load(self._machine_id, signature)
+        self._applied_signature = signature
+
+    def _save_settings(self):
+        """
+        Saves the machine settings and records the applied settings.
+        """
+
+        self._session.machine.saveSettings()
+        self._applied_signature = file_signature(self._settings_file)
+        if self._settings_cache is not None:
+            self._settings_cache.store(self._machine_id, self._applied_signature, self._applied)
+
+    def _forget_applied(self):
+        """
+        Forgets the applied settings, when unsaved changes may be lost.
+        """
+
+        self._applied = {}
+        self._applied_signature = None
+        if self._settings_cache is not None:
+            self._settings_cache.forget(self._machine_id)
+
+    def _network_adapter(self, adapter_id):
+
+        adapter = self._network_adapters.get(adapter_id)
+        if adapter is None:
+            # VirtualBox starts counting from 0
+            adapter = self._network_adapters[adapter_id] = self._session.machine.getNetworkAdapter(adapter_id)
+        return adapter
+
+    def _write(self, key, write, value):
+        """
+        Writes a setting unless it is known to have this value already.
+
+        :param key: setting key in the applied settings
+        :param write: function writing the value
+        :param value: setting value
+        """
+
+        if key in self._applied and self._applied[key] == value:
+            self._writes_avoided += 1
+            return
+        # the value is unknown until written
+        self._applied.pop(key, None)
+        write(value)
+        self._writes += 1
+        self._applied[key] = value
+
+    def _set_adapter(self, adapter_id, attribute, value):
+
+        self._write("adapter{}.{}".format(adapter_id, attribute),
+                    lambda value: setattr(self._network_adapter(adapter_id), attribute, value),
+                    value)
+
+    def _set_adapter_property(self, adapter_id, name, value):
+
+        self._write("adapter{}.property.{}".format(adapter_id, name),
+                    lambda value: self._network_adapter(adapter_id).setProperty(name, value),
+                    value)
+
+    def _set_serial_port(self, attribute, value):
+
+        self._write("serial.{}".format(attribute),
+                    lambda value: setattr(self._session.machine.getSerialPort(0), attribute, value),
+                    value)
 
     def _get_session(self):
 
         log.debug("getting session for {}".format(self._vmname))
-        try:
-            self._session = self._vboxmanager.mgr.getSessionObject(self._vboxmanager.vbox)
-        except Exception as e:
-            # fails on heavily loaded hosts...
-            raise VirtualBoxError("VirtualBox error: {}".format(e))
+        self._release_session()
+        # fails on heavily loaded hosts...
+        if self._session_pool is not None:
+            self._session = self._retry(self.session_retry, "get a session", self._session_pool.acquire)
+        else:
+            self._session = self._retry(self.session_retry, "get a session",
+                                        self._vboxmanager.mgr.getSessionObject, self._vboxmanager.vbox)
+
+    def _release_session(self):
+        """
+        Gives the session back to the pool once the machine is unlocked.
+        """
+
+        session = self._session
+        self._session = None
+        if session is not None and self._session_pool is not None:
+            self._session_pool.release(session)
 
     def _set_network_options(self):
+        """
+        Configures the network adapters, the machine must be locked.
+        """
 
         log.debug("setting network options for {}".format(self._vmname))
 
-        self._lock_machine()
-
-        first_adapter_type = self._vboxmanager.constants.NetworkAdapterType_I82540EM
-        try:
-            first_adapter = self._session.machine.getNetworkAdapter(0)
-            first_adapter_type = first_adapter.adapterType
-        except Exception as e:
-            pass
-            #raise VirtualBoxError("VirtualBox error: {}".format(e))
+        constants = self._vboxmanager.constants
+        vbox_adapter_type = None
+        if self._adapter_type in self.adapter_types:
+            vbox_adapter_type = getattr(constants, self.adapter_types[self._adapter_type])
+        elif self._adapter_type == "Automatic":  # "Auto-guess, based on first NIC"
+            vbox_adapter_type = constants.NetworkAdapterType_I82540EM
+            try:
+                vbox_adapter_type = self._network_adapter(0).adapterType
+            except Exception as e:
+                pass
+                #raise VirtualBoxError("VirtualBox error: {}".format(e))
 
         for adapter_id in range(0, len(self._adapters)):
 
             try:
-                # VirtualBox starts counting from 0
-                adapter = self._session.machine.getNetworkAdapter(adapter_id)
                 if self._adapters[adapter_id] is None:
                     # force enable to avoid any discrepancy in the interface numbering inside the VM
                     # e.g. Ethernet2 in GNS3 becoming eth0 inside the VM when using a start index of 2.
-                    adapter.enabled = True
+                    self._set_adapter(adapter_id, "enabled", True)
                     continue
 
-                vbox_adapter_type = adapter.adapterType
-                if self._adapter_type == "PCnet-PCI II (Am79C970A)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_Am79C970A
-                if self._adapter_type == "PCNet-FAST III (Am79C973)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_Am79C973
-                if self._adapter_type == "Intel PRO/1000 MT Desktop (82540EM)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_I82540EM
-                if self._adapter_type == "Intel PRO/1000 T Server (82543GC)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_I82543GC
-                if self._adapter_type == "Intel PRO/1000 MT Server (82545EM)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_I82545EM
-                if self._adapter_type == "Paravirtualized Network (virtio-net)":
-                    vbox_adapter_type = self._vboxmanager.constants.NetworkAdapterType_Virtio
-                if self._adapter_type == "Automatic":  # "Auto-guess, based on first NIC"
-                    vbox_adapter_type = first_adapter_type
-
-                adapter.adapterType = vbox_adapter_type
+                # other adapter types keep the current type of the adapter
+                if vbox_adapter_type is not None:
+                    self._set_adapter(adapter_id, "adapterType", vbox_adapter_type)
 
             except Exception as e:
                 raise VirtualBoxError("VirtualBox error: {}".format(e))
@@ -307,32 +653,32 @@ class VirtualBoxController(object):
             if nio:
                 log.debug("setting UDP params on adapter {}".format(adapter_id))
                 try:
-                    adapter.enabled = True
-                    adapter.cableConnected = True
-                    adapter.traceEnabled = False
+                    self._set_adapter(adapter_id, "enabled", True)
+                    self._set_adapter(adapter_id, "cableConnected", True)
+                    self._set_adapter(adapter_id, "traceEnabled", False)
                     # Temporary hack around VBox-UDP patch limitation: inability to use DNS
                     if nio.rhost == 'localhost':
                         rhost = '127.0.0.1'
                     else:
                         rhost = nio.rhost
-                    adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Generic
-                    adapter.genericDriver = "UDPTunnel"
-                    adapter.setProperty("sport", str(nio.lport))
-                    adapter.setProperty("dest", rhost)
-                    adapter.setProperty("dport", str(nio.rport))
+                    self._set_adapter(adapter_id, "attachmentType", constants.NetworkAttachmentType_Generic)
+                    self._set_adapter(adapter_id, "genericDriver", "UDPTunnel")
+                    self._set_adapter_property(adapter_id, "sport", str(nio.lport))
+                    self._set_adapter_property(adapter_id, "dest", rhost)
+                    self._set_adapter_property(adapter_id, "dport", str(nio.rport))
                 except Exception as e:
                     # usually due to COM Error: "The object is not ready"
                     raise VirtualBoxError("VirtualBox error: {}".format(e))
 
                 if nio.capturing:
-                    self._enable_capture(adapter, nio.pcap_output_file)
+                    self._enable_capture(adapter_id, nio.pcap_output_file)
 
             else:
                 # shutting down unused adapters...
                 try:
-                    adapter.enabled = True
-                    adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Null
-                    adapter.cableConnected = False
+                    self._set_adapter(adapter_id, "enabled", True)
+                    self._set_adapter(adapter_id, "attachmentType", constants.NetworkAttachmentType_Null)
+                    self._set_adapter(adapter_id, "cableConnected", False)
                 except Exception as e:
                     raise VirtualBoxError("VirtualBox error: {}".format(e))
 
@@ -340,106 +686,121 @@ class VirtualBoxController(object):
             log.debug("disabling remaining adapter {}".format(adapter_id))
             self._disable_adapter(adapter_id)
 
-        try:
-            self._session.machine.saveSettings()
-        except Exception as e:
-            raise VirtualBoxError("VirtualBox error: {}".format(e))
+    def _retry(self, policy, description, func, *args):
+        """
+        Calls a VirtualBox API function with a retry policy.
+
+        :param policy: RetryPolicy instance
+        :param description: what the call does
+        :param func: function to call
+        :param args: function arguments
 
-        self._unlock_machine()
+        :returns: what the function returns
+        """
+
+        try:
+            return policy.run("{} for {}".format(description, self._vmname), func, *args)
+        except RetryError as e:
+            raise VirtualBoxError(str(e), e.last_exception)
 
     def _disable_adapter(self, adapter_id, disable=True):
 
         log.debug("disabling network adapter for {}".format(self._vmname))
-        # this command is retried several times, because it fails more often...
-        retries = 6
-        last_exception = None
-        for retry in range(retries):
-            if retry == (retries - 1):
-                raise VirtualBoxError("Could not disable network adapter after 4 retries: {}".format(last_exception))
+
+        def disable_adapter():
             try:
-                adapter = self._session.machine.getNetworkAdapter(adapter_id)
-                adapter.traceEnabled = False
-                adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Null
+                self._set_adapter(adapter_id, "traceEnabled", False)
+                self._set_adapter(adapter_id, "attachmentType", self._vboxmanager.constants.NetworkAttachmentType_Null)
                 if disable:
-                    adapter.enabled = False
-                break
-            except Exception as e:
+                    self._set_adapter(adapter_id, "enabled", False)
+            except Exception:
                 # usually due to COM Error: "The object is not ready"
-                log.warn("cannot disable network adapter for {}, retrying {}: {}".format(self._vmname, retry + 1, e))
-                last_exception = e
-                time.sleep(1)
-                continue
+                self._network_adapters.pop(adapter_id, None)
+                raise
 
-    def _enable_capture(self, adapter, output_file):
+        # this command is retried several times, because it fails more often...
+        self._retry(self.adapter_retry, "disable network adapter {}".format(adapter_id), disable_adapter)
+
+    def _enable_capture(self, adapter_id, output_file):
 
         log.debug("enabling capture for {}".format(self._vmname))
+
+        def enable_capture():
+            self._set_adapter(adapter_id, "traceEnabled", True)
+            self._set_adapter(adapter_id, "traceFile", output_file)
+
         # this command is retried several times, because it fails more often...
-        retries = 4
-        last_exception = None
-        for retry in range(retries):
-            if retry == (retries - 1):
-                raise VirtualBoxError("Could not enable packet capture after 4 retries: {}".format(last_exception))
-            try:
-                adapter.traceEnabled = True
-                adapter.traceFile = output_file
-                break
-            except Exception as e:
-                log.warn("cannot enable packet capture for {}, retrying {}: {}".format(self._vmname, retry + 1, e))
-                last_exception = e
-                time.sleep(0.75)
-                continue
+        self._retry(self.adapter_retry, "enable packet capture on adapter {}".format(adapter_id), enable_capture)
+
+    def _runtime_change(self, change):
+        """
+        Applies a change to a running machine and saves it, the
+        applied settings are forgotten if the change fails.
+        """
+
+        try:
+            self._load_applied()
+            change()
+        except Exception:
+            self._forget_applied()
+            raise
+
+    def _connect_udp(self, adapter_id, sport, daddr, dport):
+
+        self._set_adapter(adapter_id, "cableConnected", True)
+        # detach first so the UDP tunnel driver is recreated with its new properties
+        self._set_adapter(adapter_id, "attachmentType", self._vboxmanager.constants.NetworkAttachmentType_Null)
+        self._set_adapter(adapter_id, "attachmentType", self._vboxmanager.constants.NetworkAttachmentType_Generic)
+        self._set_adapter(adapter_id, "genericDriver", "UDPTunnel")
+        self._set_adapter_property(adapter_id, "sport", str(sport))
+        self._set_adapter_property(adapter_id, "dest", daddr)
+        self._set_adapter_property(adapter_id, "dport", str(dport))
+
+    def _disconnect_udp(self, adapter_id):
+
+        self._set_adapter(adapter_id, "attachmentType", self._vboxmanager.constants.NetworkAttachmentType_Null)
+        self._set_adapter(adapter_id, "cableConnected", False)
 
     def create_udp(self, adapter_id, sport, daddr, dport):
 
-        if self._machine.state >= self._vboxmanager.constants.MachineState_FirstOnline and \
-                self._machine.state <= self._vboxmanager.constants.MachineState_LastOnline:
-            # the machine is being executed
-            retries = 4
-            last_exception = None
-            for retry in range(retries):
-                if retry == (retries - 1):
-                    raise VirtualBoxError("Could not create an UDP tunnel after 4 retries :{}".format(last_exception))
-                try:
-                    adapter = self._session.machine.getNetworkAdapter(adapter_id)
-                    adapter.cableConnected = True
-                    adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Null
-                    self._session.machine.saveSettings()
-                    adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Generic
-                    adapter.genericDriver = "UDPTunnel"
-                    adapter.setProperty("sport", str(sport))
-                    adapter.setProperty("dest", daddr)
-                    adapter.setProperty("dport", str(dport))
-                    self._session.machine.saveSettings()
-                    break
-                except Exception as e:
-                    # usually due to COM Error: "The object is not ready"
-                    log.warn("cannot create UDP tunnel for {}: {}".format(self._vmname, e))
-                    last_exception = e
-                    time.sleep(0.75)
-                    continue
+        self.apply_udp_changes([("create", adapter_id, sport, daddr, dport)])
 
     def delete_udp(self, adapter_id):
 
-        if self._machine.state >= self._vboxmanager.constants.MachineState_FirstOnline and \
-                self._machine.state <= self._vboxmanager.constants.MachineState_LastOnline:
-            # the machine is being executed
-            retries = 4
-            last_exception = None
-            for retry in range(retries):
-                if retry == (retries - 1):
-                    raise VirtualBoxError("Could not delete an UDP tunnel after 4 retries :{}".format(last_exception))
-                try:
-                    adapter = self._session.machine.getNetworkAdapter(adapter_id)
-                    adapter.attachmentType = self._vboxmanager.constants.NetworkAttachmentType_Null
-                    adapter.cableConnected = False
-                    self._session.machine.saveSettings()
-                    break
-                except Exception as e:
-                    # usually due to COM Error: "The object is not ready"
-                    log.debug("cannot delete UDP tunnel for {}: {}".format(self._vmname, e))
-                    last_exception = e
-                    time.sleep(0.75)
-                    continue
+        self.apply_udp_changes([("delete", adapter_id)])
+
+    def apply_udp_changes(self, changes, save=True):
+        """
+        Creates and deletes UDP tunnels on the running machine
+        with a single save of the settings.
+
+        :param changes: list of ("create", adapter_id, sport, daddr, dport)
+        and ("delete", adapter_id) tuples, applied in order
+        :param save: False to only change the running machine, the
+        changes are then lost once the machine is powered off
+        """
+
+        if not self._is_online() or not changes:
+            return
+
+        # the machine is being executed
+        def apply_changes():
+            saved = dict(self._applied)
+            for change in changes:
+                if change[0] == "create":
+                    self._connect_udp(*change[1:])
+                else:
+                    self._disconnect_udp(change[1])
+            if save:
+                self._save_settings()
+                return
+            # unsaved values are not those of the settings file
+            for key, value in list(self._applied.items()):
+                if key not in saved or saved[key] != value:
+                    del self._applied[key]
+
+        self._retry(self.runtime_retry, "apply {} UDP tunnel changes".format(len(changes)),
+                    self._runtime_change, apply_changes)
 
     def _get_pipe_name(self):
 
@@ -467,49 +828,33 @@ class VirtualBoxController(object):
         serial_port.hostMode = 1
         serial_port.server = True
         session.unlockMachine()
+
+        The machine must be locked.
         """
 
         log.info("setting console options for {}".format(self._vmname))
 
-        self._lock_machine()
         pipe_name = self._get_pipe_name()
 
         try:
-            serial_port = self._session.machine.getSerialPort(0)
-            serial_port.enabled = True
-            serial_port.path = pipe_name
-            serial_port.hostMode = 1
-            serial_port.server = True
-            self._session.machine.saveSettings()
+            self._set_serial_port("enabled", True)
+            self._set_serial_port("path", pipe_name)
+            self._set_serial_port("hostMode", 1)
+            self._set_serial_port("server", True)
         except Exception as e:
             raise VirtualBoxError("VirtualBox error: {}".format(e))
 
-        self._unlock_machine()
-
     def _launch_vm_process(self):
 
         log.debug("launching VM {}".format(self._vmname))
-        # this command is retried several times, because it fails more often...
-        retries = 4
-        last_exception = None
-        for retry in range(retries):
-            if retry == (retries - 1):
-                raise VirtualBoxError("Could not launch the VM after 4 retries: {}".format(last_exception))
-            try:
-                if self._headless:
-                    mode = "headless"
-                else:
-                    mode = "gui"
-                log.info("starting {} in {} mode".format(self._vmname, mode))
-                progress = self._machine.launchVMProcess(self._session, mode, "")
-                break
-            except Exception as e:
-                # This will usually happen if you try to start the same VM twice,
-                # but may happen on loaded hosts too...
-                log.warn("cannot launch VM {}, retrying {}: {}".format(self._vmname, retry + 1, e))
-                last_exception = e
-                time.sleep(0.6)
-                continue
+        if self._headless:
+            mode = "headless"
+        else:
+            mode = "gui"
+        log.info("starting {} in {} mode".format(self._vmname, mode))
+        # This will usually fail if you try to start the same VM twice,
+        # but may happen on loaded hosts too...
+        progress = self._retry(self.launch_retry, "launch the VM", self._machine.launchVMProcess, self._session, mode, "")
 
         try:
             progress.waitForCompletion(-1)
@@ -522,34 +867,10 @@ class VirtualBoxController(object):
 
         log.debug("locking machine for {}".format(self._vmname))
         # this command is retried several times, because it fails more often...
-        retries = 4
-        last_exception = None
-        for retry in range(retries):
-            if retry == (retries - 1):
-                raise VirtualBoxError("Could not lock the machine after 4 retries: {}".format(last_exception))
-            try:
-                self._machine.lockMachine(self._session, 1)
-                break
-            except Exception as e:
-                log.warn("cannot lock the machine for {}, retrying {}: {}".format(self._vmname, retry + 1, e))
-                last_exception = e
-                time.sleep(1)
-                continue
+        self._retry(self.lock_retry, "lock the machine", self._machine.lockMachine, self._session, 1)
 
     def _unlock_machine(self):
 
         log.debug("unlocking machine for {}".format(self._vmname))
         # this command is retried several times, because it fails more often...
-        retries = 4
-        last_exception = None
-        for retry in range(retries):
-            if retry == (retries - 1):
-                raise VirtualBoxError("Could not unlock the machine after 4 retries: {}".format(last_exception))
-            try:
-                self._session.unlockMachine()
-                break
-            except Exception as e:
-                log.warn("cannot unlock the machine for {}, retrying {}: {}".format(self._vmname, retry + 1, e))
-                time.sleep(1)
-                last_exception = e
-                continue
+        self._retry(self.lock_retry, "unlock the machine", self._session.unlockMachine)
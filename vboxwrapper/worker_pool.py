@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 GNS3 Technologies Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bounded pool of worker threads used to run slow VirtualBox calls.
+"""
+
+import collections
+import contextlib
+import threading
+import Queue
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Fixed number of daemon threads consuming a task queue.
+
+    :param size: number of worker threads
+    :param name: prefix for the thread names
+    """
+
+    def __init__(self, size=8, name="worker"):
+
+        self._size = max(1, size)
+        self._name = name
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+
+        return self._size
+
+    def _ensure_started(self):
+
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self._size):
+                thread = threading.Thread(target=self._run, name="{}-{}".format(self._name, index))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, args=(), callback=None):
+        """
+        Queues a call to be run by a worker thread.
+
+        :param func: function to call
+        :param args: function arguments
+        :param callback: called with no arguments once func has returned
+        """
+
+        self._ensure_started()
+        self._tasks.put((func, args, callback))
+
+    def _run(self):
+
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            func, args, callback = task
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("exception in worker thread: {}".format(e))
+            finally:
+                if callback:
+                    try:
+                        callback()
+                    except Exception as e:
+                        log.error("exception in worker callback: {}".format(e))
+
+    def shutdown(self):
+        """
+        Stops the worker threads once the queued tasks have run.
+        """
+
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for _ in threads:
+            self._tasks.put(None)
+
+
+class KeyedExecutor(object):
+    """
+    Runs tasks on a WorkerPool, tasks sharing the same key run
+    one after the other in submission order, tasks with different
+    keys run concurrently.
+
+    :param pool: WorkerPool instance
+    """
+
+    def __init__(self, pool):
+
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._held = {}     # keys held by hold(), with their number of holders
+
+    def idle(self):
+        """
+        Returns either no task is queued or running.
+
+        :returns: boolean
+        """
+
+        return not self._queues and not self._held
+
+    def pending(self, key):
+        """
+        Returns either tasks are queued or running for a key.
+
+        :param key: task key
+
+        :returns: boolean
+        """
+
+        # dictionary lookups are atomic, no need to lock
+        return key in self._queues or key in self._held
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        """
+        Makes keys pending while they are worked on outside of the
+        executor, the callers checking pending() then queue their
+        tasks instead of running them and blocking on the same locks.
+
+        :param keys: task keys
+        """
+
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._held[key] = self._held.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._held[key] -= 1
+                    if not self._held[key]:
+                        del self._held[key]
+
+    def submit(self, key, func, args=(), callback=None):
+        """
+        Queues a task after the other tasks of the same key.
+
+        :param key: task key
+        :param func: function to call
+        :param args: function arguments
+        :param callback: called with no arguments once func has returned
+        """
+
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, args, callback))
+                return
+            self._queues[key] = collections.deque([(func, args, callback)])
+        self._pool.submit(self._drain, (key,))
+
+    def _drain(self, key):
+
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                # the task stays queued while running so pending() sees it
+                func, args, callback = queue[0]
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("exception in worker thread: {}".format(e))
+            finally:
+                with self._lock:
+                    queue.popleft()
+                if callback:
+                    try:
+                        callback()
+                    except Exception as e:
+                        log.error("exception in worker callback: {}".format(e))